@@ -0,0 +1,812 @@
+#!/usr/bin/env python3
+#
+# A local stand-in for the subset of the Google Drive v3 API that the
+# scripts in this directory use, so that they can be benchmarked (and
+# generally beaten on) without touching real data.
+#
+# Implements:
+#
+# - files.list / get / create / update / copy
+# - teamdrives.list / get / create
+# - changes.getStartPageToken / list
+# - batch requests
+# - the discovery document, so that googleapiclient can build() a
+#   service against this server
+#
+# Point the scripts at it by setting GX_DRIVE_API_URL to the URL that
+# this server prints when it starts (see gxlib/api.py).  The access
+# token in the credentials file says who the caller is: a token of
+# "fake:EMAIL" is user EMAIL (bench/run-bench.py writes such
+# credentials files).
+#
+# The initial contents of the drive come from a JSON tree made by
+# bench/make-tree.py.
+#
+# Just enough of Drive's rules are enforced to make the scripts do
+# what they would do for real:
+#
+# - Files with more than one parent cannot be moved to a Team Drive.
+# - Only the owner of a file, or someone in the owner's domain (i.e.,
+#   the domain admin), can move it to a Team Drive.
+#
+# Everyone can see everything (i.e., everyone is an admin as far as
+# reading goes).
+#
+# Latency, errors, and per-user quotas can be injected (see --help).
+#
+
+import re
+import sys
+import json
+import time
+import email
+import random
+import argparse
+import threading
+import traceback
+import socketserver
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+folder_mime_type = 'application/vnd.google-apps.folder'
+
+args = None
+
+#-------------------------------------------------------------------
+
+class DriveError(Exception):
+    def __init__(self, code, reason, message):
+        self.code    = code
+        self.reason  = reason
+        self.message = message
+
+    def body(self):
+        return { 'error' : { 'errors'  : [ { 'domain'  : 'global',
+                                             'reason'  : self.reason,
+                                             'message' : self.message } ],
+                             'code'    : self.code,
+                             'message' : self.message } }
+
+def bool_param(params, name):
+    return params.get(name, 'false').lower() == 'true'
+
+#-------------------------------------------------------------------
+
+# Drive's "fields" syntax: "nextPageToken,files(id,name,owners)".
+# Returns a hash of field name -> sub-spec (None means "all of it").
+def parse_fields(fields):
+    spec  = dict()
+    stack = [ spec ]
+    name  = ''
+    for c in fields + ',':
+        if c == '(':
+            sub = dict()
+            stack[-1][name.strip()] = sub
+            stack.append(sub)
+            name = ''
+        elif c == ')':
+            if name.strip():
+                stack[-1][name.strip()] = None
+            stack.pop()
+            name = ''
+        elif c == ',':
+            if name.strip():
+                stack[-1][name.strip()] = None
+            name = ''
+        else:
+            name = name + c
+    return spec
+
+def filter_fields(value, spec):
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [ filter_fields(v, spec) for v in value ]
+    if isinstance(value, dict):
+        return { k : filter_fields(v, spec[k])
+                 for k, v in value.items() if k in spec }
+    return value
+
+#-------------------------------------------------------------------
+
+class Drive:
+    def __init__(self, tree):
+        self.lock        = threading.Lock()
+        self.files       = dict()   # ID -> file hash
+        self.seq         = dict()   # ID -> creation sequence number
+        self.children    = dict()   # parent ID -> set of child IDs
+        self.team_drives = dict()   # ID -> team drive hash
+        self.requests    = dict()   # requestId -> team drive ID
+        self.changes     = list()   # file IDs, in the order they changed
+        self.next_id     = 0
+
+        for td in tree.get('team_drives', []):
+            self.team_drives[td['id']] = { 'kind' : 'drive#teamDrive',
+                                           'id'   : td['id'],
+                                           'name' : td['name'] }
+        for file in tree['files']:
+            self._add(dict(file))
+        self.changes = list()
+
+    def new_id(self, prefix):
+        self.next_id = self.next_id + 1
+        return '{0}{1:06d}'.format(prefix, self.next_id)
+
+    def _add(self, file):
+        file.setdefault('kind', 'drive#file')
+        file.setdefault('owners', list())
+        file.setdefault('parents', list())
+        file['trashed'] = file.get('trashed', False)
+        file['webViewLink'] = 'https://drive.example/{0}'.format(file['id'])
+        self.files[file['id']] = file
+        self.seq[file['id']] = len(self.seq)
+        for parent in file['parents']:
+            self.children.setdefault(parent, set()).add(file['id'])
+        self.changes.append(file['id'])
+
+    def _set_parents(self, file, parents):
+        for parent in file['parents']:
+            self.children.get(parent, set()).discard(file['id'])
+        file['parents'] = parents
+        for parent in parents:
+            self.children.setdefault(parent, set()).add(file['id'])
+        self.changes.append(file['id'])
+
+    def _file(self, id):
+        if id not in self.files:
+            raise DriveError(404, 'notFound',
+                             'File not found: {0}.'.format(id))
+        return self.files[id]
+
+    # The Team Drive that an ID (file or Team Drive) is in, if any
+    def _team_drive_of(self, id):
+        if id in self.team_drives:
+            return id
+        if id in self.files:
+            return self.files[id].get('teamDriveId', None)
+        return None
+
+    #---------------------------------------------------------------
+
+    # Returns a function that says whether a file matches the query
+    def _parse_query(self, q):
+        tests = list()
+        for term in re.split(r'\s+and\s+', q.strip(), flags=re.I):
+            m = re.match(r"^'(.*)'\s+in\s+parents$", term)
+            if m:
+                tests.append(lambda f, id=m.group(1): id in f['parents'])
+                continue
+            m = re.match(r"^trashed\s*=\s*(true|false)$", term)
+            if m:
+                tests.append(lambda f, t=(m.group(1) == 'true'): f['trashed'] == t)
+                continue
+            m = re.match(r"^mimeType\s*(!=|=)\s*'(.*)'$", term)
+            if m:
+                tests.append(lambda f, op=m.group(1), v=m.group(2):
+                             (f['mimeType'] == v) == (op == '='))
+                continue
+            m = re.match(r"^name\s*(=|contains)\s*'(.*)'$", term)
+            if m:
+                v = m.group(2).replace("\\'", "'")
+                if m.group(1) == '=':
+                    tests.append(lambda f, v=v: f['name'] == v)
+                else:
+                    tests.append(lambda f, v=v: v.lower() in f['name'].lower())
+                continue
+            raise DriveError(400, 'invalid',
+                             'Invalid Value: unsupported query term: {0}'.format(term))
+
+        return lambda f: all(t(f) for t in tests)
+
+    def files_list(self, user, params):
+        q = params.get('q', '')
+        match = self._parse_query(q) if q else (lambda f: True)
+
+        # Narrow things down with the children index if we can
+        m = re.match(r"^'([^']*)'\s+in\s+parents", q.strip())
+        if m:
+            candidates = self.children.get(m.group(1), set())
+        else:
+            candidates = self.files.keys()
+
+        team_drive_id = None
+        if params.get('corpora', 'user') in ('teamDrive', 'drive'):
+            team_drive_id = params.get('teamDriveId', params.get('driveId'))
+        with_team_items = bool_param(params, 'includeTeamDriveItems')
+
+        files = list()
+        for id in candidates:
+            f = self.files[id]
+            if team_drive_id and f.get('teamDriveId') != team_drive_id:
+                continue
+            if (not team_drive_id and not with_team_items and not m and
+                f.get('teamDriveId')):
+                continue
+            if match(f):
+                files.append(f)
+
+        # Page tokens are the sequence number of the last file
+        # returned, so that pages stay consistent even if files are
+        # moved around between pages
+        files.sort(key=lambda f: self.seq[f['id']])
+        after = int(params.get('pageToken', -1))
+        if after >= 0:
+            files = [ f for f in files if self.seq[f['id']] > after ]
+        size = min(int(params.get('pageSize', 100)), 1000)
+
+        response = { 'kind'  : 'drive#fileList',
+                     'files' : files[:size] }
+        if len(files) > size:
+            response['nextPageToken'] = str(self.seq[files[size - 1]['id']])
+        return response
+
+    def files_get(self, user, params, id):
+        if id in self.team_drives:
+            return { 'kind'        : 'drive#file',
+                     'id'          : id,
+                     'name'        : self.team_drives[id]['name'],
+                     'mimeType'    : folder_mime_type,
+                     'teamDriveId' : id,
+                     'parents'     : list(),
+                     'owners'      : list(),
+                     'webViewLink' : 'https://drive.example/{0}'.format(id) }
+        return self._file(id)
+
+    def files_create(self, user, params, body):
+        parents = body.get('parents', [ 'root' ])
+        file = { 'id'       : self.new_id('new'),
+                 'name'     : body.get('name', 'Untitled'),
+                 'mimeType' : body.get('mimeType', 'application/octet-stream'),
+                 'parents'  : parents,
+                 'owners'   : [ { 'displayName'  : user,
+                                  'emailAddress' : user } ] }
+        team_drive_id = self._team_drive_of(parents[0])
+        if team_drive_id:
+            file['teamDriveId'] = team_drive_id
+            file['owners'] = list()
+        self._add(file)
+        return file
+
+    def files_update(self, user, params, id, body):
+        file = self._file(id)
+        add    = [ p for p in params.get('addParents', '').split(',') if p ]
+        remove = [ p for p in params.get('removeParents', '').split(',') if p ]
+
+        # Moving into a Team Drive?
+        team_drive_id = None
+        for parent in add:
+            team_drive_id = team_drive_id or self._team_drive_of(parent)
+        if team_drive_id and not file.get('teamDriveId'):
+            parents = [ p for p in file['parents'] if p not in remove ]
+            if parents:
+                raise DriveError(403, 'teamDrivesParentLimit',
+                                 'A shared drive item must have exactly one parent.')
+            owner_emails = [ o['emailAddress'] for o in file['owners'] ]
+            domain = user.split('@')[-1]
+            if not any(o == user or o.split('@')[-1] == domain
+                       for o in owner_emails):
+                raise DriveError(403, 'insufficientFilePermissions',
+                                 'The user does not have sufficient permissions for this file.')
+            file['teamDriveId'] = team_drive_id
+            file['owners'] = list()
+
+        if 'name' in body:
+            file['name'] = body['name']
+        parents = [ p for p in file['parents'] if p not in remove ] + add
+        self._set_parents(file, parents)
+        return file
+
+    def files_copy(self, user, params, id, body):
+        source = self._file(id)
+        file = dict(source)
+        file['id']      = self.new_id('copy')
+        file['name']    = body.get('name', source['name'])
+        file['parents'] = body.get('parents', source['parents'])
+        file['owners']  = [ { 'displayName'  : user,
+                              'emailAddress' : user } ]
+        file.pop('teamDriveId', None)
+        team_drive_id = self._team_drive_of(file['parents'][0])
+        if team_drive_id:
+            file['teamDriveId'] = team_drive_id
+            file['owners'] = list()
+        self._add(file)
+        return file
+
+    #---------------------------------------------------------------
+
+    def teamdrives_list(self, user, params):
+        drives = list(self.team_drives.values())
+        if params.get('q'):
+            match  = self._parse_query(params['q'])
+            drives = [ td for td in drives if match(td) ]
+        start  = int(params.get('pageToken', 0))
+        size   = min(int(params.get('pageSize', 10)), 100)
+        response = { 'kind'       : 'drive#teamDriveList',
+                     'teamDrives' : drives[start:start + size] }
+        if start + size < len(drives):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+    def teamdrives_get(self, user, params, id):
+        if id not in self.team_drives:
+            raise DriveError(404, 'notFound',
+                             'Team Drive not found: {0}.'.format(id))
+        return self.team_drives[id]
+
+    def teamdrives_create(self, user, params, body):
+        request_id = params.get('requestId')
+        if request_id in self.requests:
+            return self.team_drives[self.requests[request_id]]
+
+        id = self.new_id('td')
+        self.team_drives[id] = { 'kind' : 'drive#teamDrive',
+                                 'id'   : id,
+                                 'name' : body.get('name', 'Untitled') }
+        self.requests[request_id] = id
+        return self.team_drives[id]
+
+    #---------------------------------------------------------------
+
+    def changes_start(self, user, params):
+        return { 'startPageToken' : str(len(self.changes)) }
+
+    def changes_list(self, user, params):
+        start = int(params['pageToken'])
+        size  = min(int(params.get('pageSize', 100)), 1000)
+        team_drive_id   = params.get('teamDriveId', None)
+        with_team_items = bool_param(params, 'includeTeamDriveItems')
+
+        ids = self.changes[start:start + size]
+        changes = list()
+        for id in ids:
+            file = self.files.get(id, None)
+            change = { 'kind' : 'drive#change', 'fileId' : id,
+                       'removed' : file is None }
+            if file is not None:
+                in_team_drive = file.get('teamDriveId', None)
+                if team_drive_id and in_team_drive != team_drive_id:
+                    continue
+                # Things that moved into a Team Drive are gone as far
+                # as a My Drive listing is concerned
+                if not team_drive_id and in_team_drive and not with_team_items:
+                    change['removed'] = True
+                else:
+                    change['file'] = file
+            changes.append(change)
+
+        response = { 'kind' : 'drive#changeList', 'changes' : changes }
+        if start + size >= len(self.changes):
+            response['newStartPageToken'] = str(len(self.changes))
+        else:
+            response['nextPageToken'] = str(start + size)
+        return response
+
+#-------------------------------------------------------------------
+
+# (HTTP method, path regexp, API method name, Drive method, takes a body)
+routes = [
+    ('GET',   r'^files$',                   'files.list',   'files_list',        False),
+    ('POST',  r'^files$',                   'files.create', 'files_create',      True),
+    ('GET',   r'^files/([^/]+)$',           'files.get',    'files_get',         False),
+    ('PATCH', r'^files/([^/]+)$',           'files.update', 'files_update',      True),
+    ('POST',  r'^files/([^/]+)/copy$',      'files.copy',   'files_copy',        True),
+    ('GET',   r'^teamdrives$',              'teamdrives.list',   'teamdrives_list',   False),
+    ('GET',   r'^teamdrives/([^/]+)$',      'teamdrives.get',    'teamdrives_get',    False),
+    ('POST',  r'^teamdrives$',              'teamdrives.create', 'teamdrives_create', True),
+    ('GET',   r'^changes/startPageToken$',  'changes.getStartPageToken', 'changes_start', False),
+    ('GET',   r'^changes$',                 'changes.list', 'changes_list',      False),
+]
+
+service_path = 'drive/v3/'
+batch_path   = 'batch/drive/v3'
+
+class Server:
+    def __init__(self, drive):
+        self.drive = drive
+        self.lock  = threading.Lock()
+        self.stats = dict()
+        self.quota = dict()     # user -> list of call times
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = { 'requests'         : 0,
+                           'http_requests'    : 0,
+                           'by_method'        : dict(),
+                           'by_user'          : dict(),
+                           'injected_errors'  : 0,
+                           'quota_rejections' : 0,
+                           'started'          : time.time() }
+
+    def count(self, key, name):
+        self.stats[key][name] = self.stats[key].get(name, 0) + 1
+
+    # Everything that can go wrong before the call itself
+    def check(self, user):
+        if user is None:
+            raise DriveError(401, 'authError', 'Invalid Credentials')
+
+        if args.quota:
+            now   = time.monotonic()
+            calls = self.quota.setdefault(user, list())
+            while calls and calls[0] < now - args.quota_window:
+                calls.pop(0)
+            if len(calls) >= args.quota:
+                self.stats['quota_rejections'] += 1
+                raise DriveError(403, 'userRateLimitExceeded',
+                                 'User Rate Limit Exceeded')
+            calls.append(now)
+
+        if args.error_rate and random.random() < args.error_rate:
+            self.stats['injected_errors'] += 1
+            code = random.choice(args.error_codes)
+            if code == 403:
+                raise DriveError(403, 'userRateLimitExceeded',
+                                 'User Rate Limit Exceeded')
+            if code == 429:
+                raise DriveError(429, 'rateLimitExceeded',
+                                 'Rate Limit Exceeded')
+            raise DriveError(code, 'backendError', 'Backend Error')
+
+    # One API call.  Returns (HTTP status, response hash).
+    def call(self, method, path, query, body, user):
+        params = dict(parse_qsl(query))
+        if not path.startswith('/' + service_path):
+            return (404, DriveError(404, 'notFound', 'Not Found').body())
+        path = path[len(service_path) + 1:]
+
+        for (http_method, regexp, name, func, has_body) in routes:
+            m = re.match(regexp, path)
+            if http_method != method or not m:
+                continue
+
+            try:
+                with self.lock:
+                    self.stats['requests'] += 1
+                    self.count('by_method', name)
+                    self.count('by_user', str(user))
+                    self.check(user)
+
+                with self.drive.lock:
+                    call_args = [ user, params ] + list(m.groups())
+                    if has_body:
+                        call_args.append(json.loads(body.decode('utf-8') or '{}'))
+                    result = getattr(self.drive, func)(*call_args)
+                    if 'fields' in params:
+                        result = filter_fields(result,
+                                               parse_fields(params['fields']))
+                    # Serialize while we still hold the lock
+                    return (200, json.loads(json.dumps(result)))
+            except DriveError as e:
+                return (e.code, e.body())
+
+        return (404, DriveError(404, 'notFound', 'Not Found').body())
+
+    def discovery(self, root_url):
+        return discovery_document(root_url)
+
+#-------------------------------------------------------------------
+
+# Just enough of the Drive v3 discovery document for googleapiclient
+# to build a service with the methods that the scripts use
+def discovery_document(root_url):
+    def param(type='string', location='query', required=False):
+        p = { 'type' : type, 'location' : location }
+        if required:
+            p['required'] = True
+        return p
+
+    def params(*dicts, **kwargs):
+        p = { 'supportsTeamDrives' : param('boolean'),
+              'supportsAllDrives'  : param('boolean') }
+        for d in dicts:
+            p.update(d)
+        p.update(kwargs)
+        return p
+    file_id = { 'fileId' : param(location='path', required=True) }
+
+    def method(id, path, http_method, parameters, request=None,
+               response='File'):
+        m = { 'id'         : 'drive.' + id,
+              'path'       : path,
+              'httpMethod' : http_method,
+              'parameters' : parameters,
+              'response'   : { '$ref' : response },
+              'scopes'     : [ 'https://www.googleapis.com/auth/drive' ] }
+        order = [ k for k, v in parameters.items() if v.get('required') ]
+        if order:
+            m['parameterOrder'] = order
+        if request:
+            m['request'] = { '$ref' : request }
+        return m
+
+    list_params = params(q=param(), pageSize=param('integer'),
+                         pageToken=param(), spaces=param(),
+                         corpora=param(), corpus=param(), orderBy=param(),
+                         teamDriveId=param(), driveId=param(),
+                         includeTeamDriveItems=param('boolean'),
+                         includeItemsFromAllDrives=param('boolean'))
+    changes_params = params(pageToken=param(required=True),
+                            pageSize=param('integer'), spaces=param(),
+                            includeRemoved=param('boolean'),
+                            teamDriveId=param(), driveId=param(),
+                            includeTeamDriveItems=param('boolean'),
+                            includeItemsFromAllDrives=param('boolean'))
+    update_params = params(file_id,
+                           addParents=param(), removeParents=param())
+
+    schemas = dict()
+    for name in [ 'File', 'FileList', 'TeamDrive', 'TeamDriveList',
+                  'ChangeList', 'StartPageToken' ]:
+        schemas[name] = { 'id' : name, 'type' : 'object',
+                          'properties' : dict() }
+
+    return {
+        'kind'             : 'discovery#restDescription',
+        'discoveryVersion' : 'v1',
+        'id'               : 'drive:v3',
+        'name'             : 'drive',
+        'version'          : 'v3',
+        'title'            : 'Fake Drive API',
+        'protocol'         : 'rest',
+        'rootUrl'          : root_url,
+        'servicePath'      : service_path,
+        'baseUrl'          : root_url + service_path,
+        'batchPath'        : batch_path,
+        'parameters'       : {
+            'fields'      : param(),
+            'alt'         : param(),
+            'key'         : param(),
+            'oauth_token' : param(),
+            'prettyPrint' : param('boolean'),
+            'quotaUser'   : param(),
+            'userIp'      : param(),
+        },
+        'schemas'          : schemas,
+        'resources'        : {
+            'files' : { 'methods' : {
+                'list'   : method('files.list', 'files', 'GET',
+                                  list_params, response='FileList'),
+                'get'    : method('files.get', 'files/{fileId}', 'GET',
+                                  params(file_id)),
+                'create' : method('files.create', 'files', 'POST',
+                                  params(), request='File'),
+                'update' : method('files.update', 'files/{fileId}',
+                                  'PATCH', update_params, request='File'),
+                'copy'   : method('files.copy', 'files/{fileId}/copy',
+                                  'POST', params(file_id),
+                                  request='File'),
+            } },
+            'teamdrives' : { 'methods' : {
+                'list'   : method('teamdrives.list', 'teamdrives', 'GET',
+                                  { 'pageSize'  : param('integer'),
+                                    'pageToken' : param(),
+                                    'q'         : param(),
+                                    'useDomainAdminAccess' : param('boolean') },
+                                  response='TeamDriveList'),
+                'get'    : method('teamdrives.get', 'teamdrives/{teamDriveId}',
+                                  'GET',
+                                  { 'teamDriveId' : param(location='path',
+                                                          required=True),
+                                    'useDomainAdminAccess' : param('boolean') },
+                                  response='TeamDrive'),
+                'create' : method('teamdrives.create', 'teamdrives', 'POST',
+                                  { 'requestId' : param(required=True) },
+                                  request='TeamDrive',
+                                  response='TeamDrive'),
+            } },
+            'changes' : { 'methods' : {
+                'getStartPageToken' : method('changes.getStartPageToken',
+                                             'changes/startPageToken', 'GET',
+                                             params(teamDriveId=param(),
+                                                    driveId=param()),
+                                             response='StartPageToken'),
+                'list'   : method('changes.list', 'changes', 'GET',
+                                  changes_params, response='ChangeList'),
+            } },
+        },
+    }
+
+#-------------------------------------------------------------------
+
+def user_from_headers(headers):
+    auth = headers.get('Authorization', '') or ''
+    m = re.match(r'^Bearer\s+fake:(\S+)$', auth)
+    if m:
+        return m.group(1)
+    return None
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *log_args):
+        if args.verbose:
+            sys.stderr.write("fake-drive: " + (format % log_args) + "\n")
+
+    def send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b''
+
+    def root_url(self):
+        return 'http://{0}/'.format(self.headers.get('Host'))
+
+    def latency(self):
+        delay = args.latency + random.uniform(0, args.latency_jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def handle_any(self, method):
+        try:
+            self.dispatch(method)
+        except Exception as e:
+            traceback.print_exc()
+            self.send(500, DriveError(500, 'backendError', str(e)).body())
+
+    def dispatch(self, method):
+        server = self.server.fake
+        body   = self.read_body()
+        url    = urlsplit(self.path)
+        with server.lock:
+            server.stats['http_requests'] += 1
+
+        # Housekeeping for bench/run-bench.py
+        if url.path == '/_bench/stats':
+            with server.lock:
+                stats = json.loads(json.dumps(server.stats))
+            stats['elapsed'] = time.time() - stats['started']
+            return self.send(200, stats)
+        if url.path == '/_bench/reset':
+            server.reset_stats()
+            return self.send(200, {})
+
+        if url.path == '/discovery/v1/apis/drive/v3/rest':
+            return self.send(200, server.discovery(self.root_url()))
+
+        self.latency()
+        user = user_from_headers(self.headers)
+        if url.path == '/' + batch_path and method == 'POST':
+            return self.batch(server, body, user)
+
+        (status, response) = server.call(method, url.path, url.query,
+                                         body, user)
+        self.send(status, response)
+
+    # A multipart/mixed batch of API calls.  Each part is a complete
+    # HTTP request; the response is a multipart/mixed of complete HTTP
+    # responses, with matching Content-IDs.
+    def batch(self, server, body, user):
+        content_type = self.headers.get('Content-Type')
+        message = email.message_from_bytes(
+            'Content-Type: {0}\r\n\r\n'.format(content_type).encode('utf-8') + body)
+
+        boundary = '=====fake-drive-batch-{0}====='.format(random.randint(0, 1 << 30))
+        out = list()
+        for part in message.get_payload():
+            content_id = part.get('Content-ID', '')
+            content_id = content_id.strip('<>')
+            raw = part.get_payload(decode=True) or part.get_payload().encode('utf-8')
+            (head, _, part_body) = raw.replace(b'\r\n', b'\n').partition(b'\n\n')
+            lines = head.decode('utf-8').split('\n')
+            (method, path, _) = lines[0].split(' ', 2)
+            headers = dict()
+            for line in lines[1:]:
+                if ':' in line:
+                    (k, v) = line.split(':', 1)
+                    headers[k.strip()] = v.strip()
+            part_user = user_from_headers(headers) or user
+
+            url = urlsplit(path)
+            (status, response) = server.call(method, url.path, url.query,
+                                             part_body.strip(), part_user)
+            response = json.dumps(response)
+            out.append('--{boundary}\r\n'
+                       'Content-Type: application/http\r\n'
+                       'Content-ID: <response-{id}>\r\n'
+                       '\r\n'
+                       'HTTP/1.1 {status} {reason}\r\n'
+                       'Content-Type: application/json; charset=UTF-8\r\n'
+                       'Content-Length: {length}\r\n'
+                       '\r\n'
+                       '{body}\r\n'
+                       .format(boundary=boundary, id=content_id,
+                               status=status,
+                               reason=self.responses.get(status, ('',))[0],
+                               length=len(response.encode('utf-8')),
+                               body=response))
+        out.append('--{0}--\r\n'.format(boundary))
+        self.send(200, ''.join(out).encode('utf-8'),
+                  content_type='multipart/mixed; boundary={0}'.format(boundary))
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PATCH(self):
+        self.handle_any('PATCH')
+
+class ThreadingServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+#-------------------------------------------------------------------
+
+def add_cli_args():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Google Drive v3 API')
+    parser.add_argument('--tree',
+                        required=True,
+                        help='JSON file of the initial drive contents (from bench/make-tree.py)')
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port',
+                        type=int,
+                        default=0,
+                        help='Port to listen on (default: 0, meaning pick a free one)')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Milliseconds to wait before answering each HTTP request (default: 0)')
+    parser.add_argument('--latency-jitter',
+                        type=float,
+                        default=0,
+                        help='Up to this many more random milliseconds to wait (default: 0)')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help='Fraction of API calls to fail at random (default: 0)')
+    parser.add_argument('--error-codes',
+                        default='403,429,500',
+                        help='Comma-separated HTTP statuses to pick from for random failures (default: 403,429,500)')
+    parser.add_argument('--quota',
+                        type=int,
+                        default=0,
+                        help='Maximum API calls per user per --quota-window; more are failed with userRateLimitExceeded (default: 0, meaning no limit)')
+    parser.add_argument('--quota-window',
+                        type=float,
+                        default=100,
+                        help='Seconds in a quota window (default: 100, like Drive)')
+    parser.add_argument('--seed',
+                        type=int,
+                        help='Random seed for latency jitter and error injection')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='Log every HTTP request to stderr')
+
+    global args
+    args = parser.parse_args()
+    args.error_codes = [ int(c) for c in args.error_codes.split(',') if c ]
+
+def main():
+    add_cli_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    with open(args.tree) as f:
+        tree = json.load(f)
+
+    httpd = ThreadingServer((args.host, args.port), Handler)
+    httpd.fake = Server(Drive(tree))
+
+    # bench/run-bench.py reads this line to find out where we are
+    print('Listening on http://{0}:{1}/'.format(*httpd.server_address))
+    sys.stdout.flush()
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Make a synthetic Google Drive folder tree for bench/fake-drive.py.
+#
+# The tree is a root folder with --fanout subfolders per folder,
+# --depth levels deep, and (on average) --files-per-folder files in
+# each folder.  Some fraction of the files and folders get a second
+# parent (which is what makes gxcopy.py copy instead of move), and
+# the files are owned by a weighted mix of --owners.
+#
+# With --team-drive, the tree is put in a Team Drive instead (e.g.,
+# for find-multifiles.py).  Team Drive items can't have multiple
+# parents, so the multi-parent rate is used to sprinkle "MULTIFILE"
+# copies around instead.
+#
+# The output is JSON:
+#
+#    {
+#      "version": 1,
+#      "root": <root folder ID>,
+#      "domain": <owning domain>,
+#      "admin": <admin email address>,
+#      "owners": [ <email>, ... ],
+#      "team_drives": [ {"id": ..., "name": ...}, ... ],
+#      "files": [ {"id": ..., "name": ..., "mimeType": ..., "parents": [...],
+#                  "owners": [...], "md5Checksum": ..., "size": ...}, ... ]
+#    }
+#
+
+import sys
+import json
+import random
+import hashlib
+import argparse
+
+folder_mime_type = 'application/vnd.google-apps.folder'
+doc_mime_type    = 'application/vnd.google-apps.document'
+sheet_mime_type  = 'application/vnd.google-apps.spreadsheet'
+file_mime_types  = [ doc_mime_type, sheet_mime_type,
+                     'application/pdf', 'image/jpeg', 'text/plain' ]
+
+args = None
+
+#-------------------------------------------------------------------
+
+# "EMAIL[:WEIGHT],..." -> ([emails], [weights])
+def parse_owners(owners):
+    emails  = list()
+    weights = list()
+    for item in owners.split(','):
+        (email, _, weight) = item.partition(':')
+        emails.append(email.strip())
+        weights.append(float(weight or 1))
+    return (emails, weights)
+
+def make_tree():
+    (emails, weights) = parse_owners(args.owners)
+    files   = list()
+    folders = list()
+    serial  = [ 0 ]
+
+    def new_id(prefix):
+        serial[0] = serial[0] + 1
+        return '{0}{1:07d}'.format(prefix, serial[0])
+
+    def owners():
+        email = random.choices(emails, weights)[0]
+        return [ { 'displayName'  : email.split('@')[0].title(),
+                   'emailAddress' : email } ]
+
+    team_drives = list()
+    if args.team_drive:
+        team_drive_id = new_id('td')
+        team_drives.append({ 'id' : team_drive_id, 'name' : args.team_drive })
+        root = team_drive_id
+    else:
+        team_drive_id = None
+        root = new_id('folder')
+        files.append({ 'id'       : root,
+                       'name'     : args.root_name,
+                       'mimeType' : folder_mime_type,
+                       'parents'  : [ 'root' ],
+                       'owners'   : [ { 'displayName'  : 'Admin',
+                                        'emailAddress' : args.admin } ] })
+
+    def add(item):
+        if team_drive_id:
+            item['teamDriveId'] = team_drive_id
+            item['owners'] = list()
+        files.append(item)
+
+    # Build it breadth first, so that a folder's second parent (picked
+    # from the folders made before it) can never be one of its own
+    # descendants
+    level = [ root ]
+    for depth in range(1, args.depth + 1):
+        next_level = list()
+        for parent in level:
+            for i in range(args.fanout):
+                id = new_id('folder')
+                parents = [ parent ]
+                if (not team_drive_id and folders and
+                    random.random() < args.multi_parent_rate):
+                    other = random.choice(folders)
+                    if other != parent:
+                        parents.append(other)
+                add({ 'id'       : id,
+                      'name'     : 'Folder {0}-{1}'.format(depth, len(next_level)),
+                      'mimeType' : folder_mime_type,
+                      'parents'  : parents,
+                      'owners'   : owners() })
+                next_level.append(id)
+        folders.extend(next_level)
+        level = next_level
+
+    all_folders = [ root ] + folders
+    plain_files = list()
+    for parent in all_folders:
+        count = random.randint(0, 2 * args.files_per_folder)
+        for i in range(count):
+            id   = new_id('file')
+            name = 'File {0}'.format(id[-7:])
+            parents = [ parent ]
+            if random.random() < args.multi_parent_rate:
+                if team_drive_id:
+                    name = 'MULTIFILE ' + name
+                else:
+                    other = random.choice(all_folders)
+                    if other != parent:
+                        parents.append(other)
+
+            file = { 'id'          : id,
+                     'name'        : name,
+                     'mimeType'    : random.choice(file_mime_types),
+                     'parents'     : parents,
+                     'owners'      : owners(),
+                     'md5Checksum' : hashlib.md5(id.encode('utf-8')).hexdigest(),
+                     'size'        : str(random.randint(1, 1 << 20)) }
+
+            # Some files are exact duplicates of some other file
+            if plain_files and random.random() < args.duplicate_rate:
+                other = random.choice(plain_files)
+                file['mimeType']    = other['mimeType']
+                file['md5Checksum'] = other['md5Checksum']
+                file['size']        = other['size']
+            plain_files.append(file)
+            add(file)
+
+    return {
+        'version'     : 1,
+        'root'        : root,
+        'domain'      : args.domain,
+        'admin'       : args.admin,
+        'owners'      : emails,
+        'team_drives' : team_drives,
+        'files'       : files,
+    }
+
+#-------------------------------------------------------------------
+
+def add_cli_args():
+    parser = argparse.ArgumentParser(description='Make a synthetic Google Drive tree for bench/fake-drive.py')
+    parser.add_argument('--depth',
+                        type=int,
+                        default=4,
+                        help='Number of levels of folders below the root (default: 4)')
+    parser.add_argument('--fanout',
+                        type=int,
+                        default=4,
+                        help='Number of subfolders in each folder (default: 4)')
+    parser.add_argument('--files-per-folder',
+                        type=int,
+                        default=10,
+                        help='Average number of files in each folder (default: 10)')
+    parser.add_argument('--multi-parent-rate',
+                        type=float,
+                        default=0.02,
+                        help='Fraction of files and folders that have a second parent (default: 0.02)')
+    parser.add_argument('--duplicate-rate',
+                        type=float,
+                        default=0,
+                        help='Fraction of files that have the same contents as some other file (default: 0)')
+    parser.add_argument('--domain',
+                        default='example.org',
+                        help='Domain that will own the Team Drive (default: example.org)')
+    parser.add_argument('--owners',
+                        help='Comma-separated EMAIL[:WEIGHT] list of file owners (default: a mix of users in and out of --domain)')
+    parser.add_argument('--team-drive',
+                        metavar='NAME',
+                        help='Put the tree in a Team Drive of this name instead of a folder')
+    parser.add_argument('--root-name',
+                        default='Bench Root',
+                        help='Name of the root folder (default: "Bench Root")')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help='Random seed (default: 1)')
+    parser.add_argument('--output', '-o',
+                        help='File to write the tree to (default: stdout)')
+
+    global args
+    args = parser.parse_args()
+
+    args.admin = 'admin@' + args.domain
+    if not args.owners:
+        args.owners = ('alice@{0}:5,bob@{0}:3,carol@gmail.com:1,dave@example.com:1'
+                       .format(args.domain))
+
+def main():
+    add_cli_args()
+    random.seed(args.seed)
+
+    tree = make_tree()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(tree, f)
+    else:
+        json.dump(tree, sys.stdout)
+
+    sys.stderr.write("{0} items ({1} folders)\n"
+                     .format(len(tree['files']),
+                             sum(1 for f in tree['files']
+                                 if f['mimeType'] == folder_mime_type)))
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
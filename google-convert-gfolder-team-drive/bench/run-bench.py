@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+#
+# Benchmark the scripts in this directory against bench/fake-drive.py.
+#
+# For each scenario, start a fresh fake Drive server loaded with the
+# --tree (made by bench/make-tree.py), run the script against it, and
+# report:
+#
+# - wall clock time
+# - number of API calls the server saw, and calls per second
+# - peak RSS of the script
+#
+# Scenarios:
+#
+# - crawl:        scan-and-report.py, folder-by-folder crawl
+# - crawl-corpus: scan-and-report.py, --crawl-mode corpus
+# - crawl-snapshot: scan-and-report.py --from-snapshot, after a
+#                 scan-and-report.py --save-snapshot crawl (which isn't
+#                 timed or counted)
+# - plan:         gxcopy.py --plan
+# - migrate:      gxcopy.py (a real migration, into the fake drive)
+# - multifiles:   find-multifiles.py (needs a tree made with --team-drive)
+# - multifiles-query: find-multifiles.py --crawl-mode query
+# - verify:       verify-migration.py, after a gxcopy.py migration
+#                 (which isn't timed or counted)
+#
+# Anything given with --tool-args is added to every script's command
+# line (e.g., --tool-args "--crawl-workers 8 --api-rate-limit 0").
+#
+# Fake credentials files are written to a scratch directory, so no
+# real Google credentials are needed (or used).
+#
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+args = None
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_drive = os.path.join(top_dir, 'bench', 'fake-drive.py')
+
+scenarios = [ 'crawl', 'crawl-corpus', 'crawl-snapshot', 'plan', 'migrate',
+              'multifiles', 'multifiles-query', 'verify' ]
+
+#-------------------------------------------------------------------
+
+# Credentials files that oauth2client will happily load, with an
+# access token that tells the fake server who we are
+def write_credentials(filename, email):
+    cred = {
+        '_module'        : 'oauth2client.client',
+        '_class'         : 'OAuth2Credentials',
+        'access_token'   : 'fake:' + email,
+        'client_id'      : 'fake-client-id',
+        'client_secret'  : 'fake-client-secret',
+        'refresh_token'  : 'fake-refresh-token',
+        'token_expiry'   : '2099-01-01T00:00:00Z',
+        'token_uri'      : 'https://oauth2.googleapis.com/token',
+        'user_agent'     : None,
+        'revoke_uri'     : 'https://oauth2.googleapis.com/revoke',
+        'id_token'       : None,
+        'id_token_jwt'   : None,
+        'token_response' : None,
+        'scopes'         : [ 'https://www.googleapis.com/auth/drive' ],
+        'token_info_uri' : 'https://oauth2.googleapis.com/tokeninfo',
+        'invalid'        : False,
+    }
+    with open(filename, 'w') as f:
+        json.dump(cred, f)
+
+def write_app_credentials(filename):
+    with open(filename, 'w') as f:
+        json.dump({ 'installed' : { 'client_id'     : 'fake-client-id',
+                                    'client_secret' : 'fake-client-secret' } },
+                  f)
+
+#-------------------------------------------------------------------
+
+def start_server():
+    cmd = [ sys.executable, fake_drive, '--tree', args.tree,
+            '--latency', str(args.latency),
+            '--latency-jitter', str(args.latency_jitter),
+            '--error-rate', str(args.error_rate),
+            '--error-codes', args.error_codes,
+            '--quota', str(args.quota),
+            '--quota-window', str(args.quota_window) ]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              universal_newlines=True)
+    line = server.stdout.readline()
+    if not line.startswith('Listening on '):
+        server.kill()
+        print("ERROR: fake Drive server did not start")
+        exit(1)
+    return (server, line.split()[-1])
+
+def server_stats(url):
+    with urllib.request.urlopen(url + '_bench/stats') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+#-------------------------------------------------------------------
+
+# Returns (list of commands to run first, without timing or counting
+# them; the command to benchmark), or None if the scenario doesn't
+# apply to this tree
+def scenario_command(scenario, tree, work_dir):
+    cred_args = [ '--app-id', os.path.join(work_dir, 'client_id.json'),
+                  '--admin-credentials', os.path.join(work_dir, 'admin.json') ]
+    user_args = list()
+    for email in args.user_credentials or []:
+        user_args.extend([ '--user-credentials', email,
+                           os.path.join(work_dir, email + '.json') ])
+
+    def full(cmd):
+        cmd[0] = os.path.join(top_dir, cmd[0])
+        return ([ sys.executable ] + cmd + cred_args +
+                shlex.split(args.tool_args or ''))
+
+    setup = list()
+    if scenario in ('crawl', 'crawl-corpus'):
+        cmd = [ 'scan-and-report.py',
+                '--source-folder-id', tree['root'],
+                '--csv', os.path.join(work_dir, 'report.csv') ]
+        if scenario == 'crawl-corpus':
+            cmd.extend([ '--crawl-mode', 'corpus' ])
+    elif scenario == 'crawl-snapshot':
+        snapshot = os.path.join(work_dir, 'snapshot.db')
+        setup.append(full([ 'scan-and-report.py',
+                            '--source-folder-id', tree['root'],
+                            '--save-snapshot', snapshot ]))
+        cmd = [ 'scan-and-report.py',
+                '--from-snapshot', snapshot,
+                '--csv', os.path.join(work_dir, 'report.csv') ]
+    elif scenario in ('plan', 'migrate'):
+        cmd = [ 'gxcopy.py',
+                '--source-folder-id', tree['root'],
+                '--owning-domain', tree['domain'] ] + user_args
+        if scenario == 'plan':
+            cmd.extend([ '--plan', os.path.join(work_dir, 'plan.json') ])
+    elif scenario in ('multifiles', 'multifiles-query'):
+        if not tree['team_drives']:
+            return None
+        cmd = [ 'find-multifiles.py',
+                '--source-team-drive', tree['team_drives'][0]['name'],
+                '--csv', os.path.join(work_dir, 'multifiles.csv') ]
+        if scenario == 'multifiles-query':
+            cmd.extend([ '--crawl-mode', 'query' ])
+    elif scenario == 'verify':
+        if tree['team_drives']:
+            return None
+        # gxcopy.py names the Team Drive after the source folder
+        journal = os.path.join(work_dir, 'verify-journal.jsonl')
+        if os.path.exists(journal):
+            os.remove(journal)
+        setup.append(full([ 'gxcopy.py',
+                            '--source-folder-id', tree['root'],
+                            '--owning-domain', tree['domain'],
+                            '--journal', journal ] + user_args))
+        cmd = [ 'verify-migration.py',
+                '--source-folder-id', tree['root'],
+                '--dest-team-drive', [ f['name'] for f in tree['files']
+                                       if f['id'] == tree['root'] ][0],
+                '--journal', journal,
+                '--csv', os.path.join(work_dir, 'verify.csv') ]
+
+    return (setup, full(cmd))
+
+# Run one scenario against a fresh server.  Returns a hash of results.
+def run_scenario(scenario, tree, work_dir, run):
+    cmds = scenario_command(scenario, tree, work_dir)
+    if cmds is None:
+        print("Skipping {0}: not for this kind of tree (see bench/make-tree.py --team-drive)"
+              .format(scenario))
+        return None
+    (setup, cmd) = cmds
+
+    (server, url) = start_server()
+    try:
+        env = dict(os.environ)
+        env['GX_DRIVE_API_URL'] = url
+        log_file = os.path.join(work_dir,
+                                '{0}-{1}.log'.format(scenario, run))
+        with open(log_file, 'w') as log:
+            for setup_cmd in setup:
+                subprocess.check_call(setup_cmd, cwd=work_dir, env=env,
+                                      stdout=log, stderr=subprocess.STDOUT)
+            if setup:
+                urllib.request.urlopen(url + '_bench/reset').close()
+
+            start = time.time()
+            tool  = subprocess.Popen(cmd, cwd=work_dir, env=env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+            # wait4() instead of wait() to get the tool's own rusage
+            (_, status, rusage) = os.wait4(tool.pid, 0)
+            wall = time.time() - start
+            tool.returncode = status
+
+        stats = server_stats(url)
+    finally:
+        server.kill()
+        server.wait()
+
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss = rusage.ru_maxrss * 1024
+    if sys.platform == 'darwin':
+        rss = rusage.ru_maxrss
+
+    return {
+        'scenario'         : scenario,
+        'status'           : os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+        'wall'             : wall,
+        'requests'         : stats['requests'],
+        'http_requests'    : stats['http_requests'],
+        'requests_per_sec' : stats['requests'] / wall if wall > 0 else 0,
+        'peak_rss_mb'      : rss / (1024.0 * 1024.0),
+        'by_method'        : stats['by_method'],
+        'injected_errors'  : stats['injected_errors'],
+        'quota_rejections' : stats['quota_rejections'],
+        'log'              : log_file,
+    }
+
+def print_results(results):
+    print("{0:<16} {1:>6} {2:>9} {3:>9} {4:>9} {5:>10}"
+          .format('scenario', 'status', 'wall (s)', 'API calls',
+                  'calls/s', 'peak RSS'))
+    for r in results:
+        print("{0:<16} {1:>6} {2:>9.2f} {3:>9} {4:>9.1f} {5:>8.1f}MB"
+              .format(r['scenario'], r['status'], r['wall'],
+                      r['requests'], r['requests_per_sec'],
+                      r['peak_rss_mb']))
+        if r['status'] != 0:
+            print("    (failed; see {0})".format(r['log']))
+
+#-------------------------------------------------------------------
+
+def add_cli_args():
+    parser = argparse.ArgumentParser(description='Benchmark the Drive scripts against bench/fake-drive.py')
+    parser.add_argument('--tree',
+                        required=True,
+                        help='JSON tree made by bench/make-tree.py')
+    parser.add_argument('--scenario',
+                        action='append',
+                        choices=scenarios,
+                        help='Scenario to run (can be given more than once; default: crawl and migrate)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='Number of times to run each scenario (default: 1)')
+    parser.add_argument('--user-credentials',
+                        action='append',
+                        metavar='EMAIL',
+                        help='Give gxcopy.py user credentials for this file owner (can be given more than once)')
+    parser.add_argument('--tool-args',
+                        help='Extra arguments for every script (one string)')
+
+    parser.add_argument('--latency',
+                        type=float,
+                        default=50,
+                        help='Fake Drive latency per HTTP request, in milliseconds (default: 50)')
+    parser.add_argument('--latency-jitter',
+                        type=float,
+                        default=0,
+                        help='Up to this many more random milliseconds of latency (default: 0)')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help='Fraction of API calls that fail at random (default: 0)')
+    parser.add_argument('--error-codes',
+                        default='403,429,500',
+                        help='HTTP statuses for the random failures (default: 403,429,500)')
+    parser.add_argument('--quota',
+                        type=int,
+                        default=0,
+                        help='API calls allowed per user per --quota-window (default: 0, meaning no limit)')
+    parser.add_argument('--quota-window',
+                        type=float,
+                        default=100,
+                        help='Seconds in a quota window (default: 100)')
+
+    parser.add_argument('--work-dir',
+                        help='Directory for credentials, logs, and reports (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--json',
+                        help='Also write the results to this JSON file')
+
+    global args
+    args = parser.parse_args()
+    if not args.scenario:
+        args.scenario = [ 'crawl', 'migrate' ]
+
+def main():
+    add_cli_args()
+
+    with open(args.tree) as f:
+        tree = json.load(f)
+
+    work_dir = args.work_dir
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='gx-bench-')
+
+    write_app_credentials(os.path.join(work_dir, 'client_id.json'))
+    write_credentials(os.path.join(work_dir, 'admin.json'), tree['admin'])
+    for email in args.user_credentials or []:
+        write_credentials(os.path.join(work_dir, email + '.json'), email)
+
+    results = list()
+    try:
+        for scenario in args.scenario:
+            for i in range(args.repeat):
+                result = run_scenario(scenario, tree, work_dir, i + 1)
+                if result:
+                    results.append(result)
+        print_results(results)
+    finally:
+        # Keep the logs around if anything went wrong
+        ok = results and all(r['status'] == 0 for r in results)
+        if not args.work_dir and ok:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif not ok:
+            print("Logs are in {0}".format(work_dir))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    exit(main())
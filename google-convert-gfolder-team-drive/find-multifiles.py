@@ -29,7 +29,6 @@ import sys
 import os
 import re
 import time
-import httplib2
 import calendar
 import uuid
 import logging
@@ -40,70 +39,35 @@ import csv
 from pprint import pprint
 from pprint import pformat
 
-from recordclass import recordclass
-
-from apiclient.discovery import build
-from apiclient.http import MediaFileUpload
-from apiclient.errors import HttpError
 from oauth2client import tools
 from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 
+from gxlib.api import doit, BatchQueue, MAY_BE_MISSING
+from gxlib.api import register_http, set_rate_limit, default_rate
+from gxlib.api import build_drive_service
+from gxlib import metrics
+from gxlib.transport import PooledHttp, keep_token_fresh
+from gxlib.crawl import read_source_tree
+from gxlib.records import folder_mime_type, team_drive_mime_type
+from gxlib.records import GFile
+from gxlib.teamdrives import find_team_drives
+from gxlib.snapshot import SnapshotWriter, open_snapshot, read_snapshot_tree
+from gxlib.teamdrives import set_index_ttl, default_index_ttl
+
 # Globals
 app_cred_file = 'client_id.json'
 admin_cred_file = 'admin-credentials.json'
 user_agent = 'gxcopy'
-doc_mime_type = 'application/vnd.google-apps.document';
-sheet_mime_type = 'application/vnd.google-apps.spreadsheet';
-folder_mime_type = 'application/vnd.google-apps.folder'
 args = None
 log = None
-# JMS this is probably a lie, but it's useful for comparisons
-team_drive_mime_type = 'application/vnd.google-apps.team_drive'
 # Scopes documented here:
 # https://developers.google.com/drive/v3/web/about-auth
 scope = 'https://www.googleapis.com/auth/drive'
 
 #-------------------------------------------------------------------
 
-# Recordclasses are effecitvely namedtuples that are mutable (i.e.,
-# support assignment). These are the recordclasses that are used in
-# the rest of the script.
-
-GFile = recordclass('GFile',
-                   ['id',           # string
-                    'webViewLink',  # string (URL)
-                    'mimeType',     # string
-                    'name',         # string
-                    'parents',      # list of strings (each an ID)
-                    'team_file',    # GFile or None
-                    ])
-Tree = recordclass('Tree',
-                  ['root_folder',   # See comment in read_source_tree()
-                   'contents'])
-ContentEntry = recordclass('ContentEntry',
-                          ['gfile',      # GFile
-                           'is_folder',  # boolean
-                           'traverse',   # boolean
-                           'contents',   # list of ContentEntry's
-                           'tree'        # Tree
-                           ])
-AllFiles = recordclass('AllFiles',
-                      ['name',           # string
-                       'webViewLink',    # string (URL)
-                       'parents',        # array of Parent records
-                       'is_folder',      # boolean
-                       ])
-Parent = recordclass('Parent',
-                     ['id',              # string
-                      'name',            # string
-                      'name_abs',        # string
-                      'webViewLink'      # string (URL)
-                      ])
-
-#-------------------------------------------------------------------
-
 def diediedie(msg):
     global log
 
@@ -184,260 +148,172 @@ def load_user_credentials(filename, scope, app_cred):
               .format(file))
     return user_cred
 
-def authorize(user_cred):
-    http    = httplib2.Http()
+def authorize(user_cred, name=None):
+    # One pooled, thread-safe Http per credential (see
+    # gxlib/transport.py), so the service can be shared by threads
+    http    = PooledHttp()
     http    = user_cred.authorize(http)
-    service = build('drive', 'v3', http=http)
+    service = build_drive_service(http)
+    register_http(http, user_cred, name)
+    keep_token_fresh(user_cred)
 
     log.debug('Authorized to Google')
     return service
 
 ####################################################################
 
-# If the Google API call fails, try again...
-def doit(httpref, can_fail=False):
-    count = 0
-    while count < 3:
-        try:
-            ret = httpref.execute()
-            return ret
-
-        except HttpError as err:
-            log.debug("*** Got HttpError:")
-            pprint(err)
-            if err.resp.status in [500, 503]:
-                log.debug("*** Seems recoverable; let's sleep and try again...")
-                time.sleep(5)
-                count = count + 1
-                continue
-            elif err.resp.status == 403 and can_fail:
-                log.debug("*** Got a 403, but we're allowed to fail this call")
-                # Need to return None to indicate failure
-                return None
-            else:
-                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(err.resp.status))
-                log.debug(err)
-                raise
+multifile_prefix = 'MULTIFILE'
 
-        except:
-            log.error("*** Some unknown error occurred")
-            log.error(sys.exc_info()[0])
-            raise
+query_fields = 'nextPageToken,files(id,name,parents,webViewLink)'
 
-    # If we get here, it's failed multiple times -- time to bail...
-    log.error("Error: we failed this 3 times; there's no reason to believe it'll work if we do it again...")
-    exit(1)
-
-####################################################################
-
-def find_multifiles(all_files, csvfile, log=None):
-
-    multifiles = dict()
+# Find the multifiles in a crawled tree.  Returns a list of hashes
+# with 'name', 'webViewLink', and 'path' (of the folder it's in).
+def find_multifiles(all_files):
+    multifiles = list()
     for id, allfile in all_files.items():
         # Skip folders
         if allfile.is_folder:
             continue
 
-        if allfile.name.startswith('MULTIFILE'):
-            multifiles[id] = allfile
+        if allfile.name.startswith(multifile_prefix):
+            multifiles.append({ 'name'        : allfile.name,
+                                'webViewLink' : allfile.webViewLink,
+                                'path'        : allfile.parents[0].name_abs })
+
+    return multifiles
+
+# Same as find_multifiles(), but instead of crawling the whole Team
+# Drive, ask Google for just the multifiles (i.e., one paginated
+# files().list over the whole Team Drive), and then look up the paths
+# of only the folders that they're in.
+def query_multifiles(service, team_drive):
+    query = ("name contains '{prefix}' and mimeType != '{folder}' and trashed=false"
+             .format(prefix=multifile_prefix, folder=folder_mime_type))
+    log.debug("Query: {0}".format(query))
+
+    files = list()
+    page_token = None
+    while True:
+        response = doit(service.files()
+                        .list(q=query,
+                              corpora='teamDrive',
+                              teamDriveId=team_drive.id,
+                              includeTeamDriveItems=True,
+                              supportsTeamDrives=True,
+                              pageSize=1000,
+                              pageToken=page_token,
+                              fields=query_fields))
+        # "contains" matches the start of any word in the name
+        files.extend(file for file in response.get('files', [])
+                     if file['name'].startswith(multifile_prefix))
+
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    log.info("Found {0} multifiles; looking up their folders"
+             .format(len(files)))
+    paths = resolve_folder_paths(service, team_drive,
+                                 set(file['parents'][0] for file in files))
+
+    return [ { 'name'        : file['name'],
+               'webViewLink' : file['webViewLink'],
+               'path'        : paths[file['parents'][0]] }
+             for file in files ]
+
+# Return a hash of folder ID -> absolute path (e.g., "/Team
+# Drive/Folder/Sub folder") for these folders in the Team Drive.
+# Folders are looked up a level at a time, in batches, and each folder
+# is only looked up once, no matter how many of the folders are in it.
+def resolve_folder_paths(service, team_drive, folder_ids):
+    folders = { team_drive.id : None }  # ID -> (name, parent ID), or None
+    batch   = BatchQueue()
+
+    def found(id, folder):
+        if folder is None:
+            # We can't see it (or it's gone)
+            folders[id] = ('<Unknown>', None)
+        else:
+            parents = folder.get('parents') or [ None ]
+            folders[id] = (folder['name'], parents[0])
+
+    pending = set(folder_ids)
+    while pending:
+        for id in pending:
+            folders[id] = None
+            batch.add(service,
+                      service.files().get(fileId=id,
+                                          fields='id,name,parents',
+                                          supportsTeamDrives=True),
+                      lambda folder, id=id: found(id, folder),
+                      can_fail=MAY_BE_MISSING)
+        batch.flush()
+
+        # Next level up
+        pending = set(folders[id][1] for id in pending
+                      if folders[id][1] is not None and
+                      folders[id][1] not in folders)
+
+    paths = { team_drive.id : '/' + team_drive.name }
+    def path(id):
+        if id not in paths:
+            (name, parent_id) = folders.get(id) or ('<Unknown>', None)
+            if parent_id is None:
+                paths[id] = name
+            else:
+                paths[id] = path(parent_id) + '/' + name
+        return paths[id]
 
+    return { id : path(id) for id in folder_ids }
+
+def print_multifiles(multifiles, csvfile):
     # Setup for CSV output, if desired
     writer = None
     if csvfile:
-        fieldnames = [ 'Filename', 'File link' ]
+        fieldnames = [ 'Filename', 'File link', 'Folder path' ]
         writer     = csv.DictWriter(csvfile, fieldnames=fieldnames,
                                     quoting=csv.QUOTE_ALL)
         writer.writeheader()
 
     if len(multifiles) == 0:
-        if log:
-            log.info("No multifiles found!")
+        log.info("No multifiles found!")
         return
 
     row = dict()
-    for id, allfile in multifiles.items():
-        row['Filename']  = allfile.name
-        row['File link'] = allfile.webViewLink
+    for multifile in multifiles:
+        row['Filename']    = multifile['name']
+        row['File link']   = multifile['webViewLink']
+        row['Folder path'] = multifile['path']
 
         print("Multifile: {name}"
-              .format(name=allfile.name))
+              .format(name=multifile['name']))
         print("     Link: {wvl}"
-              .format(wvl=allfile.webViewLink))
+              .format(wvl=multifile['webViewLink']))
+        print("   Folder: {path}"
+              .format(path=multifile['path']))
 
         if writer:
             writer.writerow(row)
 
 #-------------------------------------------------------------------
 
-# Find a list of contents of a particular root folder (GFile), and
-# recursively call down into each folder.  Make a somewhat complicated
-# data structure to represent the tree (remember that both files and
-# folders can have multiple parents).
-#
-# tree:
-#   .root_folder, a GFile instance:
-#      .id
-#      .mimeType: folder mime type
-#      .name
-#      .parents: list
-#      .team_id: None (will be populated later)
-#   .contents: list, each entry is an instance of ContentEntry, representing an item in this folder
-#      .gfile, a GFile instance:
-#         .id
-#         .mimeType
-#         .name
-#         .parents
-#         .team_id: None (will never be populated)
-#      .is_folder: boolean, True if folder
-#      .traverse: boolean, True if this is 1st time we've seen this folder
-#      .tree: if traverse==True, a tree, otherwise None
-#
-# all_files: hash indexed by ID, each entry is:
-#    .name
-#    .webViewLink
-#    .parents: list, each entry dictionary with these keys:
-#       .parent_folder_name
-#       .parent_folder_name_abs (contains entire name since root)
-#       .parent_folder_id
-#       .parent_folder_url: None (*may* be populated later)
-#    .team_file: None (will be populated later)
-#
-def read_source_tree(service, team_drive_id,
-                     prefix, root_folder, all_files = dict()):
-    log.info('Discovering contents of Team Drive: "{0}" (ID: {1})'
-             .format(root_folder.name, root_folder.id))
-
-    parent_folder_name_abs = '{0}/{1}'.format(prefix, root_folder.name)
-    log.debug('parent folder name abs: {0}=={1}'
-              .format(prefix, root_folder.name))
-    tree = Tree(root_folder=root_folder, contents=[])
-
-    # Iterate through everything in this root folder
-    page_token = None
-    query = "'{0}' in parents and trashed=false".format(root_folder.id)
-    log.debug("Query: {0}".format(query))
-    while True:
-        response = doit(service.files()
-                        .list(q=query,
-                              spaces='drive',
-                              corpora='teamDrive',
-                              fields='nextPageToken,files(name,id,mimeType,parents,webViewLink)',
-                              pageToken=page_token,
-                              teamDriveId=team_drive_id,
-                              includeTeamDriveItems=True,
-                              supportsTeamDrives=True))
-        for file in response.get('files', []):
-            log.info('Found: "{0}"'.format(file['name']))
-            id = file['id']
-            traverse = False
-            is_folder = False
-            if file['mimeType'] == folder_mime_type:
-                is_folder = True
-
-            # We have already seen this file before
-            if id in all_files:
-                log.debug('--- We already know this file; cross-referencing...')
-
-                # If this is a folder that we already know, then do
-                # not traverse down into it (again).
-                if is_folder:
-                    log.debug('--- Is a folder, but we already know it; NOT adding to pending traversal list')
-                    traverse = False
-
-            # We have *NOT* already seen this file before
-            else:
-                log.debug('--- We do not already know this file; saving...')
-                log.debug("Parents: {p}".format(p=file['parents']))
-                all_files[id] = AllFiles(name=file['name'],
-                                         webViewLink=file['webViewLink'],
-                                         parents=[], # Filled in below
-                                         is_folder=is_folder)
-
-                # If it's a folder, add it to the pending traversal list
-                if is_folder:
-                    traverse = True
-                    log.debug("--- Is a folder; adding to pending traversal list")
-
-            # Save this content entry in the list of contents for this
-            # folder
-            gfile = GFile(id=id,
-                          mimeType=file['mimeType'],
-                          webViewLink=file['webViewLink'],
-                          name=file['name'],
-                          parents=file['parents'],
-                          team_file=None)
-            content_entry = ContentEntry(gfile=gfile,
-                                         is_folder=is_folder,
-                                         traverse=traverse,
-                                         contents=[],
-                                         tree=None)
-            tree.contents.append(content_entry)
-
-            # JMS delete me
-            log.debug("Created gfile for content entry: {0}"
-                      .format(gfile))
-
-            # Save this file in the master list of *all* files found.
-            # Basically, add a parent listing to this ID in the
-            # all_files index.
-            parent_wvl = '<Unknown>'
-            if root_folder.id in all_files:
-                parent_wvl = all_files[root_folder.id].webViewLink
-
-            parent = Parent(id=root_folder.id, name=root_folder.name,
-                            name_abs=parent_folder_name_abs,
-                            webViewLink=parent_wvl)
-            all_files[id].parents.append(parent)
-
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
-
-    # Traverse all the sub folders
-    for entry in tree.contents:
-        if entry.traverse:
-            new_prefix = '{0}/{1}'.format(parent_folder_name_abs,
-                                          entry.gfile.name)
-            log.debug("== Traversing down into {0}"
-                          .format(new_prefix))
-            (t, all_files) = read_source_tree(service, team_drive_id,
-                                              parent_folder_name_abs,
-                                              entry.gfile, all_files)
-            entry.tree = t
-
-    # Done!
-    return (tree, all_files)
-
-#-------------------------------------------------------------------
-# Ensure there is no Team Drive of the same folder name
+# Find the Team Drive with this name or ID (see gxlib/teamdrives.py)
 def find_team_drive(service, name_or_id):
     log.info("Looking for a Team Drive named '{name}'"
              .format(name=name_or_id))
 
-    page_token = None
-    while True:
-        response = doit(service.teamdrives()
-                        .list(pageToken=page_token))
-
-        for team_drive in response.get('teamDrives', []):
-            log.debug("Checking existing team drive: {name} / {id}"
-                      .format(name=team_drive['name'],
-                              id=team_drive['id']))
-
-            if (team_drive['name'] == name_or_id or
-                team_drive['id'] == name_or_id):
-                log.info("Found matching Team Drive")
-                file = GFile(id=team_drive['id'],
-                             mimeType=team_drive_mime_type,
-                             webViewLink=None,
-                             name=team_drive['name'],
-                             parents=['root'],
-                             team_file=None)
-                return file
-
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    for team_drive in find_team_drives(service, name_or_id):
+        log.info("Found matching Team Drive: {name} / {id}"
+                 .format(name=team_drive['name'],
+                         id=team_drive['id']))
+        file = GFile(id=team_drive['id'],
+                     mimeType=team_drive_mime_type,
+                     webViewLink=None,
+                     name=team_drive['name'],
+                     owners=list(),
+                     parents=['root'],
+                     team_file=None)
+        return file
 
     # If we get here, we didn't find a team drive with the same name.
     # Boo!
@@ -449,8 +325,7 @@ def find_team_drive(service, name_or_id):
 
 def add_cli_args():
     tools.argparser.add_argument('--source-team-drive',
-                                 required=True,
-                                 help='Source team drive (name or ID)')
+                                 help='Source team drive (name or ID) (required, unless --from-snapshot)')
 
     tools.argparser.add_argument('--app-id',
                                  default=app_cred_file,
@@ -463,6 +338,44 @@ def add_cli_args():
     tools.argparser.add_argument('--csv',
                                  help='Output CSV file (optional)')
 
+    tools.argparser.add_argument('--crawl-workers',
+                                 type=int,
+                                 default=1,
+                                 help='Number of folders to list in parallel when reading the source tree (default: 1)')
+
+    tools.argparser.add_argument('--crawl-mode',
+                                 choices=['folders', 'corpus', 'query'],
+                                 default='folders',
+                                 help='How to read the source tree: list it folder-by-folder, list every file we can see in one pass and rebuild the tree locally, or (query) ask Google for just the MULTIFILE files and look up only their folders (default: folders)')
+
+    tools.argparser.add_argument('--save-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Also save the Team Drive tree to this snapshot file (see gxlib/snapshot.py), so that it can be used with --from-snapshot instead of reading the tree again (optional)')
+    tools.argparser.add_argument('--from-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Read the Team Drive tree from this snapshot file (made with --save-snapshot) instead of from Google; no credentials are needed (optional)')
+
+    tools.argparser.add_argument('--api-rate-limit',
+                                 type=float,
+                                 default=default_rate,
+                                 help='Maximum Google API calls per second per credential; 0 means no limit (default: {0})'.format(default_rate))
+    tools.argparser.add_argument('--team-drive-cache-ttl',
+                                 type=float,
+                                 default=default_index_ttl,
+                                 help='Seconds to keep entries in the local index of Team Drive names and IDs for (it saves a Google API call when looking a Team Drive up by name; anything found is still checked with Google); 0 means no index (default: {0})'.format(default_index_ttl))
+
+    tools.argparser.add_argument('--progress',
+                                 action='store_true',
+                                 help='Print a line of Google API call statistics every --metrics-interval seconds')
+    tools.argparser.add_argument('--metrics-interval',
+                                 type=float,
+                                 default=30,
+                                 help='Seconds between --progress lines and --metrics-textfile updates (default: 30)')
+    tools.argparser.add_argument('--metrics-textfile',
+                                 help='Keep Prometheus-format Google API call statistics in this file (e.g., for the node_exporter textfile collector)')
+    tools.argparser.add_argument('--metrics-json',
+                                 help='Write a JSON summary of Google API call statistics to this file at exit')
+
     tools.argparser.add_argument('--verbose',
                                  action='store_true',
                                  help='Be a bit verbose in what the script is doing')
@@ -476,6 +389,29 @@ def add_cli_args():
     global args
     args = tools.argparser.parse_args()
 
+    if args.from_snapshot and args.save_snapshot:
+        print("ERROR: --from-snapshot and --save-snapshot cannot be used together")
+        exit(1)
+    if (args.from_snapshot or args.save_snapshot) and args.crawl_mode == 'query':
+        print("ERROR: --from-snapshot and --save-snapshot cannot be used with --crawl-mode query")
+        exit(1)
+    if not args.source_team_drive and not args.from_snapshot:
+        print("ERROR: --source-team-drive or --from-snapshot is required")
+        exit(1)
+
+#-------------------------------------------------------------------
+
+# Print (and write to --csv) the multifiles report
+def write_report(multifiles):
+    csvfile = None
+    if args.csv:
+        csvfile = open(args.csv, 'w', newline='')
+
+    print_multifiles(multifiles, csvfile)
+
+    if csvfile:
+        csvfile.close()
+
 #-------------------------------------------------------------------
 
 def main():
@@ -484,13 +420,41 @@ def main():
     # Setup logging
     setup_logging(args)
 
+    # Keep track of where the Google API calls go
+    metrics.start_reporting(interval=args.metrics_interval,
+                            progress=args.progress,
+                            textfile=args.metrics_textfile,
+                            json_file=args.metrics_json)
+
+    # The report can be redone from a snapshot without Google
+    if args.from_snapshot:
+        try:
+            snapshot = open_snapshot(args.from_snapshot, team_drive=True)
+        except ValueError as e:
+            diediedie("Cannot use snapshot {0}: {1}"
+                      .format(args.from_snapshot, e))
+        if (args.source_team_drive and
+            args.source_team_drive not in (snapshot.root.id,
+                                           snapshot.root.name)):
+            diediedie("Snapshot {0} is of Team Drive {1} (ID: {2}), not {3}"
+                      .format(args.from_snapshot, snapshot.root.name,
+                              snapshot.root.id, args.source_team_drive))
+
+        (source_root, all_files) = read_snapshot_tree(snapshot)
+        snapshot.close()
+        write_report(find_multifiles(all_files))
+        log.debug("END OF MAIN")
+        return 0
+
     # Authorize the app and provide user consent to Google
+    set_rate_limit(args.api_rate_limit)
+    set_index_ttl(args.team_drive_cache_ttl)
     app_cred = load_app_credentials(args.app_id)
 
     log.info("Authtenticating as administrator...")
     admin_cred = load_user_credentials(args.admin_credentials,
                                        scope, app_cred)
-    admin_service = authorize(admin_cred)
+    admin_service = authorize(admin_cred, 'admin')
 
     source_drive = find_team_drive(admin_service,
                                    args.source_team_drive)
@@ -498,20 +462,31 @@ def main():
     log.debug("Source team drive is: {drive}"
               .format(drive=source_drive))
 
-    # Read the source tree
-    (source_root, all_files) = read_source_tree(admin_service,
-                                                source_drive.id,
-                                                '',
-                                                source_drive)
-
-    csvfile = None
-    if args.csv:
-        csvfile = open(args.csv, 'w', newline='')
-
-    find_multifiles(all_files, csvfile)
-
-    if csvfile:
-        csvfile.close()
+    # The admin service is thread safe, so all the crawl workers can
+    # share it
+    crawl_services = [admin_service] * args.crawl_workers
+
+    # Ask Google for just the multifiles, or read the whole source
+    # tree and find them in it
+    metrics.set_phase('crawl')
+    if args.crawl_mode == 'query':
+        multifiles = query_multifiles(admin_service, source_drive)
+    else:
+        snapshot = None
+        if args.save_snapshot:
+            snapshot = SnapshotWriter(args.save_snapshot, source_drive,
+                                      team_drive_id=source_drive.id,
+                                      tool='find-multifiles.py')
+        (source_root, all_files) = read_source_tree(crawl_services, '',
+                                                    source_drive,
+                                                    team_drive_id=source_drive.id,
+                                                    corpus=(args.crawl_mode == 'corpus'),
+                                                    listings=snapshot)
+        if snapshot:
+            snapshot.close()
+        multifiles = find_multifiles(all_files)
+
+    write_report(multifiles)
 
     log.debug("END OF MAIN")
 
@@ -14,9 +14,13 @@ Pre-requisites:
   Drive folder.
 - pip install --upgrade google-api-python-client
 - pip install --upgrade recordclass
+- pip install --upgrade pyyaml (optional; only for YAML --manifest
+  files)
+- pip install --upgrade aiohttp (optional; only for --backend asyncio)
 
 Input:
-- Source folder ID
+- Source folder ID, or a manifest of source folders (and the Team
+  Drives to migrate them to; see gxlib/manifest.py)
 
 """
 
@@ -31,74 +35,59 @@ import uuid
 import logging
 import logging.handlers
 import traceback
+import queue
+import threading
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from pprint import pprint
 
-from recordclass import recordclass
-
-from apiclient.discovery import build
-from apiclient.http import MediaFileUpload
-from apiclient.errors import HttpError
 from oauth2client import tools
 from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 
+from gxlib.api import doit, BatchQueue
+from gxlib.api import register_http, set_rate_limit, default_rate
+from gxlib.api import set_max_in_flight
+from gxlib.api import build_drive_service
+from gxlib import metrics
+from gxlib import dedup
+from gxlib.transport import PooledHttp, keep_token_fresh
+from gxlib.crawl import read_source_tree, walk_source_tree
+from gxlib.journal import Journal
+from gxlib.manifest import load_manifest
+from gxlib.plan import choose_file_action, make_plan, ADMIN, MOVE
+from gxlib.plan import COPY, SHORTCUT
+from gxlib.plan import save_plan, load_plan, print_plan_summary
+from gxlib.plan import planned_team_drive
+from gxlib.records import folder_mime_type, team_drive_mime_type
+from gxlib.records import GFile, Tree, AllFiles, ContentEntry
+from gxlib.scheduler import QuotaScheduler
+from gxlib.snapshot import SnapshotWriter, open_snapshot
+from gxlib.teamdrives import find_team_drives, remember_team_drives
+from gxlib.teamdrives import set_index_ttl, default_index_ttl
+from gxlib.workers import run_with_services
+
 # Globals
 app_cred_file = 'client_id.json'
 admin_cred_file = 'admin-credentials.json'
 user_agent = 'gxcopy'
-doc_mime_type = 'application/vnd.google-apps.document';
-sheet_mime_type = 'application/vnd.google-apps.spreadsheet';
-folder_mime_type = 'application/vnd.google-apps.folder'
 args = None
 log = None
-# JMS this is probably a lie, but it's useful for comparisons
-team_drive_mime_type = 'application/vnd.google-apps.team_drive'
+journal = None
+scheduler = None
+dedup_index = None
+# With --backend asyncio: the AsyncBackend, and an AsyncDrive for each
+# credential (by email address, and ADMIN)
+aio = None
+async_backend = None
+async_drives = None
 # Scopes documented here:
 # https://developers.google.com/drive/v3/web/about-auth
 scope = 'https://www.googleapis.com/auth/drive'
 
 #-------------------------------------------------------------------
 
-# Recordclasses are effecitvely namedtuples that are mutable (i.e.,
-# support assignment). These are the recordclasses that are used in
-# the rest of the script.
-
-GFile = recordclass('GFile',
-                   ['id',           # string
-                    'webViewLink',  # string (URL)
-                    'mimeType',     # string
-                    'name',         # string
-                    'owners',       # array of hashes: 'displayName', 'emailAddress', 'kind', 'me', 'permissionId'
-                    'parents',      # list of strings (each an ID)
-                    'team_file',    # GFile or None
-                    ])
-Tree = recordclass('Tree',
-                  ['root_folder',   # See comment in read_source_tree()
-                   'contents'])
-ContentEntry = recordclass('ContentEntry',
-                          ['gfile',      # GFile
-                           'is_folder',  # boolean
-                           'traverse',   # boolean
-                           'contents',   # list of ContentEntry's
-                           'tree'        # Tree
-                           ])
-AllFiles = recordclass('AllFiles',
-                      ['name',           # string
-                       'webViewLink',    # string (URL)
-                       'parents',        # array of Parent records
-                       'team_file',      # GFile
-                       ])
-Parent = recordclass('Parent',
-                     ['id',              # string
-                      'name',            # string
-                      'name_abs',        # string
-                      'webViewLink'      # string (URL)
-                      ])
-
-#-------------------------------------------------------------------
-
 def diediedie(msg):
     global log
 
@@ -121,8 +110,12 @@ def setup_logging(args):
     log = logging.getLogger('FToTD')
     log.setLevel(level)
 
-    # Make sure to include the timestamp in each message
-    f = logging.Formatter('%(asctime)s %(levelname)-8s: %(message)s')
+    # Make sure to include the timestamp in each message (and with
+    # --manifest, which migration it's from)
+    if args.manifest:
+        f = logging.Formatter('%(asctime)s %(levelname)-8s [%(threadName)s]: %(message)s')
+    else:
+        f = logging.Formatter('%(asctime)s %(levelname)-8s: %(message)s')
 
     # Default log output to stdout
     s = logging.StreamHandler()
@@ -179,51 +172,59 @@ def load_user_credentials(filename, scope, app_cred):
               .format(file))
     return user_cred
 
-def authorize(user_cred):
-    http    = httplib2.Http()
-    http    = user_cred.authorize(http)
-    service = build('drive', 'v3', http=http)
+# Load the credentials for each (name, filename) in cred_files.
+# Reading the stored credentials and refreshing their access tokens is
+# done for all of them at once; only the ones that need someone to log
+# in with a web browser (i.e., there are no stored credentials, or
+# they can't be refreshed) are done one at a time.
+#
+# Returns the credentials, in the same order as cred_files.
+def load_all_user_credentials(cred_files, scope, app_cred):
+    def load_stored(item):
+        (name, filename) = item
+        user_cred = Storage(os.path.join(os.getcwd(), filename)).get()
+        if user_cred is None or user_cred.invalid:
+            return None
+
+        if user_cred.access_token_expired:
+            log.debug("Refreshing access token for {0}".format(name))
+            try:
+                user_cred.refresh(httplib2.Http())
+            except AccessTokenRefreshError:
+                return None
 
-    log.debug('Authorized to Google')
-    return service
+        log.debug('Loaded user credentials from {0}'
+                  .format(filename))
+        return user_cred
 
-####################################################################
+    with ThreadPoolExecutor(max_workers=len(cred_files)) as pool:
+        creds = list(pool.map(load_stored, cred_files))
 
-# If the Google API call fails, try again...
-def doit(httpref, can_fail=False):
-    count = 0
-    while count < 3:
-        try:
-            ret = httpref.execute()
-            return ret
-
-        except HttpError as err:
-            log.debug("*** Got HttpError:")
-            pprint(err)
-            if err.resp.status in [500, 503]:
-                log.debug("*** Seems recoverable; let's sleep and try again...")
-                time.sleep(5)
-                count = count + 1
-                continue
-            elif err.resp.status == 403 and can_fail:
-                log.debug("*** Got a 403, but we're allowed to fail this call")
-                # Need to return None to indicate failure
-                return None
-            else:
-                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(err.resp.status))
-                log.debug(err)
-                raise
+    for i, (name, filename) in enumerate(cred_files):
+        if creds[i] is None:
+            log.info("Getting new credentials for {0}".format(name))
+            creds[i] = load_user_credentials(filename, scope, app_cred)
 
-        except:
-            log.error("*** Some unknown error occurred")
-            log.error(sys.exc_info()[0])
-            raise
+    return creds
 
-    # If we get here, it's failed multiple times -- time to bail...
-    log.error("Error: we failed this 3 times; there's no reason to believe it'll work if we do it again...")
-    exit(1)
+# authorize() a bunch of credentials at once
+def authorize_all(creds, names):
+    with ThreadPoolExecutor(max_workers=len(creds)) as pool:
+        return list(pool.map(authorize, creds, names))
 
-#-------------------------------------------------------------------
+def authorize(user_cred, name=None):
+    # One pooled, thread-safe Http per credential (see
+    # gxlib/transport.py), so the service can be shared by threads
+    http    = PooledHttp()
+    http    = user_cred.authorize(http)
+    service = build_drive_service(http)
+    register_http(http, user_cred, name)
+    keep_token_fresh(user_cred)
+
+    log.debug('Authorized to Google')
+    return service
+
+####################################################################
 
 # parent_folder: gfile
 # new_folder_name: string
@@ -242,8 +243,14 @@ def create_folder(service, parent_folder, new_folder_name):
     log.debug('Created folder: "{0}" (ID: {1})'
               .format(folder['name'], folder['id']))
 
+    return team_folder_gfile(folder)
+
+# The GFile of a Team Drive folder, from a hash with its id, name,
+# parents, and webViewLink (i.e., the API's response when it was made,
+# or its journal record)
+def team_folder_gfile(folder):
     file = GFile(id=folder['id'],
-                 mimeType=folder['mimeType'],
+                 mimeType=folder_mime_type,
                  name=folder['name'],
                  parents=folder['parents'],
                  owners=list(),
@@ -271,39 +278,55 @@ def create_folder(service, parent_folder, new_folder_name):
 # source_root: tree (created by read_source_tree())
 # team_root: gfile
 # all_files: hash indexed by ID (created by read_source_tree())
+# batch: BatchQueue to put file moves/copies on, or None to do them
+#        one at a time.  The caller must flush() it when done.
 #
 # This routine will not be called if this is a dry run, so no need for
 # such protection inside this function.
 def migrate_folder_to_team_drive(admin_service, user_services, owning_domain,
-                                 source_root, team_root, all_files):
+                                 source_root, team_root, all_files,
+                                 batch=None):
+    # Use an explicit stack of (source tree, team folder, iterator over
+    # the source tree's contents) instead of recursing once per folder
+    # level, so that arbitrarily deep trees are fine.  Things are still
+    # done in the same (depth-first) order.
     log.debug('Migrating folder to Team Drive: "{folder}"'
               .format(folder=source_root.root_folder.name))
+    stack = [ (source_root, team_root, iter(source_root.contents)) ]
 
     # Now go through all the entries and find all the sub-folders.
     # Copy them one-by-one to the target team drive.
-    for source_entry in source_root.contents:
+    while stack:
+        (source_root, team_root, contents) = stack[-1]
+        source_entry = next(contents, None)
+        if source_entry is None:
+            stack.pop()
+            continue
+
         # Folder
         if source_entry.is_folder:
-            # Make the corresponding folder in the team drive
-            make_folder_in_team_drive(admin_service,
-                                      source_root, team_root,
-                                      all_files, source_entry)
+            # Make the corresponding folder in the team drive (unless
+            # make_folder_skeleton_in_team_drive() already did)
+            if source_entry.gfile.team_file is None:
+                make_folder_in_team_drive(admin_service,
+                                          source_root, team_root,
+                                          all_files, source_entry)
 
             # Traverse into the source subfolder
             if source_entry.traverse:
                 source_id = source_entry.gfile.id
-                migrate_folder_to_team_drive(admin_service, user_services,
-                                             owning_domain,
-                                             source_entry.tree,
-                                             all_files[source_id].team_file,
-                                             all_files)
+                log.debug('Migrating folder to Team Drive: "{folder}"'
+                          .format(folder=source_entry.gfile.name))
+                stack.append((source_entry.tree,
+                              all_files[source_id].team_file,
+                              iter(source_entry.tree.contents)))
 
         # File
         else:
             migrate_file_to_team_drive(admin_service, user_services,
                                        owning_domain,
                                        source_root, team_root,
-                                       all_files, source_entry)
+                                       all_files, source_entry, batch)
 
 #-------------------------------------------------------------------
 
@@ -316,94 +339,169 @@ def migrate_folder_to_team_drive(admin_service, user_services, owning_domain,
 # team_root: GFile
 # all_files: hash indexed by ID (created by read_source_tree())
 # source_file_entry: ContentEntry of file to move
+# batch: BatchQueue or None (see migrate_folder_to_team_drive())
 def migrate_file_to_team_drive(admin_service, user_services,
                                owning_domain,
                                source_root, team_root,
-                               all_files, source_file_entry):
+                               all_files, source_file_entry,
+                               batch=None):
     log.info('- Migrating "{file}" from "{source}" to Team drive'
              .format(source=source_root.root_folder.name,
                      file=source_file_entry.gfile.name))
 
-    # 0. If the file has multiple parents, Google will not let us move
-    #    it to the team drive.  Copy it instead, but put a "MULTIFILE"
-    #    prefix on the destination filenames in the Team Drive so that
-    #    the owners know that there's multiple copies.
-    # 1. If the file is owned by a user in the same domain as the
-    #    admin, move it with the admin service.
-    # 2. If the file is owned by any of the user credentials, move
-    #    it with the corresponding user service.
-    # 3. Otherwise, copy the file.
-
-    service  = None
-    rename   = None
-    can_move = False
-
-    if len(source_file_entry.gfile.parents) > 1:
-        log.info("  This file has multiple parents.")
-        log.info('  It will be copied to the Team Drive with a "MULTIFILE" prefix')
-        service = admin_service
-        rename  = 'MULTIFILE ' + source_file_entry.gfile.name
-
-    # Check to see if the owner of the file is in the owning domain.
-    # I think it's an anachronism that there can be multiple owners
-    # for a file (i.e., I don't think Google supports this any more),
-    # but cover our bases.
-    if service is None:
-        owners  = source_file_entry.gfile.owners
-        for owner in owners:
-            owner_name = owner['displayName']
-            owner_email = owner['emailAddress']
-
-            # Is this file owned by someone in the target domain?
-            if owner_email.endswith(owning_domain):
-                log.info("  This file is owned by {name} <{email}> in the target domain.  WE CAN MOVE IT."
-                         .format(name=owner_name,
-                                 email=owner_email))
-                service  = admin_service
-                can_move = True
-                break
+    if journal and journal.file_done(source_file_entry.gfile.id,
+                                     team_root.id):
+        log.info("  Already migrated (according to the journal); skipping")
+        return
 
-            # If this file owned by someone for whom we have user
-            # credentials?
-            else:
-                for us in user_services:
-                    if owner_email == us['address']:
-                        log.info("  This file is owned by {name} <{email}>, for whom we have user credentials.  WE CAN MOVE IT."
-                                 .format(name=owner_name,
-                                         email=owner_email))
-                        service  = us['service']
-                        can_move = True
-                        break
-
-                # If we found a winnner, we're done
-                if can_move:
-                    break
+    # See choose_file_action() for how we decide
+    user_service = { us['address'] : us['service'] for us in user_services }
+    (action, credential, rename) = \
+        choose_file_action(source_file_entry.gfile, owning_domain,
+                           user_service)
+    can_move = (action == MOVE)
+    service  = user_service.get(credential, admin_service)
 
     # Ok, we're ready: move or copy it
+    if batch is not None:
+        copy_service = admin_service
+        if scheduler:
+            gfile = source_file_entry.gfile
+            (_, service) = scheduler.pick(scheduler.movers(gfile, credential))
+            (_, copy_service) = scheduler.pick(scheduler.readers(gfile.owners))
+        queue_file_to_team_drive(batch, admin_service, service, can_move,
+                                 team_root, source_file_entry, rename,
+                                 copy_service)
+        return
+
     moved = False
     if can_move:
-        moved = move_file_to_team_drive(service,
-                                        source_root, team_root,
-                                        all_files, source_file_entry)
+        if scheduler:
+            movers = scheduler.movers(source_file_entry.gfile, credential)
+            with scheduler.service(movers) as (_, service):
+                moved = move_file_to_team_drive(service,
+                                                source_root, team_root,
+                                                all_files, source_file_entry)
+        else:
+            moved = move_file_to_team_drive(service,
+                                            source_root, team_root,
+                                            all_files, source_file_entry)
+
+    if moved:
+        journal_file(source_file_entry, team_root, 'moved')
+        if dedup_index:
+            dedup_index.moved(source_file_entry.gfile.id)
+    else:
+        log.info("  Looks like we have to COPY this file")
+        action = copy_or_dedup_file(admin_service, team_root,
+                                    source_file_entry, rename)
+        journal_file(source_file_entry, team_root, action)
+
+#-------------------------------------------------------------------
+
+def journal_file(source_file_entry, team_root, action):
+    if journal:
+        journal.record_file(source_file_entry.gfile.id, team_root.id,
+                            action)
+
+#-------------------------------------------------------------------
+
+# Same as the tail end of migrate_file_to_team_drive(), but put the
+# move/copy on the batch queue instead of doing it right now.  If the
+# move fails, the copy is put on the batch queue when we find out.
+#
+# copy_service: service to copy with, if not admin_service.  If the
+# copy fails, it is put back on the queue to copy with admin_service.
+#
+# With --dedup, a file whose contents are already being copied waits
+# for that copy (without holding up the queue), and then a shortcut to
+# it is put on the queue instead of another copy.
+def queue_file_to_team_drive(batch, admin_service, service, can_move,
+                             team_root, source_file_entry, rename,
+                             copy_service=None):
+    # Future from dedup_index.claim(), if this is the file to copy
+    claimed = [ None ]
+
+    def copy_it(copy_service=copy_service or admin_service):
+        request = copy_file_request(copy_service, team_root,
+                                    source_file_entry, rename)
+        batch.add(copy_service, request,
+                  lambda copied_file: copied(copy_service, copied_file),
+                  can_fail=True)
+
+    def copied(copy_service, copied_file):
+        if copied_file is None and copy_service is not admin_service:
+            log.info('  Could not copy "{file}" as its owner; copying as the admin'
+                     .format(file=source_file_entry.gfile.name))
+            copy_it(admin_service)
+            return
+        copy_file_result(copied_file)
+        if claimed[0] is not None:
+            claimed[0].set_result(copied_file['id'])
+        journal_file(source_file_entry, team_root, 'copied')
+
+    def copy_or_dedup():
+        if dedup_index is None:
+            copy_it()
+            return
+        (future, first) = dedup_index.claim(source_file_entry.gfile.id)
+        if first:
+            claimed[0] = future
+            copy_it()
+        else:
+            future.add_done_callback(lambda f: dedup_it(f.result()))
+
+    def dedup_it(target_id):
+        if target_id is None:
+            copy_it()
+        elif args.dedup != dedup.SHORTCUT:
+            action = dedup_file_to_team_drive(admin_service, team_root,
+                                              source_file_entry, target_id,
+                                              False)
+            journal_file(source_file_entry, team_root, action)
+        else:
+            request = shortcut_file_request(admin_service, team_root,
+                                            source_file_entry, target_id,
+                                            rename)
+            batch.add(admin_service, request, shortcut_made, can_fail=True)
+
+    def shortcut_made(shortcut):
+        if shortcut is None:
+            log.info('  Could not make a shortcut for "{file}"; copying it'
+                     .format(file=source_file_entry.gfile.name))
+            copy_it()
+        else:
+            journal_file(source_file_entry, team_root, 'shortcut')
+
+    def moved(migrated_file):
+        if move_file_result(migrated_file):
+            journal_file(source_file_entry, team_root, 'moved')
+            if dedup_index:
+                dedup_index.moved(source_file_entry.gfile.id)
+        else:
+            log.info('  Looks like we have to COPY "{file}"'
+                     .format(file=source_file_entry.gfile.name))
+            copy_or_dedup()
 
-    if not moved:
+    if can_move:
+        request = move_file_request(service, team_root, source_file_entry)
+        batch.add(service, request, moved, can_fail=True)
+    else:
         log.info("  Looks like we have to COPY this file")
-        copy_file_to_team_drive(admin_service, source_root, team_root,
-                                all_files, source_file_entry,
-                                rename=rename)
+        copy_or_dedup()
 
 #-------------------------------------------------------------------
 
-def move_file_to_team_drive(service, source_root, team_root,
-                            all_files, source_file_entry):
-    migrated_file = doit(service
-			 .files()
-			 .update(fileId=source_file_entry.gfile.id,
-				 addParents=team_root.id,
-				 removeParents=source_file_entry.gfile.parents[0],
-                                 supportsTeamDrives=True,
-				 fields='id'),
-                         can_fail=True)
+def move_file_request(service, team_root, source_file_entry):
+    return (service
+            .files()
+            .update(fileId=source_file_entry.gfile.id,
+                    addParents=team_root.id,
+                    removeParents=source_file_entry.gfile.parents[0],
+                    supportsTeamDrives=True,
+                    fields='id'))
+
+def move_file_result(migrated_file):
     if migrated_file is not None:
         log.debug("--> Moved!")
         return True
@@ -411,179 +509,547 @@ def move_file_to_team_drive(service, source_root, team_root,
         log.debug("--> Failed to move file")
         return False
 
+def move_file_to_team_drive(service, source_root, team_root,
+                            all_files, source_file_entry):
+    migrated_file = doit(move_file_request(service, team_root,
+                                           source_file_entry),
+                         can_fail=True)
+    return move_file_result(migrated_file)
+
 #-------------------------------------------------------------------
 
-def copy_file_to_team_drive(service, source_root, team_root,
-                            all_files, source_file_entry,
-                            rename=None):
+def copy_file_request(service, team_root, source_file_entry, rename=None):
     new_name = rename or source_file_entry.gfile.name
-    copied_file = doit(service
-                       .files()
-                       .copy(fileId=source_file_entry.gfile.id,
-                             body={ 'parents' : [team_root.id],
-                                    'name' : new_name },
-                             supportsTeamDrives=True,
-                             fields='id'),
-                       can_fail=True)
+    return (service
+            .files()
+            .copy(fileId=source_file_entry.gfile.id,
+                  body={ 'parents' : [team_root.id],
+                         'name' : new_name },
+                  supportsTeamDrives=True,
+                  fields='id'))
+
+def copy_file_result(copied_file):
     if copied_file is None:
         print("ERROR: Failed to copy file!")
         exit(1)
     else:
         log.debug("--> Copied")
 
+# Returns the ID of the copy
+def copy_file_to_team_drive(service, source_root, team_root,
+                            all_files, source_file_entry,
+                            rename=None):
+    copied_file = doit(copy_file_request(service, team_root,
+                                         source_file_entry, rename),
+                       can_fail=True)
+    copy_file_result(copied_file)
+    return copied_file['id']
+
+# Copy with whichever of the credentials that can read the file has the
+# most quota left (see gxlib/scheduler.py).  The file's owner might not be
+# allowed to write to the Team Drive, so if their copy fails, copy it
+# as the admin.
+def copy_file_with_scheduler(admin_service, team_root, source_file_entry,
+                             rename=None):
+    readers = scheduler.readers(source_file_entry.gfile.owners)
+    with scheduler.service(readers) as (name, service):
+        copied_file = doit(copy_file_request(service, team_root,
+                                             source_file_entry, rename),
+                           can_fail=True)
+
+    if copied_file is None and name != ADMIN:
+        log.info("  Could not copy it as {0}; copying as the admin"
+                 .format(name))
+        return copy_file_to_team_drive(admin_service, None, team_root,
+                                       None, source_file_entry,
+                                       rename=rename)
+    copy_file_result(copied_file)
+    return copied_file['id']
+
+# Copy a file, with the scheduler if there is one.  With --dedup, if a
+# file with the same contents is already in the Team Drive (or is
+# being copied there by another worker, in which case wait for it), make
+# a shortcut to it instead (or, with --dedup once, do nothing).
+#
+# Returns what was done, for the journal.
+def copy_or_dedup_file(admin_service, team_root, source_file_entry,
+                       rename=None):
+    copy_future = None
+    if dedup_index:
+        (copy_future, first) = dedup_index.claim(source_file_entry.gfile.id)
+        if not first:
+            target_id   = copy_future.result()
+            copy_future = None
+            if target_id is not None:
+                action = dedup_file_to_team_drive(admin_service, team_root,
+                                                  source_file_entry,
+                                                  target_id,
+                                                  args.dedup == dedup.SHORTCUT,
+                                                  rename)
+                if action:
+                    return action
+
+    # Whatever happens, don't leave anyone waiting on this copy
+    team_id = None
+    try:
+        if scheduler:
+            team_id = copy_file_with_scheduler(admin_service, team_root,
+                                               source_file_entry, rename)
+        else:
+            team_id = copy_file_to_team_drive(admin_service, None, team_root,
+                                              None, source_file_entry,
+                                              rename=rename)
+    finally:
+        if copy_future is not None:
+            copy_future.set_result(team_id)
+    return 'copied'
+
+#-------------------------------------------------------------------
+
+# A Drive shortcut to target_id (a Team Drive file with the same
+# contents as the source file), in place of a copy of the source file
+def shortcut_file_request(service, team_root, source_file_entry, target_id,
+                          rename=None):
+    new_name = rename or source_file_entry.gfile.name
+    return (service
+            .files()
+            .create(body={ 'name' : new_name,
+                           'mimeType' : dedup.shortcut_mime_type,
+                           'parents' : [team_root.id],
+                           'shortcutDetails' : { 'targetId' : target_id } },
+                    supportsTeamDrives=True,
+                    fields='id'))
+
+# Instead of copying a file with the same contents as target_id, make
+# a shortcut to target_id (or if make_shortcut is False, nothing at
+# all).  Returns what was done, for the journal, or None if the
+# shortcut could not be made (i.e., the file should be copied after
+# all).
+def dedup_file_to_team_drive(service, team_root, source_file_entry,
+                             target_id, make_shortcut, rename=None):
+    if not make_shortcut:
+        log.info("  Same contents as Team Drive file {0}; not copying it"
+                 .format(target_id))
+        return 'deduplicated'
+
+    log.info("  Same contents as Team Drive file {0}; making a shortcut to it"
+             .format(target_id))
+    shortcut = doit(shortcut_file_request(service, team_root,
+                                          source_file_entry, target_id,
+                                          rename),
+                    can_fail=True)
+    if shortcut is None:
+        log.info("  Could not make a shortcut; copying it instead")
+        return None
+    log.debug("--> Made shortcut")
+    return 'shortcut'
+
 #-------------------------------------------------------------------
 
+# Make a folder in the Team Drive, unless the journal says we already
+# did.  Returns the GFile of the Team Drive folder.
+def make_or_resume_folder(service, team_root, source_id, name):
+    record = journal.folder(source_id, team_root.id) if journal else None
+    if record:
+        log.debug('--> Already made (according to the journal): "{0}" (ID: {1})'
+                  .format(record['name'], record['id']))
+        team_folder = team_folder_gfile(record)
+    else:
+        team_folder = create_folder(service, team_root, name)
+        if journal:
+            journal.record_folder(source_id, team_root.id, team_folder)
+
+    return team_folder
+
 def make_folder_in_team_drive(service, source_root, team_root,
                               all_files, source_folder_entry):
     log.debug('- Making sub folder: "{new}" in "{old}"'
                   .format(old=source_root.root_folder.name,
                           new=source_folder_entry.gfile.name))
 
-    # Make the folder in the Team Drive
-    source_id = source_folder_entry.gfile.id
-    team_folder = create_folder(service, team_root,
-                                source_folder_entry.gfile.name)
-    all_files[source_id].team_file = team_folder
+    source_id   = source_folder_entry.gfile.id
+    team_folder = make_or_resume_folder(service, team_root, source_id,
+                                        source_folder_entry.gfile.name)
+
+    # A folder with multiple parents gets a Team Drive folder for each
+    # of them, but only the one we traverse into gets any contents
+    source_folder_entry.gfile.team_file = team_folder
+    if source_folder_entry.traverse:
+        all_files[source_id].team_file = team_folder
+
+#-------------------------------------------------------------------
+
+# Make every folder in the source tree in the Team Drive, before any
+# files are moved/copied.  All the folders at a given depth can be made
+# in parallel, since their parents were all made in the previous pass.
+# So this takes (depth of the tree) rounds of parallel calls instead of
+# (number of folders) serial calls.
+#
+# services: list of services (with admin creds), one per thread
+def make_folder_skeleton_in_team_drive(services, source_root, team_root,
+                                       all_files):
+    # (source tree, team folder) pairs whose sub folders need making
+    level = [ (source_root, team_root) ]
+    depth = 1
+    while level:
+        work = [ (tree, team_folder, entry)
+                 for (tree, team_folder) in level
+                 for entry in tree.contents
+                 if entry.is_folder and entry.gfile.team_file is None ]
+        if not work:
+            break
+
+        log.info("Making {0} folders at depth {1} in the Team Drive"
+                 .format(len(work), depth))
+        run_with_services(services, work,
+                          lambda service, item:
+                          make_folder_in_team_drive(service, item[0], item[1],
+                                                    all_files, item[2]))
+
+        level = [ (entry.tree, entry.gfile.team_file)
+                  for (_, _, entry) in work
+                  if entry.traverse ]
+        depth = depth + 1
 
 #-------------------------------------------------------------------
 
-# Find a list of contents of a particular root folder (GFile), and
-# recursively call down into each folder.  Make a somewhat complicated
-# data structure to represent the tree (remember that both files and
-# folders can have multiple parents).
+# Crawl the source tree and migrate it at the same time, instead of
+# reading the whole tree into memory first.
 #
-# tree:
-#   .root_folder, a GFile instance:
-#      .id
-#      .mimeType: folder mime type
-#      .name
-#      .parents: list
-#      .owners: JMS ???list
-#      .team_id: None (will be populated later)
-#   .contents: list, each entry is an instance of ContentEntry, representing an item in this folder
-#      .gfile, a GFile instance:
-#         .id
-#         .mimeType
-#         .name
-#         .parents
-#         .owners: JMS ???list
-#         .team_id: None (will never be populated)
-#      .is_folder: boolean, True if folder
-#      .traverse: boolean, True if this is 1st time we've seen this folder
-#      .tree: if traverse==True, a tree, otherwise None
+# The crawl (walk_source_tree()) puts a task on a bounded queue for
+# every item it finds; a pool of migration workers takes them off.
+# Each folder gets a Future that is resolved with its Team Drive
+# folder once that has been made; the tasks for the items in that
+# folder wait on it.  The crawl is breadth first and the queue is
+# FIFO, so a folder's task is always taken off the queue before the
+# tasks of anything in it (i.e., a worker can't wait on a folder that
+# no one is making).  The crawl blocks when the queue is full, and
+# the crawl workers stop prefetching once max_prefetched folder
+# listings are waiting (see FolderFetcher in gxlib/crawl.py), so the
+# tasks and listings in memory are bounded.  The crawl's own
+# bookkeeping (the folders still to be listed, team_folders and
+# all_files) still grows with the tree.
 #
-# all_files: hash indexed by ID, each entry is:
-#    .name
-#    .webViewLink
-#    .parents: list, each entry dictionary with these keys:
-#       .parent_folder_name
-#       .parent_folder_name_abs (contains entire name since root)
-#       .parent_folder_id
-#       .parent_folder_url: None (*may* be populated later)
-#    .team_file: None (will be populated later)
+# crawl_services: list of services (with admin creds) to crawl with
+# worker_services: list of (admin_service, user_services) tuples, one
+#                  per migration worker
+def pipeline_migrate_to_team_drive(crawl_services, worker_services,
+                                   owning_domain, source_folder,
+                                   team_drive, queue_size):
+    tasks   = queue.Queue(maxsize=queue_size)
+    errors  = list()
+    # Only folders go in all_files (for make_folder_in_team_drive())
+    all_files = dict()
+    team_folders = { source_folder.id : Future() }
+    team_folders[source_folder.id].set_result(team_drive)
+
+    def worker(admin_service, user_services):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            (parent, entry) = task
+            source_root = Tree(root_folder=parent, contents=[])
+
+            try:
+                # Raises if the parent folder could not be made
+                team_root = team_folders[parent.id].result()
+
+                if entry.is_folder:
+                    make_folder_in_team_drive(admin_service, source_root,
+                                              team_root, all_files, entry)
+                    if entry.traverse:
+                        team_folders[entry.gfile.id].set_result(entry.gfile.team_file)
+                else:
+                    migrate_file_to_team_drive(admin_service, user_services,
+                                               owning_domain,
+                                               source_root, team_root,
+                                               all_files, entry)
+            except BaseException as e:
+                errors.append(e)
+                if entry.is_folder and entry.traverse:
+                    team_folders[entry.gfile.id].set_exception(e)
+
+    threads = list()
+    for (admin_service, user_services) in worker_services:
+        t = threading.Thread(target=worker,
+                             args=(admin_service, user_services),
+                             daemon=True)
+        t.start()
+        threads.append(t)
+
+    try:
+        for (parent, _, entry) in walk_source_tree(crawl_services, '',
+                                                   source_folder,
+                                                   scheduler=scheduler,
+                                                   dedup=dedup_index):
+            if entry.is_folder and entry.traverse:
+                all_files[entry.gfile.id] = AllFiles(name=entry.gfile.name,
+                                                     webViewLink=entry.gfile.webViewLink,
+                                                     parents=[],
+                                                     is_folder=True,
+                                                     owners=list(),
+                                                     team_file=None)
+                team_folders[entry.gfile.id] = Future()
+
+            # Don't block forever if the workers have all died
+            while not errors:
+                try:
+                    tasks.put((parent, entry), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if errors:
+                break
+    finally:
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+#-------------------------------------------------------------------
+
+# Execute a plan made by --plan (see gxlib/plan.py).  No decisions are
+# made here: the folders are made a level at a time, in parallel, and
+# then the files are moved/copied in parallel with the credentials
+# that the plan says to use.  If a planned move fails (e.g., the owner
+# changed since the plan was made), the file is copied instead.
 #
-def read_source_tree(service, prefix, root_folder, all_files = dict()):
-    log.info('Discovering contents of folder: "{0}" (ID: {1})'
-             .format(root_folder.name, root_folder.id))
-
-    parent_folder_name_abs = '{0}/{1}'.format(prefix, root_folder.name)
-    log.debug('parent folder name abs: {0}=={1}'
-              .format(prefix, root_folder.name))
-    tree = Tree(root_folder=root_folder, contents=[])
-
-    # Iterate through everything in this root folder
-    page_token = None
-    query = "'{0}' in parents and trashed=false".format(root_folder.id)
-    log.debug("Query: {0}".format(query))
-    while True:
-        response = doit(service.files()
-                        .list(q=query,
-                              spaces='drive',
-                              corpora='user',
-                              fields='nextPageToken,files(name,id,mimeType,parents,owners,webViewLink)',
-                              pageToken=page_token,
-                              supportsTeamDrives=True))
-        for file in response.get('files', []):
-            log.info('Found: "{0}"'.format(file['name']))
-            id = file['id']
-            traverse = False
-            is_folder = False
-            if file['mimeType'] == folder_mime_type:
-                is_folder = True
-
-            # We have already seen this file before
-            if id in all_files:
-                log.debug('--- We already know this file; cross-referencing...')
-
-                # If this is a folder that we already know, then do
-                # not traverse down into it (again).
-                if is_folder:
-                    log.debug('--- Is a folder, but we already know it; NOT adding to pending traversal list')
-                    traverse = False
-
-            # We have *NOT* already seen this file before
-            else:
-                log.debug('--- We do not already know this file; saving...')
-                all_files[id] = AllFiles(name=file['name'],
-                                         webViewLink=file['webViewLink'],
-                                         parents=list(),
-                                         team_file=None)
-
-                # If it's a folder, add it to the pending traversal list
-                if is_folder:
-                    traverse = True
-                    log.debug("--- Is a folder; adding to pending traversal list")
-
-            # Save this content entry in the list of contents for this
-            # folder
-            gfile = GFile(id=id,
-                          mimeType=file['mimeType'],
-                          webViewLink=file['webViewLink'],
-                          name=file['name'],
-                          parents=file['parents'],
-                          owners=file['owners'],
-                          team_file=None)
-            content_entry = ContentEntry(gfile=gfile,
-                                         is_folder=is_folder,
-                                         traverse=traverse,
-                                         contents=[],
+# Files that the plan dedups (see gxlib/dedup.py) are done last, once
+# the Team Drive IDs of the files they dedup against are known.  If
+# that file was not migrated in this run (e.g., the journal says it
+# was done before), the file is copied instead.
+#
+# worker_services: list of (admin_service, user_services) tuples, one
+#                  per apply worker
+# plan: plan hash (from load_plan())
+# team_drive: GFile
+def apply_plan_to_team_drive(worker_services, plan, team_drive):
+    admin_services = [ admin_service
+                       for (admin_service, _) in worker_services ]
+
+    # Folders: everything at a given depth can be made at once
+    folders      = plan['folders']
+    team_folders = [ None ] * len(folders)
+    def team_parent(item):
+        if item['parent'] is None:
+            return team_drive
+        return team_folders[item['parent']]
+
+    def make_folder(service, i):
+        team_folders[i] = make_or_resume_folder(service,
+                                                team_parent(folders[i]),
+                                                folders[i]['source'],
+                                                folders[i]['name'])
+
+    metrics.set_phase('folders')
+    start = 0
+    while start < len(folders):
+        depth = folders[start]['depth']
+        end   = start
+        while end < len(folders) and folders[end]['depth'] == depth:
+            end = end + 1
+
+        log.info("Making {0} folders at depth {1} in the Team Drive"
+                 .format(end - start, depth))
+        run_with_services(admin_services, range(start, end), make_folder)
+        start = end
+
+    # Files
+    files      = plan['files']
+    team_files = [ None ] * len(files)
+    def migrate_file(services, i):
+        (admin_service, user_services) = services
+        item      = files[i]
+        team_root = team_parent(item)
+        log.info('- Migrating "{file}" to Team drive'
+                 .format(file=item['name']))
+        if journal and journal.file_done(item['source'], team_root.id):
+            log.info("  Already migrated (according to the journal); skipping")
+            return
+
+        source_file_entry = ContentEntry(gfile=GFile(id=item['source'],
+                                                     webViewLink=None,
+                                                     mimeType=None,
+                                                     name=item['name'],
+                                                     owners=list(),
+                                                     parents=[ item['remove_parent'] ],
+                                                     team_file=None),
+                                         is_folder=False,
+                                         traverse=False,
+                                         contents=None,
                                          tree=None)
-            tree.contents.append(content_entry)
-
-            # JMS delete me
-            log.debug("Created gfile for content entry: {0}"
-                      .format(gfile))
-
-            # Save this file in the master list of *all* files found.
-            # Basically, add a parent listing to this ID in the
-            # all_files index.
-            parent_wvl = '<Unknown>'
-            if root_folder.id in all_files:
-                parent_wvl = all_files[root_folder.id].webViewLink
-
-            parent = Parent(id=root_folder.id, name=root_folder.name,
-                            name_abs=parent_folder_name_abs,
-                            webViewLink=parent_wvl)
-            all_files[id].parents.append(parent)
-
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+        if item['action'] not in (MOVE, COPY):
+            target_id = team_files[item['target']]
+            if target_id is not None:
+                action = dedup_file_to_team_drive(admin_service, team_root,
+                                                  source_file_entry,
+                                                  target_id,
+                                                  item['action'] == SHORTCUT,
+                                                  item['rename'])
+                if action:
+                    journal_file(source_file_entry, team_root, action)
+                    return
+
+        moved = False
+        if item['action'] == MOVE:
+            service = user_services.get(item['credential'], admin_service)
+            moved = move_file_to_team_drive(service, None, team_root,
+                                            None, source_file_entry)
+
+        if moved:
+            journal_file(source_file_entry, team_root, 'moved')
+            team_files[i] = item['source']
+        else:
+            log.info("  Looks like we have to COPY this file")
+            team_files[i] = copy_file_to_team_drive(admin_service, None,
+                                                    team_root, None,
+                                                    source_file_entry,
+                                                    rename=item['rename'])
+            journal_file(source_file_entry, team_root, 'copied')
+
+    migrate = [ i for i, item in enumerate(files)
+                if item['action'] in (MOVE, COPY) ]
+    deduped = [ i for i, item in enumerate(files)
+                if item['action'] not in (MOVE, COPY) ]
+
+    metrics.set_phase('files')
+    log.info("Migrating {0} files to the Team Drive"
+             .format(len(migrate)))
+    run_with_services(worker_services, migrate, migrate_file)
+    if deduped:
+        log.info("Deduplicating {0} files in the Team Drive"
+                 .format(len(deduped)))
+        run_with_services(worker_services, deduped, migrate_file)
 
-    # Traverse all the sub folders
-    for entry in tree.contents:
-        if entry.traverse:
-            new_prefix = '{0}/{1}'.format(parent_folder_name_abs,
-                                          entry.gfile.name)
-            log.debug("== Traversing down into {0}"
-                          .format(new_prefix))
-            (t, all_files) = read_source_tree(service,
-                                              parent_folder_name_abs,
-                                              entry.gfile, all_files)
-            entry.tree = t
-
-    # Done!
-    return (tree, all_files)
+#-------------------------------------------------------------------
+
+# The same as apply_plan_to_team_drive(), but with --backend asyncio
+# (see gxlib/aio.py): instead of --apply-workers threads, all the
+# folders at a given depth, and then all the files, are done on the
+# event loop, with up to --async-concurrency calls in flight at once.
+#
+# plan: plan hash (from load_plan(), or made by make_plan() right after
+#       the crawl)
+# team_drive: GFile
+def apply_plan_async(plan, team_drive):
+    admin_drive = async_drives[ADMIN]
+    tasks       = args.async_concurrency
+
+    folders      = plan['folders']
+    team_folders = [ None ] * len(folders)
+    def team_parent(item):
+        if item['parent'] is None:
+            return team_drive
+        return team_folders[item['parent']]
+
+    async def make_folder(i):
+        item   = folders[i]
+        parent = team_parent(item)
+        record = journal.folder(item['source'], parent.id) if journal else None
+        if record:
+            log.debug('--> Already made (according to the journal): "{0}" (ID: {1})'
+                      .format(record['name'], record['id']))
+            team_folders[i] = team_folder_gfile(record)
+            return
+
+        log.debug("Creating new folder {0}, parent {1} (ID: {2})"
+                  .format(item['name'], parent.name, parent.id))
+        folder = await admin_drive.create_folder(parent.id, item['name'])
+        log.debug('Created folder: "{0}" (ID: {1})'
+                  .format(folder['name'], folder['id']))
+        team_folders[i] = team_folder_gfile(folder)
+        if journal:
+            journal.record_folder(item['source'], parent.id,
+                                  team_folders[i])
+
+    def journal_item(item, team_root, action):
+        if journal:
+            journal.record_file(item['source'], team_root.id, action)
+
+    files      = plan['files']
+    team_files = [ None ] * len(files)
+    async def migrate_file(i):
+        item      = files[i]
+        team_root = team_parent(item)
+        name      = item['rename'] or item['name']
+        log.info('- Migrating "{file}" to Team drive'
+                 .format(file=item['name']))
+        if journal and journal.file_done(item['source'], team_root.id):
+            log.info("  Already migrated (according to the journal); skipping")
+            return
+
+        if item['action'] not in (MOVE, COPY):
+            target_id = team_files[item['target']]
+            if target_id is not None and item['action'] != SHORTCUT:
+                log.info("  Same contents as Team Drive file {0}; not copying it"
+                         .format(target_id))
+                journal_item(item, team_root, 'deduplicated')
+                return
+            if target_id is not None:
+                log.info("  Same contents as Team Drive file {0}; making a shortcut to it"
+                         .format(target_id))
+                if await admin_drive.create_shortcut(team_root.id, name,
+                                                     target_id):
+                    log.debug("--> Made shortcut")
+                    journal_item(item, team_root, 'shortcut')
+                    return
+                log.info("  Could not make a shortcut; copying it instead")
+
+        moved = False
+        if item['action'] == MOVE:
+            drive = async_drives.get(item['credential'], admin_drive)
+            moved = move_file_result(await drive.move_file(item['source'],
+                                                           team_root.id,
+                                                           item['remove_parent']))
+
+        if moved:
+            journal_item(item, team_root, 'moved')
+            team_files[i] = item['source']
+        else:
+            log.info("  Looks like we have to COPY this file")
+            team_files[i] = await admin_drive.copy_file(item['source'],
+                                                        team_root.id, name)
+            if team_files[i] is None:
+                # copy_file_result() would exit(1), which must not
+                # happen on the event loop
+                print("ERROR: Failed to copy file!")
+                raise aio.GaveUp()
+            log.debug("--> Copied")
+            journal_item(item, team_root, 'copied')
+
+    async def apply():
+        metrics.set_phase('folders')
+        start = 0
+        while start < len(folders):
+            depth = folders[start]['depth']
+            end   = start
+            while end < len(folders) and folders[end]['depth'] == depth:
+                end = end + 1
+
+            log.info("Making {0} folders at depth {1} in the Team Drive"
+                     .format(end - start, depth))
+            await aio.run_all(range(start, end), make_folder, tasks)
+            start = end
+
+        migrate = [ i for i, item in enumerate(files)
+                    if item['action'] in (MOVE, COPY) ]
+        deduped = [ i for i, item in enumerate(files)
+                    if item['action'] not in (MOVE, COPY) ]
+
+        metrics.set_phase('files')
+        log.info("Migrating {0} files to the Team Drive"
+                 .format(len(migrate)))
+        await aio.run_all(migrate, migrate_file, tasks)
+        if deduped:
+            log.info("Deduplicating {0} files in the Team Drive"
+                     .format(len(deduped)))
+            await aio.run_all(deduped, migrate_file, tasks)
+
+    async_backend.run(apply())
 
 #-------------------------------------------------------------------
 
@@ -600,6 +1066,7 @@ def create_team_drive(service, source_folder):
                                               requestId=u))
     log.info('Created Team Drive: "{0}" (ID: {1})'
           .format(source_folder.name, tdrive['id']))
+    remember_team_drives([ tdrive ])
 
     file = GFile(id=tdrive['id'], mimeType=team_drive_mime_type,
                  webViewLink=None,
@@ -612,51 +1079,44 @@ def create_team_drive(service, source_folder):
 #-------------------------------------------------------------------
 
 # Ensure there is no Team Drive of the same folder name
-def verify_no_team_drive_name(service, args, source_folder, name):
-    page_token = None
-    while True:
-        response = doit(service.teamdrives()
-                        .list(pageToken=page_token))
-        str = ("Looking for a Team Drive named '{name}'"
-               .format(name=source_folder.name))
-        if name:
-            str = str + (" or '{name}'"
-                         .format(name=name))
-        log.info(str)
-
-        for team_drive in response.get('teamDrives', []):
+#
+# exists_ok: if there is one, don't abort; return it instead
+def verify_no_team_drive_name(service, source_folder, name, exists_ok=False):
+    str = ("Looking for a Team Drive named '{name}'"
+           .format(name=source_folder.name))
+    if name:
+        str = str + (" or '{name}'"
+                     .format(name=name))
+    log.info(str)
+
+    # Server-side (or index) lookups by name; see gxlib/teamdrives.py
+    candidates = [ name ] if name else list()
+    if source_folder.name != name:
+        candidates.append(source_folder.name)
+    for candidate in candidates:
+        for team_drive in find_team_drives(service, candidate, by_id=False):
             log.debug("Checking existing team drive: {name}"
                       .format(name=team_drive['name']))
-            found = False
-            if name and team_drive['name'] == name:
-                found = True
-            elif team_drive['name'] == source_folder.name:
-                found = True
-
-            if found:
-                # By default, abort if a Team Drive of the same name
-                # already exists.  But if the user said it was ok,
-                # keep going if it already exists.
-                if args.debug_team_drive_already_exists_ok:
-                    log.info('Team Drive "{name}" already exists, but proceeding anyway...'
-                                 .format(name=source_folder.name))
-                    file = GFile(id=team_drive['id'],
-                                 mimeType=team_drive_mime_type,
-                                 webViewLink=None,
-                                 name=team_drive['name'],
-                                 owners=list(),
-                                 parents=['root'],
-                                 team_file=None)
-                    return file
-                else:
-                    log.error('Found existing Team Drive of same name as source folder: "{0}" (ID: {1})'
-                                  .format(source_folder.name, team_drive['id']))
-                    log.error("There cannot be an existing Team Drive with the same name as the source folder")
-                    exit(1)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+            # By default, abort if a Team Drive of the same name
+            # already exists.  But if the user said it was ok,
+            # keep going if it already exists.
+            if exists_ok:
+                log.info('Team Drive "{name}" already exists, but proceeding anyway...'
+                             .format(name=source_folder.name))
+                file = GFile(id=team_drive['id'],
+                             mimeType=team_drive_mime_type,
+                             webViewLink=None,
+                             name=team_drive['name'],
+                             owners=list(),
+                             parents=['root'],
+                             team_file=None)
+                return file
+            else:
+                log.error('Found existing Team Drive of same name as source folder: "{0}" (ID: {1})'
+                              .format(source_folder.name, team_drive['id']))
+                log.error("There cannot be an existing Team Drive with the same name as the source folder")
+                exit(1)
 
     # If we get here, we didn't find a team drive with the same name.
     # Yay!
@@ -697,8 +1157,7 @@ def verify_folder_id(service, id):
 
 def add_cli_args():
     tools.argparser.add_argument('--source-folder-id',
-                                 required=True,
-                                 help='Source folder ID')
+                                 help='Source folder ID (required, unless --manifest is used)')
     tools.argparser.add_argument('--dest-team-drive',
                                  help='Destinaton Team Drive name')
     tools.argparser.add_argument('--owning-domain',
@@ -722,10 +1181,111 @@ def add_cli_args():
                                  action='store_true',
                                  help='Go through the motions but make no actual changes')
 
+    tools.argparser.add_argument('--batch-size',
+                                 type=int,
+                                 default=0,
+                                 help='Send file moves/copies to Google in batches of up to this many calls per credential (max: 100; default: 0, meaning do not batch)')
+
+    tools.argparser.add_argument('--journal',
+                                 help='File to record the progress of the migration in, so that it can be resumed with --resume if it dies partway through (optional)')
+    tools.argparser.add_argument('--resume',
+                                 action='store_true',
+                                 help='Resume a migration that died partway through: skip everything that the --journal file says is already done')
+
+    tools.argparser.add_argument('--folder-workers',
+                                 type=int,
+                                 default=0,
+                                 help='Make all the folders in the Team Drive before moving/copying any files, making up to this many folders at a time (default: 0, meaning make folders one at a time as the files are migrated)')
+
+    tools.argparser.add_argument('--pipeline',
+                                 type=int,
+                                 default=0,
+                                 metavar='WORKERS',
+                                 help='Start migrating items as soon as they are found (instead of reading the whole source tree first), with this many migration workers (default: 0, meaning read the whole tree first)')
+    tools.argparser.add_argument('--pipeline-queue-size',
+                                 type=int,
+                                 default=1000,
+                                 help='Maximum number of found-but-not-yet-migrated items to hold in memory with --pipeline (default: 1000)')
+
+    tools.argparser.add_argument('--plan',
+                                 metavar='PLAN_FILE',
+                                 help='Read the source tree and write a plan of everything the migration would do (folders to make, files to move and with which credentials, files to copy) to this file; make no changes')
+    tools.argparser.add_argument('--apply',
+                                 metavar='PLAN_FILE',
+                                 help='Execute a plan written by --plan instead of reading the source tree')
+    tools.argparser.add_argument('--apply-workers',
+                                 type=int,
+                                 default=4,
+                                 help='Number of folders / files to migrate at a time with --apply (default: 4)')
+
+    tools.argparser.add_argument('--save-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Also save the source tree to this snapshot file (see gxlib/snapshot.py), so that a later run of this script or scan-and-report.py can use it with --from-snapshot instead of reading the tree again (optional)')
+    tools.argparser.add_argument('--from-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Read the source tree from this snapshot file (made with --save-snapshot by this script or scan-and-report.py) instead of from Google.  Anything that changed in the source folder since the snapshot was made is not migrated (optional)')
+
+    tools.argparser.add_argument('--manifest',
+                                 help='Migrate all the folders in this manifest (a CSV or YAML file of source_folder_id, dest_team_drive pairs; see gxlib/manifest.py) in this one run, instead of --source-folder-id / --dest-team-drive')
+    tools.argparser.add_argument('--manifest-workers',
+                                 type=int,
+                                 default=2,
+                                 help='Number of --manifest folders to migrate at a time (default: 2)')
+    tools.argparser.add_argument('--max-in-flight',
+                                 type=int,
+                                 default=0,
+                                 help='Maximum number of Google API calls in progress at once across all credentials and workers (e.g., of all the --manifest migrations); 0 means no limit (default: 0)')
+
+    tools.argparser.add_argument('--backend',
+                                 choices=['threads', 'asyncio'],
+                                 default='threads',
+                                 help='How to make the Google API calls for reading the source tree and migrating it: blocking calls in worker threads, or non-blocking calls on an asyncio event loop (needs aiohttp; see gxlib/aio.py) (default: threads)')
+    tools.argparser.add_argument('--async-concurrency',
+                                 type=int,
+                                 default=100,
+                                 help='Maximum number of Google API calls in progress at once with --backend asyncio (default: 100)')
+
     tools.argparser.add_argument('--copy-all',
                                  action='store_true',
                                  help='Instead of moving files that are capable of being moved to the new Team Drive, *copy* all files to the new Team Drive')
 
+    tools.argparser.add_argument('--crawl-workers',
+                                 type=int,
+                                 default=1,
+                                 help='Number of folders to list in parallel when reading the source tree (default: 1)')
+
+    tools.argparser.add_argument('--crawl-mode',
+                                 choices=['folders', 'corpus'],
+                                 default='folders',
+                                 help='How to read the source tree: list it folder-by-folder, or list every file we can see in one pass and rebuild the tree locally (default: folders)')
+
+    tools.argparser.add_argument('--api-rate-limit',
+                                 type=float,
+                                 default=default_rate,
+                                 help='Maximum Google API calls per second per credential; 0 means no limit (default: {0})'.format(default_rate))
+    tools.argparser.add_argument('--team-drive-cache-ttl',
+                                 type=float,
+                                 default=default_index_ttl,
+                                 help='Seconds to keep entries in the local index of Team Drive names and IDs for (it saves a Google API call when looking a Team Drive up by name; anything found is still checked with Google); 0 means no index (default: {0})'.format(default_index_ttl))
+    tools.argparser.add_argument('--spread-calls',
+                                 action='store_true',
+                                 help='Spread Google API calls (including reading the source tree) across the admin and all the --user-credentials, sending each call with whichever allowed credential has the most quota left')
+    tools.argparser.add_argument('--dedup',
+                                 choices=dedup.modes,
+                                 help='Copy files with the same contents (same MD5 checksum and size) to the Team Drive only once: make the others Drive shortcuts to that copy ("shortcut"), or leave them out ("once") (default: copy every file)')
+
+    tools.argparser.add_argument('--progress',
+                                 action='store_true',
+                                 help='Print a line of Google API call statistics every --metrics-interval seconds')
+    tools.argparser.add_argument('--metrics-interval',
+                                 type=float,
+                                 default=30,
+                                 help='Seconds between --progress lines and --metrics-textfile updates (default: 30)')
+    tools.argparser.add_argument('--metrics-textfile',
+                                 help='Keep Prometheus-format Google API call statistics in this file (e.g., for the node_exporter textfile collector)')
+    tools.argparser.add_argument('--metrics-json',
+                                 help='Write a JSON summary of Google API call statistics to this file at exit')
+
     tools.argparser.add_argument('--verbose',
                                  action='store_true',
                                  help='Be a bit verbose in what the script is doing')
@@ -742,47 +1302,94 @@ def add_cli_args():
     global args
     args = tools.argparser.parse_args()
 
+    if args.manifest:
+        if args.source_folder_id or args.dest_team_drive:
+            print("ERROR: --manifest cannot be used with --source-folder-id or --dest-team-drive")
+            exit(1)
+        if args.plan or args.apply:
+            print("ERROR: --manifest cannot be used with --plan or --apply")
+            exit(1)
+        if args.dedup:
+            print("ERROR: --manifest cannot be used with --dedup")
+            exit(1)
+        if args.manifest_workers < 1:
+            print("ERROR: --manifest-workers must be at least 1")
+            exit(1)
+    elif not args.source_folder_id:
+        print("ERROR: --source-folder-id or --manifest is required")
+        exit(1)
+
     if args.dest_team_drive:
         args.debug_team_drive_already_exists_ok = True
 
-    # Put a "@" on the owning domain, just to make comparisons easier
-    # later
-    args.owning_domain = '@' + args.owning_domain
+    if args.resume and not args.journal:
+        print("ERROR: --resume requires --journal")
+        exit(1)
+    if args.pipeline and (args.batch_size or args.folder_workers):
+        print("ERROR: --pipeline cannot be used with --batch-size or --folder-workers")
+        exit(1)
 
-#-------------------------------------------------------------------
+    if args.plan and args.apply:
+        print("ERROR: --plan and --apply cannot be used together")
+        exit(1)
+    if ((args.plan or args.apply) and
+        (args.pipeline or args.batch_size or args.folder_workers)):
+        print("ERROR: --plan and --apply cannot be used with --pipeline, --batch-size, or --folder-workers")
+        exit(1)
+    if (args.plan or args.apply) and args.spread_calls:
+        print("ERROR: --spread-calls cannot be used with --plan or --apply")
+        exit(1)
+    if args.apply and args.dedup:
+        print("ERROR: --dedup cannot be used with --apply (use it with --plan)")
+        exit(1)
 
-def main():
-    add_cli_args()
+    if args.from_snapshot and args.save_snapshot:
+        print("ERROR: --from-snapshot and --save-snapshot cannot be used together")
+        exit(1)
+    if ((args.from_snapshot or args.save_snapshot) and
+        (args.manifest or args.pipeline or args.apply)):
+        print("ERROR: --from-snapshot and --save-snapshot cannot be used with --manifest, --pipeline, or --apply")
+        exit(1)
 
-    # Setup logging
-    setup_logging(args)
+    if args.backend == 'asyncio':
+        if (args.pipeline or args.batch_size or args.folder_workers or
+            args.spread_calls or args.manifest):
+            print("ERROR: --backend asyncio cannot be used with --pipeline, --batch-size, --folder-workers, --spread-calls, or --manifest")
+            exit(1)
+        if args.crawl_mode != 'folders':
+            print("ERROR: --backend asyncio only reads the source tree with --crawl-mode folders")
+            exit(1)
+        if args.async_concurrency < 1:
+            print("ERROR: --async-concurrency must be at least 1")
+            exit(1)
+
+    # Planning never changes anything
+    if args.plan:
+        args.dry_run = True
 
-    # Authorize the app and provide user consent to Google
-    app_cred = load_app_credentials(args.app_id)
+    # Put a "@" on the owning domain, just to make comparisons easier
+    # later
+    args.owning_domain = '@' + args.owning_domain
 
-    log.info("Authtenticating as administrator...")
-    admin_cred = load_user_credentials(args.admin_credentials,
-                                       scope, app_cred)
-    admin_service = authorize(admin_cred)
+#-------------------------------------------------------------------
 
-    user_services = list()
-    if args.user_credentials:
-        for vals in args.user_credentials:
-            email    = vals[0]
-            filename = vals[1]
-            log.info("Authenticating as user: {filename}"
-                     .format(filename=filename))
-            user_cred = load_user_credentials(filename,
-                                              scope, app_cred)
-            user_services.append({
-                'service' : authorize(user_cred),
-                'address' : email,
-            })
+# Migrate one source folder to a Team Drive (or with --plan, plan it,
+# or with --dry-run, check it).
+#
+# dest_team_drive: name of an existing Team Drive to migrate into, or
+#                  None to make one named after the source folder
+# plan: plan hash to execute (from load_plan()), or None
+# snapshot: Snapshot to read the source tree from (from
+#           open_snapshot()), or None to crawl it
+def migrate_source_folder(admin_service, user_services, source_folder_id,
+                          dest_team_drive=None, plan=None, snapshot=None):
+    exists_ok = (args.debug_team_drive_already_exists_ok or
+                 bool(dest_team_drive))
 
     # Verify source folder ID.  Do this up front, before doing
     # expensive / slow things.
     source_folder = verify_folder_id(admin_service,
-                                     id=args.source_folder_id)
+                                     id=source_folder_id)
 
     log.debug("Source folder is: {0}".format(source_folder))
 
@@ -790,14 +1397,106 @@ def main():
     # source tree.
     team_drive = None
     if not args.dry_run:
+        # If we're resuming, we already know the Team Drive
+        record = journal.team_drive(source_folder.id) if journal else None
+        if record:
+            log.info('Resuming migration to Team Drive "{0}" (ID: {1})'
+                     .format(record['name'], record['id']))
+            team_drive = GFile(id=record['id'],
+                               mimeType=team_drive_mime_type,
+                               webViewLink=None,
+                               name=record['name'],
+                               owners=list(),
+                               parents=['root'],
+                               team_file=None)
+
         # Otherwise, find the Team Drive, if it already exists
-        team_drive = verify_no_team_drive_name(admin_service, args,
-                                               source_folder,
-                                               name=args.dest_team_drive)
+        else:
+            team_drive = verify_no_team_drive_name(admin_service,
+                                                   source_folder,
+                                                   name=dest_team_drive,
+                                                   exists_ok=exists_ok)
+
+    # If we're executing a plan, there's no need to read the source
+    # tree
+    if plan:
+        if args.dry_run:
+            print_plan_summary(plan)
+            log.info("DRY RUN -- done!")
+            return 0
+        if team_drive is None:
+            team_drive = create_team_drive(admin_service, source_folder)
+        if journal and not journal.team_drive(source_folder.id):
+            journal.record_team_drive(source_folder.id, team_drive)
+
+        # The services are thread safe, so all the apply workers can
+        # share them
+        worker_services = [ (admin_service,
+                             { us['address'] : us['service']
+                               for us in user_services }) ] * args.apply_workers
+
+        if async_backend:
+            apply_plan_async(plan, team_drive)
+        else:
+            apply_plan_to_team_drive(worker_services, plan, team_drive)
+        return 0
 
-    # Read the source tree
-    (source_root, all_files) = read_source_tree(admin_service, '',
-                                                source_folder)
+    # The admin service is thread safe, so all the crawl workers can
+    # share it
+    crawl_services = [admin_service] * args.crawl_workers
+
+    # In pipeline mode, crawl and migrate at the same time
+    if args.pipeline and not args.dry_run:
+        if team_drive is None:
+            team_drive = create_team_drive(admin_service, source_folder)
+        if journal and not journal.team_drive(source_folder.id):
+            journal.record_team_drive(source_folder.id, team_drive)
+
+        # The services are thread safe, so all the migration workers
+        # can share them
+        worker_services = [ (admin_service, user_services) ] * args.pipeline
+
+        metrics.set_phase('pipeline')
+        pipeline_migrate_to_team_drive(crawl_services, worker_services,
+                                       args.owning_domain, source_folder,
+                                       team_drive, args.pipeline_queue_size)
+        return 0
+
+    # Read the source tree (or rebuild it from the snapshot)
+    fetcher = None
+    if snapshot:
+        fetcher = snapshot.fetcher()
+    elif async_backend:
+        fetcher = aio.AsyncFolderFetcher(async_drives[ADMIN],
+                                         tasks=args.async_concurrency)
+    snapshot_writer = None
+    if args.save_snapshot:
+        snapshot_writer = SnapshotWriter(args.save_snapshot, source_folder,
+                                         tool='gxcopy.py')
+    metrics.set_phase('crawl')
+    (source_root, all_files) = read_source_tree(crawl_services, '',
+                                                source_folder,
+                                                corpus=(args.crawl_mode == 'corpus'),
+                                                listings=snapshot_writer,
+                                                scheduler=scheduler,
+                                                dedup=dedup_index,
+                                                fetcher=fetcher)
+    if snapshot_writer:
+        snapshot_writer.close()
+
+    # If we're planning (or migrating with --backend asyncio, which
+    # executes a plan), make the plan
+    if args.plan or async_backend:
+        plan = make_plan(source_root, args.owning_domain,
+                         [ us['address'] for us in user_services ],
+                         team_drive_name=dest_team_drive,
+                         dedup=dedup_index, dedup_mode=args.dedup)
+
+    # If we're planning, write the plan and we're done
+    if args.plan:
+        save_plan(args.plan, plan)
+        print_plan_summary(plan)
+        return 0
 
     # If dry run, we're done
     if args.dry_run:
@@ -812,13 +1511,246 @@ def main():
     # Make a Team Drive of the same folder name
     if team_drive is None:
         team_drive = create_team_drive(admin_service, source_folder)
+    if journal and not journal.team_drive(source_folder.id):
+        journal.record_team_drive(source_folder.id, team_drive)
+
+    if async_backend:
+        apply_plan_async(plan, team_drive)
+        return 0
+
+    # Make all the folders first, if requested
+    if args.folder_workers > 0:
+        folder_services = [admin_service] * args.folder_workers
+        metrics.set_phase('folders')
+        make_folder_skeleton_in_team_drive(folder_services, source_root,
+                                           team_drive, all_files)
 
     # Do it
+    batch = None
+    if args.batch_size > 0:
+        batch = BatchQueue(args.batch_size)
+    metrics.set_phase('migrate')
     migrate_folder_to_team_drive(admin_service, user_services,
                                  args.owning_domain,
-                                 source_root, team_drive, all_files)
+                                 source_root, team_drive, all_files,
+                                 batch)
+    if batch:
+        batch.flush()
+    return 0
+
+#-------------------------------------------------------------------
+
+# Migrate every folder in the manifest (see gxlib/manifest.py), up to
+# --manifest-workers of them at a time.  They all share the same
+# credentials / services (and so the same connection pools and
+# per-credential rate limits), the same Team Drive index, and the same
+# journal.
+#
+# A migration that fails (e.g., because its Team Drive already exists)
+# doesn't stop the others.  Returns 0 if they all worked, 1 otherwise.
+def run_manifest(admin_service, user_services, manifest):
+    todo    = queue.Queue()
+    results = [ None ] * len(manifest)
+    for i, entry in enumerate(manifest):
+        todo.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            entry = manifest[i]
+            threading.current_thread().name = entry['source_folder_id']
+            log.info("Migrating source folder {0} ({1} of {2})"
+                     .format(entry['source_folder_id'], i + 1,
+                             len(manifest)))
+            try:
+                migrate_source_folder(admin_service, user_services,
+                                      entry['source_folder_id'],
+                                      entry['dest_team_drive'])
+                results[i] = 'OK'
+            except SystemExit:
+                # The reason was already logged
+                results[i] = 'FAILED'
+            except Exception as e:
+                log.error("Migration of source folder {0} failed: {1}"
+                          .format(entry['source_folder_id'], e))
+                log.debug(traceback.format_exc())
+                results[i] = 'FAILED: {0}'.format(e)
+
+    threads = list()
+    for n in range(min(args.manifest_workers, len(manifest))):
+        t = threading.Thread(target=worker,
+                             name='manifest-worker-{0}'.format(n),
+                             daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    print("Manifest {0}:".format(args.manifest))
+    for entry, result in zip(manifest, results):
+        print("  {0} -> {1}: {2}"
+              .format(entry['source_folder_id'],
+                      entry['dest_team_drive'] or '(new Team Drive)',
+                      result))
+
+    if all(result == 'OK' for result in results):
+        return 0
+    return 1
+
+#-------------------------------------------------------------------
+
+def main():
+    add_cli_args()
+
+    # Setup logging
+    setup_logging(args)
+
+    # Read the manifest up front, so that a bad one doesn't waste a
+    # login
+    manifest = None
+    if args.manifest:
+        try:
+            manifest = load_manifest(args.manifest)
+        except (IOError, ValueError) as e:
+            diediedie("Cannot read manifest {0}: {1}".format(args.manifest, e))
+        log.info("Manifest {0}: {1} folders to migrate"
+                 .format(args.manifest, len(manifest)))
+
+    # Load the plan up front, so that we can check that we have all the
+    # credentials that it needs before doing anything else
+    plan = None
+    if args.apply:
+        try:
+            plan = load_plan(args.apply)
+        except (IOError, ValueError) as e:
+            diediedie("Cannot read plan {0}: {1}".format(args.apply, e))
+        if plan['source_folder']['id'] != args.source_folder_id:
+            diediedie("Plan {0} is for source folder ID {1}, not {2}"
+                      .format(args.apply, plan['source_folder']['id'],
+                              args.source_folder_id))
+
+        # Migrate into the Team Drive that the plan was made for
+        dest_team_drive = planned_team_drive(plan)
+        if args.dest_team_drive and args.dest_team_drive != dest_team_drive:
+            diediedie('Plan {0} is for {1}, not Team Drive "{2}"'
+                      .format(args.apply,
+                              'Team Drive "{0}"'.format(dest_team_drive)
+                              if dest_team_drive
+                              else 'a new Team Drive named after the source folder',
+                              args.dest_team_drive))
+        if dest_team_drive:
+            args.dest_team_drive = dest_team_drive
+            args.debug_team_drive_already_exists_ok = True
+
+        addresses = set(vals[0] for vals in (args.user_credentials or []))
+        missing = set(file['credential'] for file in plan['files']
+                      if file['action'] == MOVE and
+                      file['credential'] != ADMIN and
+                      file['credential'] not in addresses)
+        if missing:
+            diediedie("Plan {0} needs --user-credentials for: {1}"
+                      .format(args.apply, ', '.join(sorted(missing))))
+
+    # Open the snapshot up front too
+    snapshot = None
+    if args.from_snapshot:
+        try:
+            snapshot = open_snapshot(args.from_snapshot,
+                                     root_id=args.source_folder_id)
+        except ValueError as e:
+            diediedie("Cannot use snapshot {0}: {1}"
+                      .format(args.from_snapshot, e))
+
+    # Keep track of where the Google API calls go
+    metrics.start_reporting(interval=args.metrics_interval,
+                            progress=args.progress,
+                            textfile=args.metrics_textfile,
+                            json_file=args.metrics_json)
+
+    # Authorize the app and provide user consent to Google
+    set_rate_limit(args.api_rate_limit)
+    set_max_in_flight(args.max_in_flight)
+    set_index_ttl(args.team_drive_cache_ttl)
+    app_cred = load_app_credentials(args.app_id)
+
+    # Planning only needs the user email addresses, not their
+    # credentials
+    cred_files = [ ('admin', args.admin_credentials) ]
+    if args.user_credentials and not args.plan:
+        cred_files.extend((vals[0], vals[1])
+                          for vals in args.user_credentials)
+
+    log.info("Authtenticating as administrator and {0} users..."
+             .format(len(cred_files) - 1))
+    creds    = load_all_user_credentials(cred_files, scope, app_cred)
+    services = authorize_all(creds, [ name for (name, _) in cred_files ])
+    admin_cred    = creds[0]
+    admin_service = services[0]
+
+    user_services = list()
+    if args.user_credentials and args.plan:
+        user_services = [ { 'service' : None, 'address' : vals[0] }
+                          for vals in args.user_credentials ]
+    else:
+        for ((email, _), user_cred, service) in zip(cred_files[1:], creds[1:],
+                                                    services[1:]):
+            user_services.append({
+                'service'     : service,
+                'address'     : email,
+                'credentials' : user_cred,
+            })
+
+    # Send calls with whichever credential has the most quota left
+    if args.spread_calls:
+        global scheduler
+        scheduler = QuotaScheduler(admin_service, user_services)
+
+    # Note the contents of every file as the source tree is read
+    if args.dedup:
+        global dedup_index
+        dedup_index = dedup.DedupIndex()
+
+    # Make the calls on an event loop instead of in threads
+    if args.backend == 'asyncio':
+        global aio, async_backend, async_drives
+        try:
+            from gxlib import aio
+        except ImportError:
+            diediedie("--backend asyncio needs aiohttp (pip install --upgrade aiohttp)")
+        async_backend = aio.AsyncBackend(args.async_concurrency)
+        # cred_files' first name is ADMIN
+        async_drives  = { name : async_backend.drive(cred)
+                          for ((name, _), cred) in zip(cred_files, creds) }
+
+    # Open the journal, if we're keeping one
+    global journal
+    if args.journal and not args.dry_run:
+        if (not args.resume and os.path.exists(args.journal) and
+            os.path.getsize(args.journal) > 0):
+            diediedie("Journal {0} already exists; use --resume to pick up where it left off (or remove it to start over)"
+                      .format(args.journal))
+        journal = Journal(args.journal, resume=args.resume)
+
+    # Migrate everything in the manifest, or just the one folder
+    if args.manifest:
+        status = run_manifest(admin_service, user_services, manifest)
+    else:
+        status = migrate_source_folder(admin_service, user_services,
+                                       args.source_folder_id,
+                                       args.dest_team_drive, plan, snapshot)
+    if journal:
+        journal.close()
+    if async_backend:
+        async_backend.close()
+    if snapshot:
+        snapshot.close()
 
     log.debug("END OF MAIN")
+    return status
 
 if __name__ == '__main__':
     exit(main())
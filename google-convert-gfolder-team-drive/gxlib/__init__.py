@@ -0,0 +1,9 @@
+"""Code shared between the Google Folder -> Team Drive scripts in this
+directory (gxcopy.py, scan-and-report.py, find-multifiles.py,
+verify-migration.py).
+
+The scripts themselves have dashes in their names, so they cannot
+import each other.  Anything that more than one of them needs lives
+in here instead of being copied-n-pasted between them.
+
+"""
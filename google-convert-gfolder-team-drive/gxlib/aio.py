@@ -0,0 +1,472 @@
+"""An optional asyncio backend for the Drive calls that a migration makes.
+
+Everything else in gxlib is built on googleapiclient's blocking
+execute(), so the only way to have N calls in flight is N threads.
+This module makes the handful of calls that a crawl and a migration
+need -- listing a folder, making a folder, and moving / copying a
+file (plus making a shortcut, for --dedup plans) -- straight to the
+Drive REST API with aiohttp instead, so that hundreds of calls can be
+in flight at once on one event loop in one thread.
+
+An AsyncBackend runs the event loop in a thread of its own; the rest
+of the (blocking) code hands it coroutines with run().  Each
+credential gets an AsyncDrive, which:
+
+- retries calls exactly like doit() in gxlib/api.py does (and counts
+  them in gxlib/metrics.py the same way),
+- takes calls out of the same per-credential token buckets as the
+  googleapiclient calls (without blocking the event loop),
+- refreshes the credential's access token shortly before it expires,
+  without blocking the event loop either.
+
+AsyncFolderFetcher is a fetcher for build_tree() in gxlib/crawl.py
+(i.e., read_source_tree(..., fetcher=...)), so the tree that comes out
+is exactly the same as with the threaded crawl.
+
+Needs aiohttp (pip install --upgrade aiohttp).
+
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import asyncio
+import logging
+import datetime
+import itertools
+import threading
+import concurrent.futures
+
+import aiohttp
+import httplib2
+
+from googleapiclient.errors import HttpError
+
+from gxlib import metrics
+from gxlib.api import classify_error, backoff_delay, error_reason
+from gxlib.api import call_outcome, credential_bucket, drive_api_url_env
+from gxlib.api import max_tries, RETRY, FAIL
+from gxlib.crawl import list_fields, team_drive_list_fields
+from gxlib.crawl import URGENT, PREFETCH
+from gxlib.records import folder_mime_type
+from gxlib.transport import refresh_margin
+
+log = logging.getLogger('FToTD')
+
+# Default number of calls in flight at once (across all credentials)
+default_max_in_flight = 100
+
+# Default number of folders being listed at once by an
+# AsyncFolderFetcher
+default_crawl_tasks = 64
+
+drive_api_url = 'https://www.googleapis.com/'
+service_path  = 'drive/v3/'
+
+folder_fields = 'id,name,mimeType,parents,webViewLink'
+
+#-------------------------------------------------------------------
+
+# A call that failed max_tries times.  AsyncBackend.run() turns this
+# into the same sys.exit(1) that doit() does, in the calling thread
+# (raising SystemExit inside the event loop would stop the loop
+# instead).
+class GaveUp(Exception):
+    pass
+
+# The event loop (in a thread of its own), the aiohttp session, and
+# the cap on calls in flight
+class AsyncBackend:
+    def __init__(self, max_in_flight=default_max_in_flight):
+        url = drive_api_url
+        if drive_api_url_env in os.environ:
+            url = os.environ[drive_api_url_env]
+            log.info("Using Drive API at {0}".format(url))
+        self.base_url = url.rstrip('/') + '/' + service_path
+
+        self.loop    = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='asyncio-backend',
+                                        daemon=True)
+        self._thread.start()
+
+        async def setup():
+            connector = aiohttp.TCPConnector(limit=max_in_flight)
+            self.session   = aiohttp.ClientSession(connector=connector)
+            self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.run(setup())
+
+    # An AsyncDrive for this credential (as loaded by
+    # load_user_credentials(), and already authorized, so that it has
+    # a name in the metrics)
+    def drive(self, credentials):
+        return AsyncDrive(self, credentials)
+
+    # Schedule a coroutine on the event loop.  Returns a
+    # concurrent.futures.Future.  Can be called from any thread
+    # (including the event loop's).
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # Run a coroutine on the event loop, and wait for its result
+    def run(self, coro):
+        try:
+            return self.submit(coro).result()
+        except GaveUp:
+            sys.exit(1)
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+#-------------------------------------------------------------------
+
+# Drive's query parameters are strings
+def _params(params):
+    out = dict()
+    for key, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        out[key] = str(value)
+    return out
+
+class AsyncDrive:
+    def __init__(self, backend, credentials):
+        self.backend     = backend
+        self.credentials = credentials
+        self.name        = metrics.credentials_name(credentials)
+        self._bucket     = credential_bucket(credentials)
+        self._refreshing = None     # asyncio.Lock, made on the loop
+
+    #---------------------------------------------------------------
+
+    def _needs_refresh(self):
+        expiry = getattr(self.credentials, 'token_expiry', None)
+        if self.credentials.access_token is None:
+            return True
+        if expiry is None:
+            return False
+        return datetime.datetime.utcnow() + refresh_margin >= expiry
+
+    # The same thing that credentials.refresh() does, but with aiohttp
+    async def _refresh(self):
+        credentials = self.credentials
+        log.debug("Refreshing access token for {0}".format(self.name))
+        body = { 'grant_type'    : 'refresh_token',
+                 'refresh_token' : credentials.refresh_token,
+                 'client_id'     : credentials.client_id,
+                 'client_secret' : credentials.client_secret }
+        async with self.backend.session.post(credentials.token_uri,
+                                             data=body) as resp:
+            content = await resp.read()
+        if resp.status != 200:
+            log.error("Error: could not refresh the access token for {0} (HTTP status {1})"
+                      .format(self.name, resp.status))
+            raise GaveUp()
+
+        token = json.loads(content.decode('utf-8'))
+        credentials.access_token = token['access_token']
+        credentials.token_expiry = (datetime.datetime.utcnow() +
+                                    datetime.timedelta(seconds=int(token.get('expires_in', 3600))))
+        if 'refresh_token' in token:
+            credentials.refresh_token = token['refresh_token']
+        credentials.invalid = False
+        if getattr(credentials, 'store', None):
+            credentials.store.locked_put(credentials)
+
+    async def _access_token(self, force=False):
+        if self._refreshing is None:
+            self._refreshing = asyncio.Lock()
+        if force or self._needs_refresh():
+            old = self.credentials.access_token
+            async with self._refreshing:
+                # Someone else may have just done it
+                if self.credentials.access_token == old:
+                    await self._refresh()
+        return self.credentials.access_token
+
+    #---------------------------------------------------------------
+
+    # Make one Drive API call, retrying it like doit() does.  Returns
+    # the response (a hash), or None if it failed and can_fail allows
+    # that (see classify_error()).
+    #
+    # method: e.g., 'files.list', for the metrics
+    async def call(self, method, http_method, path, params,
+                   body=None, can_fail=False):
+        url     = self.backend.base_url + path
+        params  = _params(params)
+        refresh = False
+
+        count = 0
+        while count < max_tries:
+            if self._bucket:
+                await asyncio.sleep(self._bucket.reserve())
+            token   = await self._access_token(force=refresh)
+            refresh = False
+            headers = { 'Authorization' : 'Bearer ' + token }
+
+            start = time.monotonic()
+            try:
+                async with self.backend.in_flight:
+                    async with self.backend.session.request(http_method, url,
+                                                            params=params,
+                                                            json=body,
+                                                            headers=headers) as resp:
+                        status  = resp.status
+                        content = await resp.read()
+                        resp_headers = dict(resp.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.record(method, self.name, metrics.ERROR,
+                               time.monotonic() - start)
+                log.error("*** Some unknown error occurred: {0}".format(e))
+                raise
+            latency = time.monotonic() - start
+
+            if status < 300:
+                metrics.record(method, self.name, metrics.SUCCESS, latency)
+                if not content:
+                    return dict()
+                return json.loads(content.decode('utf-8'))
+
+            # The access token expired early (or was revoked): get a
+            # new one and try again
+            if status == 401 and count == 0:
+                metrics.record(method, self.name, metrics.RETRY, latency)
+                refresh = True
+                count   = count + 1
+                continue
+
+            resp_headers['status'] = str(status)
+            err = HttpError(httplib2.Response(resp_headers), content,
+                            uri=url)
+            log.debug("*** Got HttpError: {0}".format(err))
+            action = classify_error(err, can_fail)
+            metrics.record(method, self.name,
+                           call_outcome(action, count + 1), latency)
+            if action == RETRY:
+                delay = backoff_delay(count, err)
+                log.debug("*** Seems recoverable (status {0}, reason {1}); let's sleep {2:.1f} seconds and try again..."
+                          .format(status, error_reason(err), delay))
+                if self._bucket:
+                    # Everyone using this credential needs to back off
+                    self._bucket.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                count = count + 1
+                continue
+            elif action == FAIL:
+                log.debug("*** Got a {0}, but we're allowed to fail this call".format(status))
+                return None
+            else:
+                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(status))
+                raise err
+
+        log.error("Error: we failed this {0} times; there's no reason to believe it'll work if we do it again..."
+                  .format(max_tries))
+        raise GaveUp()
+
+    #---------------------------------------------------------------
+
+    # Same as list_folder() in gxlib/crawl.py
+    async def list_folder(self, folder_id, team_drive_id=None):
+        params = { 'q'                  : "'{0}' in parents and trashed=false".format(folder_id),
+                   'spaces'             : 'drive',
+                   'supportsTeamDrives' : True }
+        if team_drive_id:
+            params.update(corpora='teamDrive',
+                          fields=team_drive_list_fields,
+                          teamDriveId=team_drive_id,
+                          includeTeamDriveItems=True)
+        else:
+            params.update(corpora='user',
+                          fields=list_fields)
+
+        files = list()
+        while True:
+            response = await self.call('files.list', 'GET', 'files', params)
+            files.extend(response.get('files', []))
+
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+            params['pageToken'] = page_token
+
+        return files
+
+    # Make a folder.  Returns the new folder's id, name, mimeType,
+    # parents, and webViewLink.
+    async def create_folder(self, parent_id, name):
+        return await self.call('files.create', 'POST', 'files',
+                               { 'supportsTeamDrives' : True,
+                                 'fields'             : folder_fields },
+                               body={ 'name'     : name,
+                                      'mimeType' : folder_mime_type,
+                                      'parents'  : [ parent_id ] })
+
+    # Move a file into a (Team Drive) folder.  Returns None if we're
+    # not allowed to.
+    async def move_file(self, file_id, add_parent, remove_parent):
+        return await self.call('files.update', 'PATCH',
+                               'files/{0}'.format(file_id),
+                               { 'addParents'         : add_parent,
+                                 'removeParents'      : remove_parent,
+                                 'supportsTeamDrives' : True,
+                                 'fields'             : 'id' },
+                               body=dict(),
+                               can_fail=True)
+
+    # Copy a file into a (Team Drive) folder.  Returns the copy's ID, or
+    # None if we're not allowed to.
+    async def copy_file(self, file_id, parent_id, name):
+        copied = await self.call('files.copy', 'POST',
+                                 'files/{0}/copy'.format(file_id),
+                                 { 'supportsTeamDrives' : True,
+                                   'fields'             : 'id' },
+                                 body={ 'parents' : [ parent_id ],
+                                        'name'    : name },
+                                 can_fail=True)
+        return copied['id'] if copied else None
+
+    # Make a Drive shortcut to target_id (see gxlib/dedup.py).  Returns
+    # the shortcut's ID, or None if we're not allowed to.
+    async def create_shortcut(self, parent_id, name, target_id):
+        # Not imported at the top: gxlib.dedup doesn't need aiohttp, but
+        # keep this module's imports to what the crawl needs
+        from gxlib.dedup import shortcut_mime_type
+
+        made = await self.call('files.create', 'POST', 'files',
+                               { 'supportsTeamDrives' : True,
+                                 'fields'             : 'id' },
+                               body={ 'name'            : name,
+                                      'mimeType'        : shortcut_mime_type,
+                                      'parents'         : [ parent_id ],
+                                      'shortcutDetails' : { 'targetId' : target_id } },
+                               can_fail=True)
+        return made['id'] if made else None
+
+#-------------------------------------------------------------------
+
+# A fetcher for build_tree() (see FolderFetcher in gxlib/crawl.py)
+# that lists folders with tasks on the event loop instead of threads.
+#
+# There are `tasks` listing tasks pulling folder IDs off a priority
+# queue.  Whenever a folder has been listed, its sub folders are
+# queued up to be prefetched (breadth first); when the main thread
+# asks for a folder that hasn't been listed yet, it goes to the front
+# of the queue.
+class AsyncFolderFetcher:
+    def __init__(self, drive, team_drive_id=None, tasks=default_crawl_tasks):
+        self.drive         = drive
+        self.team_drive_id = team_drive_id
+        self._backend      = drive.backend
+
+        self._lock     = threading.Lock()
+        self._queue    = list()    # heap of (priority, seq, folder ID)
+        self._seq      = itertools.count()
+        self._results  = dict()    # ID -> concurrent.futures.Future
+        self._started  = set()     # IDs that a task has picked up
+        self._wakeup   = None      # asyncio.Event, made on the loop
+        self._shutdown = False
+
+        async def setup():
+            self._wakeup = asyncio.Event()
+        self._backend.run(setup())
+        self._tasks = [ self._backend.submit(self._task())
+                        for i in range(tasks) ]
+
+    # Queue a folder up (if it isn't already).  Returns the Future of
+    # its listing.  Can be called from any thread.
+    def _push(self, priority, folder_id):
+        with self._lock:
+            future = self._results.get(folder_id, None)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._results[folder_id] = future
+            elif priority == PREFETCH or folder_id in self._started:
+                return future
+
+            heapq.heappush(self._queue, (priority, next(self._seq), folder_id))
+        self._backend.loop.call_soon_threadsafe(self._wakeup.set)
+        return future
+
+    def request(self, folder_id):
+        self._push(PREFETCH, folder_id)
+
+    def get(self, folder_id):
+        files = self._push(URGENT, folder_id).result()
+        # If we're asked for this folder again, fetch it again
+        with self._lock:
+            self._results.pop(folder_id, None)
+            self._started.discard(folder_id)
+        return files
+
+    def close(self):
+        self._shutdown = True
+        self._backend.loop.call_soon_threadsafe(self._wakeup.set)
+        for task in self._tasks:
+            task.result()
+
+    async def _task(self):
+        while True:
+            with self._lock:
+                item = None
+                while self._queue:
+                    (_, _, folder_id) = heapq.heappop(self._queue)
+                    if folder_id not in self._started:
+                        self._started.add(folder_id)
+                        item = (folder_id, self._results[folder_id])
+                        break
+                if item is None:
+                    if self._shutdown:
+                        return
+                    self._wakeup.clear()
+
+            if item is None:
+                await self._wakeup.wait()
+                continue
+
+            (folder_id, future) = item
+            try:
+                files = await self.drive.list_folder(folder_id,
+                                                     self.team_drive_id)
+            except GaveUp:
+                future.set_exception(SystemExit(1))
+                continue
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            for file in files:
+                if file['mimeType'] == folder_mime_type:
+                    self.request(file['id'])
+            future.set_result(files)
+
+#-------------------------------------------------------------------
+
+# Call (coroutine function) func(item) for every item, with up to
+# `tasks` of them running at once -- like run_with_services() in
+# gxlib/workers.py, but on the event loop.  Stops at the first
+# exception (which is raised), like run_with_services().
+async def run_all(items, func, tasks=default_max_in_flight):
+    items = iter(items)
+    error = list()
+
+    async def task():
+        for item in items:
+            if error:
+                return
+            try:
+                await func(item)
+            except BaseException as e:
+                error.append(e)
+                return
+
+    await asyncio.gather(*[ task() for i in range(max(1, tasks)) ])
+    if error:
+        raise error[0]
@@ -0,0 +1,484 @@
+"""Wrappers around executing Google Drive API calls.
+
+Every Drive API call goes through doit(), which retries calls that
+fail in a way that is worth retrying:
+
+- 429s, 5xx's, and 403s whose reason is a rate limit are retried with
+  exponential backoff plus random jitter (or after however long Google
+  says to wait in a Retry-After header).
+- Other 403s are returned as failures (None) if the caller said the
+  call can fail (and so are 404s, if the caller said that the thing
+  may be missing; see MAY_BE_MISSING).
+- Everything else is fatal.
+
+Calls are also metered through a per-credential token bucket so that
+a burst of calls (e.g., from a bunch of crawl workers) doesn't run
+into the per-user quota in the first place.  When a call does hit a
+rate limit, the whole credential is paused, not just the one call.
+Optionally, the number of calls in flight at once (across all
+credentials and threads) is capped, too; see set_max_in_flight().
+
+Every try of every call is counted and timed in gxlib/metrics.py.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+
+# Not apiclient.errors: importing anything from the apiclient package
+# imports all of googleapiclient (including the discovery module),
+# which takes a while.  See build_drive_service().
+from googleapiclient.errors import HttpError
+
+from gxlib import metrics
+
+log = logging.getLogger('FToTD')
+
+# How many times to try a call before giving up
+max_tries = 8
+# Backoff before retry N is a random time in [0, min(cap, base * 2**N)]
+# seconds
+backoff_base = 1
+backoff_cap  = 64
+
+# Set this environment variable to the base URL of a stand-in for the
+# Drive API (e.g., bench/fake-drive.py) to talk to it instead of Google
+drive_api_url_env = 'GX_DRIVE_API_URL'
+
+# Where to get the Drive v3 discovery document, and how long to keep
+# using a copy of it cached on disk before getting it again
+discovery_url     = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+discovery_max_age = 7 * 24 * 60 * 60
+
+# Default per-credential rate limit.  Drive's default quota is 1,000
+# calls per 100 seconds per user.
+default_rate  = 10
+default_burst = 20
+
+# 403 reasons that mean "slow down", as opposed to "you can't do that"
+rate_limit_reasons = [ 'userRateLimitExceeded', 'rateLimitExceeded' ]
+
+# What to do about a failed call
+RETRY = 'retry'
+FAIL  = 'fail'
+ABORT = 'abort'
+
+# Pass this as can_fail to have 404s returned as failures too (e.g.,
+# when looking up something that may have been deleted)
+MAY_BE_MISSING = 'may be missing'
+
+####################################################################
+
+# Classic token bucket: up to burst calls can go through back-to-back,
+# after which calls are spaced out to rate per second.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate   = float(rate)
+        self.burst  = float(max(burst, 1))
+        self.tokens = self.burst
+        self.last   = time.monotonic()
+        self._lock  = threading.Lock()
+
+    # Take tokens, sleeping until they're available
+    def take(self, count=1):
+        wait = self.reserve(count)
+        if wait > 0:
+            time.sleep(wait)
+
+    # Take tokens without waiting for them.  Returns how many seconds
+    # the caller has to wait before using them (e.g., with
+    # asyncio.sleep(); see gxlib/aio.py).
+    def reserve(self, count=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # Go into debt if need be; the wait pays it off
+            self.tokens = self.tokens - count
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+
+        return wait
+
+    # How many tokens there are right now (negative if calls are
+    # waiting, or the bucket is paused)
+    def available(self):
+        with self._lock:
+            return min(self.burst,
+                       self.tokens + (time.monotonic() - self.last) * self.rate)
+
+    # Don't let any calls through for the next delay seconds
+    def pause(self, delay):
+        with self._lock:
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+# Token buckets are per-credential (that's how Google counts quota),
+# but API calls only know what Http object they're going out on.
+_rate          = default_rate
+_burst         = default_burst
+_cred_buckets  = dict()    # id(credentials) -> TokenBucket
+_http_buckets  = dict()    # id(http) -> TokenBucket
+_buckets_lock  = threading.Lock()
+
+def set_rate_limit(rate, burst=None):
+    global _rate, _burst
+    _rate  = rate
+    _burst = burst if burst is not None else 2 * rate
+
+# Meter all calls made on this (authorized) Http object against the
+# token bucket for this credential.  Call this from authorize().
+#
+# name: what to call this credential in the API metrics (e.g., its
+#       email address)
+def register_http(http, credentials, name=None):
+    metrics.register_credentials(http, credentials, name)
+    bucket = credential_bucket(credentials)
+    if bucket:
+        with _buckets_lock:
+            _http_buckets[id(http)] = bucket
+
+# The token bucket for a credential, or None if calls aren't metered
+def credential_bucket(credentials):
+    if not _rate:
+        return None
+
+    with _buckets_lock:
+        key = id(credentials)
+        if key not in _cred_buckets:
+            _cred_buckets[key] = TokenBucket(_rate, _burst)
+        return _cred_buckets[key]
+
+def _bucket(http):
+    return _http_buckets.get(id(http), None)
+
+# Cap on the number of calls in flight at once in this process (e.g.,
+# with gxcopy.py --manifest, several migrations each with their own
+# workers), or None for no cap.  A batch counts as one call.
+_in_flight = None
+
+# 0 means no limit
+def set_max_in_flight(count):
+    global _in_flight
+    _in_flight = threading.BoundedSemaphore(count) if count else None
+
+def _execute(httpref):
+    in_flight = _in_flight
+    if in_flight is None:
+        return httpref.execute()
+    with in_flight:
+        return httpref.execute()
+
+# How many calls can go out on this service's credential right now
+# without waiting for its token bucket (negative if it is paused after
+# a rate limit), or None if its calls aren't metered
+def remaining_budget(service):
+    bucket = _bucket(getattr(service, '_http', None))
+    if bucket is None:
+        return None
+    return bucket.available()
+
+####################################################################
+
+# build('drive', 'v3') fetches and parses the discovery document every
+# time it is called, i.e., once per credential / worker.  Instead, get
+# the document once, keep it in memory, and keep a copy on disk so
+# that the next run doesn't have to fetch it at all.
+_discovery_docs = dict()    # URL -> discovery document (string)
+_discovery_lock = threading.Lock()
+
+# Where to keep a kind of thing (e.g., "drive-v3" for the discovery
+# document) that we got from url on disk
+def cache_file(kind, url):
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'gxlib', '{0}-{1}.json'.format(kind, key))
+
+def _read_discovery_cache(filename, max_age):
+    try:
+        if time.time() - os.path.getmtime(filename) > max_age:
+            return None
+        with open(filename) as f:
+            return f.read()
+    except (OSError, IOError):
+        return None
+
+def _write_discovery_cache(filename, doc):
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(doc)
+        os.replace(tmp, filename)
+    except (OSError, IOError) as e:
+        log.debug("Could not cache the discovery document in {0}: {1}"
+                  .format(filename, e))
+
+def discovery_document(http, url, use_disk_cache=True):
+    with _discovery_lock:
+        if url in _discovery_docs:
+            return _discovery_docs[url]
+
+        filename = cache_file('drive-v3', url)
+        doc = None
+        if use_disk_cache:
+            doc = _read_discovery_cache(filename, discovery_max_age)
+            if doc:
+                log.debug("Using cached discovery document {0}"
+                          .format(filename))
+
+        if doc is None:
+            log.debug("Fetching discovery document {0}".format(url))
+            (resp, content) = http.request(url)
+            if resp.status == 200:
+                doc = content.decode('utf-8')
+                json.loads(doc)
+                if use_disk_cache:
+                    _write_discovery_cache(filename, doc)
+            else:
+                # An old copy is better than nothing
+                doc = _read_discovery_cache(filename, float('inf'))
+                if doc is None:
+                    log.error("Error: could not get the Drive API discovery document from {0} (HTTP status {1})"
+                              .format(url, resp.status))
+                    sys.exit(1)
+
+        _discovery_docs[url] = doc
+        return doc
+
+# Make a Drive v3 service on an (authorized) Http object.  Call this
+# from authorize().
+def build_drive_service(http):
+    # This is the slow import, so only do it when we need it
+    from googleapiclient.discovery import build_from_document
+
+    url = os.environ.get(drive_api_url_env, None)
+    if url:
+        log.info("Using Drive API at {0}".format(url))
+        doc = discovery_document(http,
+                                 url.rstrip('/') + '/discovery/v1/apis/drive/v3/rest',
+                                 use_disk_cache=False)
+    else:
+        doc = discovery_document(http, discovery_url)
+
+    # Hand it the string, not a parsed copy: build_from_document()
+    # modifies the parsed document, so each service needs its own
+    return build_from_document(doc, http=http)
+
+####################################################################
+
+# Dig the reason (e.g., "userRateLimitExceeded") out of an HttpError
+def error_reason(err):
+    try:
+        content = err.content
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return json.loads(content)['error']['errors'][0]['reason']
+    except Exception:
+        return None
+
+def classify_error(err, can_fail=False):
+    status = err.resp.status
+    if status == 429 or status >= 500:
+        return RETRY
+    if status == 403:
+        if error_reason(err) in rate_limit_reasons:
+            return RETRY
+        if can_fail:
+            return FAIL
+    if status == 404 and can_fail == MAY_BE_MISSING:
+        return FAIL
+    return ABORT
+
+# How long to wait before the next try (count is how many tries have
+# failed so far)
+def backoff_delay(count, err=None):
+    if err is not None:
+        retry_after = err.resp.get('retry-after', None)
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+
+    return random.uniform(0, min(backoff_cap,
+                                 backoff_base * (2 ** count)))
+
+# What a failed try counts as in the metrics (tries is how many tries
+# there have been so far, including this one)
+def call_outcome(action, tries):
+    if action == RETRY:
+        return metrics.RETRY if tries < max_tries else metrics.FAILURE
+    if action == FAIL:
+        return metrics.FAILURE
+    return metrics.ERROR
+
+####################################################################
+
+# If the Google API call fails, try again...
+#
+# cost: how many calls to take out of the token bucket (e.g., the
+#       number of calls in a batch request)
+# http: the Http object the call will go out on, if httpref doesn't
+#       say (e.g., for batch requests)
+def doit(httpref, can_fail=False, cost=1, http=None):
+    http       = http or getattr(httpref, 'http', None)
+    bucket     = _bucket(http)
+    method     = metrics.method_name(httpref)
+    credential = metrics.credential_name(http)
+
+    count = 0
+    while count < max_tries:
+        if bucket:
+            bucket.take(cost)
+
+        start = time.monotonic()
+        try:
+            ret = _execute(httpref)
+            metrics.record(method, credential, metrics.SUCCESS,
+                           time.monotonic() - start)
+            return ret
+
+        except HttpError as err:
+            latency = time.monotonic() - start
+            log.debug("*** Got HttpError: {0}".format(err))
+            action = classify_error(err, can_fail)
+            metrics.record(method, credential,
+                           call_outcome(action, count + 1), latency)
+            if action == RETRY:
+                delay = backoff_delay(count, err)
+                log.debug("*** Seems recoverable (status {0}, reason {1}); let's sleep {2:.1f} seconds and try again..."
+                          .format(err.resp.status, error_reason(err), delay))
+                if bucket:
+                    # Everyone using this credential needs to back off
+                    bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+                count = count + 1
+                continue
+            elif action == FAIL:
+                log.debug("*** Got a {0}, but we're allowed to fail this call".format(err.resp.status))
+                # Need to return None to indicate failure
+                return None
+            else:
+                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(err.resp.status))
+                log.debug(err)
+                raise
+
+        except:
+            metrics.record(method, credential, metrics.ERROR,
+                           time.monotonic() - start)
+            log.error("*** Some unknown error occurred")
+            log.error(sys.exc_info()[0])
+            raise
+
+    # If we get here, it's failed multiple times -- time to bail...
+    log.error("Error: we failed this {0} times; there's no reason to believe it'll work if we do it again..."
+              .format(max_tries))
+    sys.exit(1)
+
+#-------------------------------------------------------------------
+
+# Drive will not take more than this many calls in one batch request
+max_batch_size = 100
+
+# Queue up API calls per service (i.e., per credential) and send them
+# to Google in batch requests of up to batch_size calls each.
+#
+# Each call has a callback that is invoked with the result of that
+# call (or None if the call failed with a 403 and can_fail was set, or
+# a 404 and it was MAY_BE_MISSING, just like doit()).  Callbacks are
+# allowed to add more calls to the queue (e.g., to fall back from a
+# move to a copy); flush() keeps going until all the queues are empty.
+# Individual calls in a batch are retried the same way doit() retries
+# calls.
+class BatchQueue:
+    def __init__(self, batch_size=max_batch_size):
+        self.batch_size = max(1, min(batch_size, max_batch_size))
+        self._queues    = dict()    # id(service) -> (service, list of calls)
+
+    def add(self, service, httpref, callback, can_fail=False):
+        key = id(service)
+        if key not in self._queues:
+            self._queues[key] = (service, list())
+        calls = self._queues[key][1]
+        calls.append((httpref, callback, can_fail, 0))
+
+        if len(calls) >= self.batch_size:
+            self._send(service, calls)
+
+    def flush(self):
+        while True:
+            pending = [ (service, calls)
+                        for service, calls in self._queues.values()
+                        if calls ]
+            if not pending:
+                break
+            for service, calls in pending:
+                self._send(service, calls)
+
+    # Send (up to) one batch worth of calls for this service.  Calls
+    # that fail in a recoverable way are put back on the queue.
+    def _send(self, service, calls):
+        todo = calls[:self.batch_size]
+        del calls[:self.batch_size]
+
+        results = dict()
+        def cb(request_id, response, exception):
+            results[request_id] = (response, exception)
+
+        batch = service.new_batch_http_request()
+        for i, call in enumerate(todo):
+            batch.add(call[0], callback=cb, request_id=str(i))
+        log.debug("Sending batch of {0} API calls".format(len(todo)))
+        doit(batch, cost=len(todo), http=getattr(service, '_http', None))
+
+        # Process the results after the batch has completed, because
+        # the callbacks may add more calls to the queue
+        credential = metrics.credential_name(getattr(service, '_http', None))
+        delay = 0
+        for i, (httpref, callback, can_fail, count) in enumerate(todo):
+            method = metrics.method_name(httpref)
+            (response, err) = results.get(str(i), (None, None))
+            if err is None:
+                metrics.record(method, credential, metrics.SUCCESS)
+                callback(response)
+                continue
+
+            if not isinstance(err, HttpError):
+                metrics.record(method, credential, metrics.ERROR)
+                raise err
+
+            log.debug("*** Got HttpError in batch: {0}".format(err))
+            action = classify_error(err, can_fail)
+            metrics.record(method, credential, call_outcome(action, count + 1))
+            if action == RETRY:
+                if count + 1 >= max_tries:
+                    log.error("Error: we failed this {0} times; there's no reason to believe it'll work if we do it again..."
+                              .format(max_tries))
+                    sys.exit(1)
+                log.debug("*** Seems recoverable; queueing to try again...")
+                calls.append((httpref, callback, can_fail, count + 1))
+                delay = max(delay, backoff_delay(count, err))
+            elif action == FAIL:
+                log.debug("*** Got a {0}, but we're allowed to fail this call".format(err.resp.status))
+                callback(None)
+            else:
+                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(err.resp.status))
+                raise err
+
+        if delay > 0:
+            bucket = _bucket(getattr(service, '_http', None))
+            if bucket:
+                bucket.pause(delay)
+            else:
+                time.sleep(delay)
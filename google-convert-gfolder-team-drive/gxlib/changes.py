@@ -0,0 +1,207 @@
+"""Incremental rescans of a source tree via the Drive Changes API.
+
+A full crawl saves the raw listing of every folder in the tree, along
+with a Changes API start page token that was fetched *before* the
+crawl started.  A later rescan asks Google only for what changed since
+that token, applies the changes to the saved listings, and rebuilds
+the Tree / all_files structures locally.  Folders that moved into the
+tree since the last scan (and so were never listed) are listed on
+demand.
+
+"""
+
+import os
+import json
+import logging
+
+from gxlib.api import doit
+from gxlib.crawl import list_folder
+from gxlib.crawl import build_tree, RecordingFetcher, read_source_tree
+
+log = logging.getLogger('FToTD')
+
+# Bump this if the layout of the saved state changes
+scan_state_version = 1
+
+# Same fields as a folder listing, plus whether the file is trashed
+change_file_fields = 'name,id,mimeType,parents,owners,webViewLink,size,md5Checksum,trashed'
+team_drive_change_file_fields = 'name,id,mimeType,parents,webViewLink,size,md5Checksum,trashed'
+
+#-------------------------------------------------------------------
+
+def get_start_page_token(service, team_drive_id=None):
+    kwargs = dict()
+    if team_drive_id:
+        kwargs['teamDriveId'] = team_drive_id
+
+    response = doit(service.changes()
+                    .getStartPageToken(supportsTeamDrives=True,
+                                       **kwargs))
+    return response['startPageToken']
+
+#-------------------------------------------------------------------
+
+# Apply all the changes since page_token to the saved folder listings
+# (hash of folder ID -> list of raw file dicts).  Returns the new start
+# page token to save for next time.
+def apply_changes(service, listings, page_token, team_drive_id=None):
+    if team_drive_id:
+        file_fields = team_drive_change_file_fields
+        kwargs = dict(teamDriveId=team_drive_id,
+                      includeTeamDriveItems=True)
+    else:
+        file_fields = change_file_fields
+        kwargs = dict()
+    fields = ('nextPageToken,newStartPageToken,changes(fileId,removed,file({0}))'
+              .format(file_fields))
+
+    # Index of which saved listings each file currently appears in
+    where = dict()
+    for folder_id, files in listings.items():
+        for file in files:
+            if file['id'] not in where:
+                where[file['id']] = list()
+            where[file['id']].append(folder_id)
+
+    count = 0
+    while True:
+        response = doit(service.changes()
+                        .list(pageToken=page_token,
+                              spaces='drive',
+                              pageSize=1000,
+                              includeRemoved=True,
+                              supportsTeamDrives=True,
+                              fields=fields,
+                              **kwargs))
+        for change in response.get('changes', []):
+            count = count + 1
+            id = change['fileId']
+
+            # Take the file out of wherever it was...
+            for folder_id in where.pop(id, list()):
+                listings[folder_id] = [ f for f in listings[folder_id]
+                                        if f['id'] != id ]
+
+            # ...and put it wherever it is now (if it is still in one
+            # of our folders)
+            file = change.get('file', None)
+            if change.get('removed', False) or file is None:
+                log.debug("Change: {0} removed".format(id))
+                continue
+            if file.pop('trashed', False):
+                log.debug('Change: "{0}" trashed'.format(file['name']))
+                continue
+
+            log.debug('Change: "{0}" updated'.format(file['name']))
+            for folder_id in file.get('parents', []):
+                if folder_id in listings:
+                    listings[folder_id].append(file)
+                    if id not in where:
+                        where[id] = list()
+                    where[id].append(folder_id)
+
+        if 'newStartPageToken' in response:
+            log.info("Applied {0} changes".format(count))
+            return response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+#-------------------------------------------------------------------
+
+# Same interface as the fetchers in gxlib/crawl.py, but serve folder
+# listings out of saved listings.  Folders that we don't have a saved
+# listing for are listed live.
+class ListingsFetcher:
+    def __init__(self, service, listings, team_drive_id=None):
+        self.service       = service
+        self.listings      = listings
+        self.team_drive_id = team_drive_id
+
+    def request(self, folder_id):
+        pass
+
+    def get(self, folder_id):
+        if folder_id in self.listings:
+            return self.listings[folder_id]
+
+        log.info("No saved listing for folder ID {0}; listing it"
+                 .format(folder_id))
+        return list_folder(self.service, folder_id, self.team_drive_id)
+
+    def close(self):
+        pass
+
+#-------------------------------------------------------------------
+
+def load_scan_state(filename):
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename) as f:
+        state = json.load(f)
+    if state.get('version') != scan_state_version:
+        log.info("Ignoring scan state in {0}: unknown version"
+                 .format(filename))
+        return None
+
+    log.info("Loaded scan state from {0}".format(filename))
+    return state
+
+# Write to a temp file and rename it into place so that a crash in the
+# middle of writing doesn't clobber the previous state.
+def save_scan_state(filename, state):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+    log.info("Saved scan state to {0}".format(filename))
+
+#-------------------------------------------------------------------
+
+# Read the source tree, either from scratch or incrementally from the
+# scan state saved in state_file by a previous run.  Either way, save
+# the updated scan state to state_file for next time.
+#
+# Returns (tree, all_files), just like read_source_tree().
+def scan_source_tree(services, prefix, root_folder, state_file,
+                     team_drive_id=None, corpus=False, full=False):
+    state = None
+    if not full:
+        state = load_scan_state(state_file)
+    if (state is not None and
+        (state['root_id'] != root_folder.id or
+         state['team_drive_id'] != team_drive_id)):
+        log.info("Saved scan state is for a different folder; ignoring it")
+        state = None
+
+    listings = dict()
+    if state is None:
+        # Get the token *before* we crawl so that nothing that changes
+        # during the crawl is missed
+        page_token = get_start_page_token(services[0], team_drive_id)
+        (tree, all_files) = read_source_tree(services, prefix, root_folder,
+                                             team_drive_id=team_drive_id,
+                                             corpus=corpus,
+                                             listings=listings)
+    else:
+        log.info("Rescanning incrementally from saved scan state")
+        page_token = apply_changes(services[0], state['listings'],
+                                   state['page_token'], team_drive_id)
+        fetcher = ListingsFetcher(services[0], state['listings'],
+                                  team_drive_id)
+        # Only record the listings that are still reachable from the
+        # root, so that the state does not grow without bound
+        fetcher = RecordingFetcher(fetcher, listings)
+        (tree, all_files) = build_tree(fetcher, prefix, root_folder)
+
+    save_scan_state(state_file, {
+        'version'       : scan_state_version,
+        'root_id'       : root_folder.id,
+        'team_drive_id' : team_drive_id,
+        'page_token'    : page_token,
+        'listings'      : listings,
+    })
+
+    return (tree, all_files)
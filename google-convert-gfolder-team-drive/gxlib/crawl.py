@@ -0,0 +1,602 @@
+"""Crawl a Google Drive folder (or Team Drive) tree.
+
+Listing a folder is one or more round trips to Google, and on big
+shared folders nearly all of the crawl time is spent waiting on those
+round trips.  So the listing is done by a pool of worker threads (one
+per entry in the list of services; see gxlib/transport.py for why
+they can all be the same service) pulling folder IDs off a work
+queue, while the main thread stitches the results together into the
+Tree / ContentEntry / AllFiles structures in the same order that a
+single-threaded depth-first crawl would.  I.e., the result is the
+same no matter how many workers are used.
+
+Alternatively, the crawl can page once through every file the admin
+can see (the "corpus") and rebuild the folder tree locally from each
+file's parents.  This costs (total items / 1000) page fetches instead
+of (at least) one query per folder, which is a big win for deep trees
+with lots of small folders.
+
+"""
+
+import sys
+import heapq
+import collections
+import logging
+import threading
+
+from gxlib.api import doit
+from gxlib.records import folder_mime_type
+from gxlib.records import GFile, Tree, ContentEntry, AllFiles, Parent
+from gxlib.records import intern_owners
+
+log = logging.getLogger('FToTD')
+
+list_fields = 'nextPageToken,files(name,id,mimeType,parents,owners,webViewLink,size,md5Checksum)'
+# Team Drive items have no owners
+team_drive_list_fields = 'nextPageToken,files(name,id,mimeType,parents,webViewLink,size,md5Checksum)'
+
+# Page size when listing the whole corpus (1000 is the max Drive allows)
+corpus_page_size = 1000
+
+# Work queue priorities: lower numbers are fetched first
+URGENT = 0
+PREFETCH = 1
+
+# Maximum number of folder listings that FolderFetcher holds (or is in
+# the middle of fetching) before anyone has asked for them
+max_prefetched = 1000
+
+#-------------------------------------------------------------------
+
+# Return a list of everything in a single folder (i.e., all pages of
+# the listing).
+def list_folder(service, folder_id, team_drive_id=None):
+    query = "'{0}' in parents and trashed=false".format(folder_id)
+    log.debug("Query: {0}".format(query))
+
+    if team_drive_id:
+        kwargs = dict(corpora='teamDrive',
+                      fields=team_drive_list_fields,
+                      teamDriveId=team_drive_id,
+                      includeTeamDriveItems=True)
+    else:
+        kwargs = dict(corpora='user',
+                      fields=list_fields)
+
+    files = list()
+    page_token = None
+    while True:
+        response = doit(service.files()
+                        .list(q=query,
+                              spaces='drive',
+                              pageToken=page_token,
+                              supportsTeamDrives=True,
+                              **kwargs))
+        files.extend(response.get('files', []))
+
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    return files
+
+#-------------------------------------------------------------------
+
+# Page through every (non-trashed) file that we can see and return a
+# hash indexed by parent ID of lists of that parent's children.
+#
+# Files with multiple parents are listed under each of them.
+def list_corpus(service, team_drive_id=None):
+    if team_drive_id:
+        kwargs = dict(corpora='teamDrive',
+                      fields=team_drive_list_fields,
+                      teamDriveId=team_drive_id,
+                      includeTeamDriveItems=True)
+    else:
+        kwargs = dict(corpora='user',
+                      fields=list_fields)
+
+    children = dict()
+    count = 0
+    page_token = None
+    while True:
+        response = doit(service.files()
+                        .list(q='trashed=false',
+                              spaces='drive',
+                              pageSize=corpus_page_size,
+                              pageToken=page_token,
+                              supportsTeamDrives=True,
+                              **kwargs))
+        for file in response.get('files', []):
+            count = count + 1
+            for parent_id in file.get('parents', []):
+                if parent_id not in children:
+                    children[parent_id] = list()
+                children[parent_id].append(file)
+
+        log.info("Listed {0} items so far...".format(count))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    return children
+
+#-------------------------------------------------------------------
+
+# Same interface as FolderFetcher, but serve folder listings out of
+# one pass over the whole corpus (see list_corpus()).  Only the folders
+# under the root of the crawl are ever asked for, so the resulting
+# tree is pruned to that subtree.
+class CorpusFetcher:
+    def __init__(self, service, team_drive_id=None):
+        self.service       = service
+        self.team_drive_id = team_drive_id
+        self._children     = None
+
+    def request(self, folder_id):
+        pass
+
+    def get(self, folder_id):
+        if self._children is None:
+            self._children = list_corpus(self.service, self.team_drive_id)
+        return self._children.get(folder_id, list())
+
+    def close(self):
+        self._children = None
+
+#-------------------------------------------------------------------
+
+# Wrap another fetcher and save a copy of every folder listing that is
+# handed out in the listings hash (indexed by folder ID).  This is how
+# the raw crawl results are saved for incremental rescans (see
+# gxlib/changes.py).
+class RecordingFetcher:
+    def __init__(self, fetcher, listings):
+        self.fetcher  = fetcher
+        self.listings = listings
+
+    def request(self, folder_id):
+        self.fetcher.request(folder_id)
+
+    def get(self, folder_id):
+        files = self.fetcher.get(folder_id)
+        self.listings[folder_id] = files
+        return files
+
+    def close(self):
+        self.fetcher.close()
+
+# Wrap another fetcher and add every folder listing that is handed out
+# to a DedupIndex (see gxlib/dedup.py).
+class IndexingFetcher:
+    def __init__(self, fetcher, dedup):
+        self.fetcher = fetcher
+        self.dedup   = dedup
+
+    def request(self, folder_id):
+        self.fetcher.request(folder_id)
+
+    def get(self, folder_id):
+        files = self.fetcher.get(folder_id)
+        self.dedup.add_listing(files)
+        return files
+
+    def close(self):
+        self.fetcher.close()
+
+#-------------------------------------------------------------------
+
+# Fetch folder listings, possibly in parallel.
+#
+# With a single service, there are no worker threads: get() just
+# lists the folder right then and there.
+#
+# With more than one service, there is one worker thread per service.
+# Whenever a worker finishes listing a folder, it queues up all the
+# sub folders it found so that they are prefetched (breadth first)
+# before anyone asks for them.  When the main thread asks for a folder
+# that hasn't been fetched yet, that folder is bumped to the front of
+# the queue.  Prefetching stops while max_prefetched listings are
+# waiting to be picked up (e.g., because whoever is calling get() is
+# blocked on something else), so the listings that pile up are bounded;
+# urgent requests are always fetched.
+#
+# With a scheduler (see gxlib/scheduler.py), each folder is listed
+# with whichever credential can read it and has the most quota left,
+# instead of with the worker's own service.
+class FolderFetcher:
+    def __init__(self, services, team_drive_id=None, scheduler=None):
+        self.services      = services
+        self.team_drive_id = team_drive_id
+        self.scheduler     = scheduler
+        self._owners       = dict()    # folder ID -> owners (for the scheduler)
+
+        self._cond     = threading.Condition()
+        self._queue    = list()    # heap of (priority, seq, folder ID)
+        self._seq      = 0
+        self._queued   = set()     # IDs that have been queued
+        self._started  = set()     # IDs that a worker has picked up
+        self._results  = dict()    # ID -> (files, exception)
+        self._busy     = 0         # Number of folders being listed
+        self._shutdown = False
+
+        self._threads = list()
+        if len(services) > 1:
+            for i, service in enumerate(services):
+                t = threading.Thread(target=self._worker, args=(service,),
+                                     name='crawl-worker-{0}'.format(i),
+                                     daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    # Must be called with self._cond held
+    def _push(self, priority, folder_id):
+        self._seq = self._seq + 1
+        heapq.heappush(self._queue, (priority, self._seq, folder_id))
+        self._queued.add(folder_id)
+        self._cond.notify_all()
+
+    def request(self, folder_id):
+        if not self._threads:
+            return
+
+        with self._cond:
+            if folder_id not in self._queued:
+                self._push(PREFETCH, folder_id)
+
+    def _list(self, service, folder_id):
+        if self.scheduler is None:
+            return list_folder(service, folder_id, self.team_drive_id)
+
+        # The root's owners aren't known, so only the admin gets it
+        names = self.scheduler.readers(self._owners.pop(folder_id, list()))
+        with self.scheduler.service(names) as (name, service):
+            files = list_folder(service, folder_id, self.team_drive_id)
+        for file in files:
+            if file['mimeType'] == folder_mime_type:
+                self._owners[file['id']] = file.get('owners', list())
+        return files
+
+    def get(self, folder_id):
+        if not self._threads:
+            return self._list(self.services[0], folder_id)
+
+        with self._cond:
+            if folder_id not in self._results:
+                # Don't wait behind the prefetches
+                if folder_id not in self._started:
+                    self._push(URGENT, folder_id)
+                while folder_id not in self._results:
+                    self._cond.wait()
+
+            (files, exc) = self._results.pop(folder_id)
+            # If we're asked for this folder again, fetch it again
+            self._started.discard(folder_id)
+            # There may be room to prefetch again
+            self._cond.notify_all()
+
+        if exc is not None:
+            raise exc
+        return files
+
+    def close(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    # Must be called with self._cond held
+    def _runnable(self):
+        if not self._queue:
+            return False
+        # URGENT sorts first, so it's on top if there are any
+        (priority, _, _) = self._queue[0]
+        return (priority == URGENT or
+                len(self._results) + self._busy < max_prefetched)
+
+    def _worker(self, service):
+        while True:
+            with self._cond:
+                while not self._runnable() and not self._shutdown:
+                    self._cond.wait()
+                if self._shutdown:
+                    return
+
+                (_, _, folder_id) = heapq.heappop(self._queue)
+                if folder_id in self._started:
+                    continue
+                self._started.add(folder_id)
+                self._busy = self._busy + 1
+
+            files = None
+            exc   = None
+            try:
+                files = self._list(service, folder_id)
+            except BaseException as e:
+                # Includes the SystemExit from doit(); hand it to the
+                # main thread to deal with
+                exc = e
+
+            with self._cond:
+                self._busy = self._busy - 1
+                self._results[folder_id] = (files, exc)
+                if files:
+                    for file in files:
+                        if (file['mimeType'] == folder_mime_type and
+                            file['id'] not in self._queued):
+                            self._push(PREFETCH, file['id'])
+                self._cond.notify_all()
+
+#-------------------------------------------------------------------
+
+# Find a list of contents of a particular root folder (GFile), and
+# recursively call down into each folder.  Make a somewhat complicated
+# data structure to represent the tree (remember that both files and
+# folders can have multiple parents).
+#
+# tree:
+#   .root_folder, a GFile instance:
+#      .id
+#      .mimeType: folder mime type
+#      .name
+#      .parents: list
+#      .owners: JMS ???list
+#      .team_id: None (will be populated later)
+#   .contents: list, each entry is an instance of ContentEntry, representing an item in this folder
+#      .gfile, a GFile instance:
+#         .id
+#         .mimeType
+#         .name
+#         .parents
+#         .owners: JMS ???list (empty for Team Drive items)
+#         .team_id: None (will never be populated)
+#      .is_folder: boolean, True if folder
+#      .traverse: boolean, True if this is 1st time we've seen this folder
+#      .tree: if traverse==True, a tree, otherwise None
+#
+# all_files: hash indexed by ID, each entry is:
+#    .name
+#    .webViewLink
+#    .parents: list of Parent records (shared by all the files in the
+#     same folder), each with:
+#       .id
+#       .name
+#       .name_abs (contains entire name since root; computed on demand)
+#       .webViewLink
+#    .is_folder
+#    .owners
+#    .team_file: None (will be populated later)
+#
+# services: list of authorized services.  One worker thread is used
+# per service; if there is only one, the crawl is single threaded.
+#
+# team_drive_id: if crawling a Team Drive, its ID.
+#
+# corpus: if True, list the whole corpus in one pass (using only the
+# first service) instead of listing folder-by-folder.
+#
+# listings: if not None, a hash that will be filled with the raw
+# listing of each folder in the tree, indexed by folder ID.
+#
+# scheduler: if not None, a QuotaScheduler to spread the folder
+# listings across credentials with (see FolderFetcher).
+#
+# dedup: if not None, a DedupIndex to add the contents key of every
+# file to.
+#
+# fetcher: if not None, the fetcher to list the folders with (e.g., an
+# AsyncFolderFetcher from gxlib/aio.py), instead of one made here.
+#
+def read_source_tree(services, prefix, root_folder, all_files=None,
+                     team_drive_id=None, corpus=False, listings=None,
+                     scheduler=None, dedup=None, fetcher=None):
+    if fetcher is None and corpus:
+        fetcher = CorpusFetcher(services[0], team_drive_id)
+    elif fetcher is None:
+        fetcher = FolderFetcher(services, team_drive_id, scheduler)
+    if listings is not None:
+        fetcher = RecordingFetcher(fetcher, listings)
+    if dedup is not None:
+        fetcher = IndexingFetcher(fetcher, dedup)
+
+    return build_tree(fetcher, prefix, root_folder, all_files)
+
+# Build the tree (see read_source_tree()) from folder listings handed
+# out by a fetcher.  Returns (tree, all_files).
+#
+# This uses an explicit stack instead of recursing once per folder
+# level, so arbitrarily deep trees are fine.  Sub folders are pushed in
+# reverse order so that they come off the stack in the same
+# (depth-first) order that recursion would visit them.  All the state
+# of the crawl is local to this call.
+def build_tree(fetcher, prefix, root_folder, all_files=None):
+    if all_files is None:
+        all_files = dict()
+
+    # IDs of all the folders that have been (or are about to be)
+    # listed.  Includes the root, so that a folder that (eventually)
+    # contains the root doesn't cause us to list it again.
+    visited = set([ root_folder.id ])
+
+    root_tree = None
+    stack     = [ (prefix, root_folder, None) ]
+    fetcher.request(root_folder.id)
+    try:
+        while stack:
+            (prefix, folder, entry) = stack.pop()
+            (tree, parent) = _merge_folder(fetcher, prefix, folder,
+                                           all_files, visited)
+            if entry is None:
+                root_tree = tree
+            else:
+                entry.tree = tree
+
+            # Traverse all the sub folders
+            for sub in reversed(tree.contents):
+                if sub.traverse:
+                    log.debug("== Will traverse down into {0}/{1}"
+                              .format(parent.name_abs, sub.gfile.name))
+                    stack.append((parent, sub.gfile, sub))
+    finally:
+        fetcher.close()
+
+    # Done!
+    return (root_tree, all_files)
+
+# Everything in a folder shares that folder's Parent record, and
+# owners / mimeTypes / parent IDs are interned, so that a big crawl
+# doesn't need many copies of the same data.
+#
+# Merge the listing of a single folder into all_files.  Returns the
+# Tree for that folder (with the .tree of sub folder entries not yet
+# filled in) and the folder's Parent record.
+#
+# prefix: string prefix of the root's absolute name, or the Parent
+# record of the folder that the root is in.
+# visited: set of IDs of folders that have already been traversed.
+def _merge_folder(fetcher, prefix, root_folder, all_files, visited):
+    log.info('Discovering contents of folder: "{0}" (ID: {1})'
+             .format(root_folder.name, root_folder.id))
+
+    parent_wvl = '<Unknown>'
+    if root_folder.id in all_files:
+        parent_wvl = all_files[root_folder.id].webViewLink
+    parent = Parent(id=root_folder.id, name=root_folder.name,
+                    webViewLink=parent_wvl, up=prefix)
+    log.debug('parent folder name abs: {0}'.format(parent.name_abs))
+    tree = Tree(root_folder=root_folder, contents=[])
+
+    # Iterate through everything in this root folder
+    for file in fetcher.get(root_folder.id):
+        log.info('Found: "{0}"'.format(file['name']))
+        id = file['id']
+        owners = intern_owners(file.get('owners', list()))
+        parents = tuple(sys.intern(p) for p in file['parents'])
+        traverse = False
+        is_folder = False
+        if file['mimeType'] == folder_mime_type:
+            is_folder = True
+
+        # We have already seen this file before
+        if id in all_files:
+            log.debug('--- We already know this file; cross-referencing...')
+
+            # If this is a folder that we already know, then do
+            # not traverse down into it (again).
+            if is_folder:
+                log.debug('--- Is a folder, but we already know it; NOT adding to pending traversal list')
+                traverse = False
+
+        # We have *NOT* already seen this file before
+        else:
+            log.debug('--- We do not already know this file; saving...')
+            log.debug("Parents: {p}".format(p=parents))
+            all_files[id] = AllFiles(name=file['name'],
+                                     webViewLink=file['webViewLink'],
+                                     parents=[], # Filled in below
+                                     is_folder=is_folder,
+                                     owners=owners,
+                                     team_file=None)
+
+        # If it's a folder we haven't traversed, add it to the pending
+        # traversal list
+        if is_folder and id not in visited:
+            visited.add(id)
+            traverse = True
+            log.debug("--- Is a folder; adding to pending traversal list")
+
+        # Save this content entry in the list of contents for this
+        # folder
+        gfile = GFile(id=id,
+                      mimeType=sys.intern(file['mimeType']),
+                      webViewLink=file['webViewLink'],
+                      name=file['name'],
+                      parents=parents,
+                      owners=owners,
+                      team_file=None)
+        content_entry = ContentEntry(gfile=gfile,
+                                     is_folder=is_folder,
+                                     traverse=traverse,
+                                     contents=(),   # Unused
+                                     tree=None)
+        tree.contents.append(content_entry)
+
+        # Save this file in the master list of *all* files found.
+        # Basically, add a parent listing to this ID in the
+        # all_files index.
+        all_files[id].parents.append(parent)
+
+    return (tree, parent)
+
+#-------------------------------------------------------------------
+
+# Walk the source tree breadth first without building the whole Tree /
+# all_files structures in memory, yielding each item as soon as its
+# folder has been listed.  Yields (parent, parent_name_abs, file,
+# traverse) tuples, where parent is the GFile of the folder that file
+# (the raw hash from the folder listing) was found in.
+#
+# As with read_source_tree(), a folder with multiple parents is only
+# traversed the first time it is found (traverse is True for that
+# one).  Only folder IDs are remembered, to keep memory use down.
+# traverse_under can override that: it is a hash of folder ID -> ID of
+# the parent to traverse that folder under (e.g., wherever a migration
+# put its contents); such a folder isn't traversed anywhere else.
+def walk_source_listing(services, prefix, root_folder, team_drive_id=None,
+                        scheduler=None, dedup=None, traverse_under=None):
+    fetcher = FolderFetcher(services, team_drive_id, scheduler)
+    if dedup is not None:
+        fetcher = IndexingFetcher(fetcher, dedup)
+    seen    = set([ root_folder.id ])
+    pending = collections.deque()
+
+    pending.append((root_folder,
+                    '{0}/{1}'.format(prefix, root_folder.name)))
+    fetcher.request(root_folder.id)
+    try:
+        while pending:
+            (folder, name_abs) = pending.popleft()
+            log.info('Discovering contents of folder: "{0}" (ID: {1})'
+                     .format(folder.name, folder.id))
+
+            for file in fetcher.get(folder.id):
+                log.info('Found: "{0}"'.format(file['name']))
+                traverse = (file['mimeType'] == folder_mime_type and
+                            file['id'] not in seen)
+                if traverse and traverse_under:
+                    traverse = (traverse_under.get(file['id'], folder.id) ==
+                                folder.id)
+                if traverse:
+                    seen.add(file['id'])
+                    pending.append((_gfile(file),
+                                    '{0}/{1}'.format(name_abs, file['name'])))
+                    fetcher.request(file['id'])
+
+                yield (folder, name_abs, file, traverse)
+    finally:
+        fetcher.close()
+
+def _gfile(file):
+    return GFile(id=file['id'],
+                 mimeType=sys.intern(file['mimeType']),
+                 webViewLink=file['webViewLink'],
+                 name=file['name'],
+                 parents=tuple(sys.intern(p) for p in file['parents']),
+                 owners=intern_owners(file.get('owners', list())),
+                 team_file=None)
+
+# Same as walk_source_listing(), but yields (parent, parent_name_abs,
+# entry) tuples, where entry is a ContentEntry (with .tree and
+# .contents left empty).
+def walk_source_tree(services, prefix, root_folder, team_drive_id=None,
+                     scheduler=None, dedup=None):
+    for (folder, name_abs, file, traverse) in \
+            walk_source_listing(services, prefix, root_folder,
+                                team_drive_id, scheduler, dedup):
+        entry = ContentEntry(gfile=_gfile(file),
+                             is_folder=(file['mimeType'] == folder_mime_type),
+                             traverse=traverse,
+                             contents=(),
+                             tree=None)
+        yield (folder, name_abs, entry)
@@ -0,0 +1,86 @@
+"""Copy each distinct file's contents to the Team Drive only once.
+
+Files that can't be moved are copied, and a file with several parents
+is copied once per parent -- and trees full of email attachments tend
+to have the same file in lots of different folders, too.  Each of
+those copies is a slow API call and another copy of the bytes in the
+Team Drive.
+
+A DedupIndex is filled in from the folder listings during the crawl
+(see read_source_tree()): Drive gives the md5Checksum and size of
+every file with contents (i.e., everything except Google Docs /
+Sheets / etc.), and files with the same checksum and size have the
+same contents.  The first file with given contents to be copied (or
+moved) into the Team Drive is the copy; the rest of them become
+shortcuts to it (SHORTCUT), or are left out altogether (ONCE).
+
+"""
+
+import logging
+import threading
+
+from concurrent.futures import Future
+
+log = logging.getLogger('FToTD')
+
+# What to do with the other files with the same contents
+SHORTCUT = 'shortcut'
+ONCE     = 'once'
+modes    = [ SHORTCUT, ONCE ]
+
+shortcut_mime_type = 'application/vnd.google-apps.shortcut'
+
+#-------------------------------------------------------------------
+
+class DedupIndex:
+    def __init__(self):
+        self._keys   = dict()   # file ID -> (md5 bytes, size)
+        self._copies = dict()   # key -> Future of the Team Drive file ID
+        self._lock   = threading.Lock()
+
+    # Add the files in a folder listing (raw hashes from the API)
+    def add_listing(self, files):
+        for file in files:
+            md5 = file.get('md5Checksum', None)
+            if md5 is None or file['id'] in self._keys:
+                continue
+            # 16 bytes instead of a 32 character string
+            self._keys[file['id']] = (bytes.fromhex(md5),
+                                      int(file.get('size', 0)))
+
+    # The contents key of a file, or None if it doesn't have one
+    def key(self, file_id):
+        return self._keys.get(file_id, None)
+
+    # Call this before copying a file.  Returns (future, first):
+    #
+    # - first is True if this is the first file with these contents (or
+    #   we don't know its contents), i.e., it should be copied.  The
+    #   caller must then set_result() the future (if it's not None)
+    #   with the ID of the copy, or None if copying failed.
+    # - Otherwise, the future will give the ID of the Team Drive file
+    #   that has these contents (or None if copying it failed).
+    def claim(self, file_id):
+        key = self.key(file_id)
+        if key is None:
+            return (None, True)
+
+        with self._lock:
+            if key in self._copies:
+                return (self._copies[key], False)
+            future = Future()
+            self._copies[key] = future
+            return (future, True)
+
+    # Call this after moving a file into the Team Drive, so that other
+    # files with the same contents can be shortcuts to it
+    def moved(self, file_id):
+        key = self.key(file_id)
+        if key is None:
+            return
+
+        with self._lock:
+            if key not in self._copies:
+                future = Future()
+                future.set_result(file_id)
+                self._copies[key] = future
@@ -0,0 +1,161 @@
+"""Append-only journal of what a migration has done so far.
+
+Each line of the journal is a JSON record of one completed step:
+
+    {"type": "team_drive", "source": <source root ID>, "id": ..., "name": ...}
+    {"type": "folder", "source": <source folder ID>, "parent": <team folder ID>, "id": ..., "name": ..., ...}
+    {"type": "file", "source": <source file ID>, "parent": <team folder ID>, "action": "moved"|"copied"|"shortcut"|"deduplicated"}
+
+Files and folders are keyed by both their source ID and the Team
+Drive folder they went into, because files with multiple parents are
+copied once per parent, and folders with multiple parents are made
+once per parent.
+
+If the migration dies partway through, re-running it with the same
+journal skips everything the journal says is already done (without
+making any API calls for it), so that folders are not created twice
+and files are not copied twice.
+
+The journal is fsync'ed in batches to keep the overhead down.  Folder
+records are synced right away, though: a folder that was created but
+not journaled would be created again on resume.
+
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+log = logging.getLogger('FToTD')
+
+# Sync the journal after this many records or this many seconds,
+# whichever comes first
+sync_records = 100
+sync_seconds = 5
+
+#-------------------------------------------------------------------
+
+# Yield the records in a journal, skipping any line that was cut off
+# by a crash
+def read_records(filename):
+    with open(filename) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Most likely the last line, cut off by a crash
+                log.info("Ignoring partial journal line: {0}"
+                         .format(line.strip()))
+                continue
+            yield record
+
+#-------------------------------------------------------------------
+
+class Journal:
+    def __init__(self, filename, resume=False):
+        self.filename    = filename
+        self.team_drives = dict()   # source root ID -> record
+        self.folders     = dict()   # (source folder ID, team folder ID) -> record
+        self.files       = set()    # (source file ID, team folder ID)
+
+        self._lock      = threading.Lock()
+        self._unsynced  = 0
+        self._last_sync = time.monotonic()
+
+        if resume:
+            self._load()
+        self._fp = open(filename, 'a')
+
+        # If a crash cut off the last line, don't append to it
+        if self._fp.tell() > 0:
+            with open(filename, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    self._fp.write('\n')
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            log.info("No journal {0} to resume from; starting fresh"
+                     .format(self.filename))
+            return
+
+        for record in read_records(self.filename):
+            if record['type'] == 'team_drive':
+                self.team_drives[record['source']] = record
+            elif record['type'] == 'folder':
+                # Older journals don't have the parent, but it is the
+                # same as the Team Drive folder's own parent
+                parent = record.get('parent', None)
+                if parent is None:
+                    parent = record['parents'][0]
+                self.folders[(record['source'], parent)] = record
+            elif record['type'] == 'file':
+                self.files.add((record['source'], record['parent']))
+
+        log.info("Resuming from journal {0}: {1} folders and {2} files already done"
+                 .format(self.filename, len(self.folders), len(self.files)))
+
+    #-------------------------------------------------------------------
+
+    def team_drive(self, source_id):
+        return self.team_drives.get(source_id, None)
+
+    def folder(self, source_id, team_parent_id):
+        return self.folders.get((source_id, team_parent_id), None)
+
+    def file_done(self, source_id, team_parent_id):
+        return (source_id, team_parent_id) in self.files
+
+    #-------------------------------------------------------------------
+
+    def record_team_drive(self, source_id, team_drive):
+        record = { 'type'   : 'team_drive',
+                   'source' : source_id,
+                   'id'     : team_drive.id,
+                   'name'   : team_drive.name }
+        self.team_drives[source_id] = record
+        self._write(record, sync=True)
+
+    def record_folder(self, source_id, team_parent_id, team_folder):
+        record = { 'type'        : 'folder',
+                   'source'      : source_id,
+                   'parent'      : team_parent_id,
+                   'id'          : team_folder.id,
+                   'name'        : team_folder.name,
+                   'parents'     : team_folder.parents,
+                   'webViewLink' : team_folder.webViewLink }
+        self.folders[(source_id, team_parent_id)] = record
+        self._write(record, sync=True)
+
+    def record_file(self, source_id, team_parent_id, action):
+        record = { 'type'   : 'file',
+                   'source' : source_id,
+                   'parent' : team_parent_id,
+                   'action' : action }
+        self.files.add((source_id, team_parent_id))
+        self._write(record)
+
+    #-------------------------------------------------------------------
+
+    def _write(self, record, sync=False):
+        with self._lock:
+            self._fp.write(json.dumps(record) + '\n')
+            self._unsynced = self._unsynced + 1
+
+            if (sync or self._unsynced >= sync_records or
+                time.monotonic() - self._last_sync >= sync_seconds):
+                self._sync()
+
+    # Must be called with self._lock held
+    def _sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._unsynced  = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._fp.close()
@@ -0,0 +1,85 @@
+"""Read a manifest of folders for gxcopy.py --manifest to migrate.
+
+Instead of running gxcopy.py once per shared folder (and logging in,
+setting up, and re-learning the Team Drives every time), a manifest
+lists all the source folder -> Team Drive pairs, and gxcopy.py
+migrates them all in one process (see run_manifest() in gxcopy.py).
+
+A manifest is a CSV file with a header line:
+
+    source_folder_id,dest_team_drive
+    0B1234...,Finance
+    0B5678...,
+
+or (if the filename ends in .yaml or .yml, and PyYAML is installed) a
+YAML list of the same:
+
+    - source_folder_id: 0B1234...
+      dest_team_drive: Finance
+    - source_folder_id: 0B5678...
+
+dest_team_drive is optional, and means the same as gxcopy.py's
+--dest-team-drive: the (existing) Team Drive to migrate into.  Without
+it, a Team Drive named after the source folder is made.  CSV lines
+that start with "#" are ignored.
+
+"""
+
+import csv
+
+fields = [ 'source_folder_id', 'dest_team_drive' ]
+
+#-------------------------------------------------------------------
+
+def _read_csv(filename):
+    with open(filename, newline='') as f:
+        lines = (line for line in f if not line.lstrip().startswith('#'))
+        return list(csv.DictReader(lines))
+
+def _read_yaml(filename):
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError("YAML manifests need PyYAML (pip install --upgrade pyyaml); or use a CSV manifest")
+
+    with open(filename) as f:
+        entries = yaml.safe_load(f)
+    if not isinstance(entries, list):
+        raise ValueError("expected a list of source_folder_id / dest_team_drive entries")
+    return entries
+
+# Returns a list of hashes with 'source_folder_id' and
+# 'dest_team_drive' (None if not given), in the order they are in the
+# manifest.  Raises ValueError if the manifest is no good.
+def load_manifest(filename):
+    if filename.endswith(('.yaml', '.yml')):
+        entries = _read_yaml(filename)
+    else:
+        entries = _read_csv(filename)
+
+    manifest = list()
+    seen     = set()
+    for i, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise ValueError("entry {0} is not a source_folder_id / dest_team_drive pair"
+                             .format(i))
+        unknown = set(entry) - set(fields)
+        if unknown:
+            raise ValueError("entry {0}: unknown field(s): {1}"
+                             .format(i, ', '.join(sorted(str(u) for u in unknown))))
+
+        source = str(entry.get('source_folder_id') or '').strip()
+        dest   = str(entry.get('dest_team_drive') or '').strip()
+        if not source:
+            raise ValueError("entry {0} has no source_folder_id".format(i))
+        if source in seen:
+            raise ValueError("source folder {0} is in the manifest more than once"
+                             .format(source))
+        seen.add(source)
+
+        manifest.append({ 'source_folder_id' : source,
+                          'dest_team_drive'  : dest or None })
+
+    if not manifest:
+        raise ValueError("no folders to migrate")
+    return manifest
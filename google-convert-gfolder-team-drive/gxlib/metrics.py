@@ -0,0 +1,239 @@
+"""Counters and latency histograms for every Drive API call.
+
+doit() (and the batch queue) report every try of every call here:
+which API method it was (files.list, files.update, ...), which
+credential it went out on, how long it took, and how it turned out:
+
+- success: it worked
+- retry:   it failed in a way that we retry (e.g., a rate limit)
+- failure: it failed in a way that the caller allowed (e.g., a 403
+           on a move), or it was retried too many times
+- error:   it failed in a way that aborts the script
+
+Calls are also counted per "phase" (e.g., crawl, folders, files), as
+set by the scripts with set_phase().
+
+The numbers can be reported three ways (see start_reporting()):
+
+- a progress line, printed every so often
+- a Prometheus textfile (e.g., for node_exporter's textfile
+  collector), rewritten every so often and at exit
+- a JSON summary, written at exit
+
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+
+SUCCESS = 'success'
+RETRY   = 'retry'
+FAILURE = 'failure'
+ERROR   = 'error'
+outcomes = [ SUCCESS, RETRY, FAILURE, ERROR ]
+
+# Upper bounds of the latency histogram buckets, in seconds
+latency_buckets = [ 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ]
+
+_lock      = threading.Lock()
+_start     = time.time()
+_phase     = 'startup'
+_counts    = dict()     # (method, credential, outcome) -> count
+_phases    = dict()     # phase -> count
+_latencies = dict()     # method -> [ bucket counts..., +Inf count, sum ]
+_cred_names = dict()    # id(credentials) -> name
+_http_creds = dict()    # id(http) -> credential name
+
+####################################################################
+
+# Give a credential a name to report its calls under (e.g., the email
+# address that it's for).  Unnamed credentials are numbered.
+def register_credentials(http, credentials, name=None):
+    with _lock:
+        key = id(credentials)
+        if key not in _cred_names:
+            _cred_names[key] = name or 'credential{0}'.format(len(_cred_names) + 1)
+        _http_creds[id(http)] = _cred_names[key]
+
+def credential_name(http):
+    return _http_creds.get(id(http), 'unknown')
+
+# Same, for calls that don't go out on an Http object (see gxlib/aio.py)
+def credentials_name(credentials):
+    return _cred_names.get(id(credentials), 'unknown')
+
+# e.g., "files.list" (or "batch" for a batch request)
+def method_name(httpref):
+    method_id = getattr(httpref, 'methodId', None)
+    if method_id:
+        return method_id.split('.', 1)[-1]
+    if type(httpref).__name__ == 'BatchHttpRequest':
+        return 'batch'
+    return '{0} {1}'.format(getattr(httpref, 'method', '?'),
+                            getattr(httpref, 'uri', '?').split('?')[0])
+
+def set_phase(phase):
+    global _phase
+    with _lock:
+        _phase = phase
+
+# latency is in seconds, or None if it's not known (e.g., for the
+# individual calls in a batch request)
+def record(method, credential, outcome, latency=None):
+    with _lock:
+        key = (method, credential, outcome)
+        _counts[key] = _counts.get(key, 0) + 1
+        _phases[_phase] = _phases.get(_phase, 0) + 1
+
+        if latency is not None:
+            if method not in _latencies:
+                _latencies[method] = [ 0 ] * (len(latency_buckets) + 2)
+            hist = _latencies[method]
+            for i, bound in enumerate(latency_buckets):
+                if latency <= bound:
+                    hist[i] = hist[i] + 1
+                    break
+            else:
+                hist[len(latency_buckets)] += 1
+            hist[-1] = hist[-1] + latency
+
+####################################################################
+
+# Everything, as a hash (this is what goes in the JSON summary)
+def summary():
+    with _lock:
+        counts    = dict(_counts)
+        phases    = dict(_phases)
+        latencies = { k : list(v) for k, v in _latencies.items() }
+
+    elapsed = time.time() - _start
+    methods = dict()
+    credentials = dict()
+    totals = { outcome : 0 for outcome in outcomes }
+    for (method, credential, outcome), count in counts.items():
+        m = methods.setdefault(method, { outcome : 0 for outcome in outcomes })
+        m[outcome] = m[outcome] + count
+        c = credentials.setdefault(credential, { 'calls' : 0 })
+        c['calls'] = c['calls'] + count
+        totals[outcome] = totals[outcome] + count
+
+    for method, hist in latencies.items():
+        timed = sum(hist[:-1])
+        methods[method]['latency'] = {
+            'count'   : timed,
+            'sum'     : hist[-1],
+            'average' : hist[-1] / timed if timed else 0,
+            'buckets' : { str(bound) : count for bound, count
+                          in zip(latency_buckets + [ '+Inf' ], hist[:-1]) },
+        }
+    for c in credentials.values():
+        c['per_second'] = c['calls'] / elapsed if elapsed > 0 else 0
+
+    return {
+        'elapsed'     : elapsed,
+        'calls'       : sum(totals.values()),
+        'outcomes'    : totals,
+        'methods'     : methods,
+        'credentials' : credentials,
+        'phases'      : phases,
+    }
+
+def progress_line():
+    s = summary()
+    rate = s['calls'] / s['elapsed'] if s['elapsed'] > 0 else 0
+    line = ("API: {0} calls in {1:.0f}s ({2:.1f}/s), {3} retries, {4} failures [{5}]"
+            .format(s['calls'], s['elapsed'], rate,
+                    s['outcomes'][RETRY], s['outcomes'][FAILURE], _phase))
+
+    busiest = sorted(s['methods'].items(),
+                     key=lambda item: -sum(item[1][o] for o in outcomes))
+    for method, m in busiest[:4]:
+        line = line + "; {0}: {1}".format(method, m[SUCCESS])
+        if 'latency' in m:
+            line = line + " avg {0:.2f}s".format(m['latency']['average'])
+    return line
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus_text():
+    with _lock:
+        counts    = dict(_counts)
+        phases    = dict(_phases)
+        latencies = { k : list(v) for k, v in _latencies.items() }
+
+    lines = [ '# HELP gx_api_calls_total Drive API calls (each try counts)',
+              '# TYPE gx_api_calls_total counter' ]
+    for (method, credential, outcome), count in sorted(counts.items()):
+        lines.append('gx_api_calls_total{{method="{0}",credential="{1}",outcome="{2}"}} {3}'
+                     .format(_label(method), _label(credential), outcome, count))
+
+    lines.extend([ '# HELP gx_api_call_duration_seconds Drive API call latency',
+                   '# TYPE gx_api_call_duration_seconds histogram' ])
+    for method, hist in sorted(latencies.items()):
+        cumulative = 0
+        for bound, count in zip(latency_buckets + [ '+Inf' ], hist[:-1]):
+            cumulative = cumulative + count
+            lines.append('gx_api_call_duration_seconds_bucket{{method="{0}",le="{1}"}} {2}'
+                         .format(_label(method), bound, cumulative))
+        lines.append('gx_api_call_duration_seconds_sum{{method="{0}"}} {1}'
+                     .format(_label(method), hist[-1]))
+        lines.append('gx_api_call_duration_seconds_count{{method="{0}"}} {1}'
+                     .format(_label(method), cumulative))
+
+    lines.extend([ '# HELP gx_api_phase_calls_total Drive API calls per phase of the script',
+                   '# TYPE gx_api_phase_calls_total counter' ])
+    for phase, count in sorted(phases.items()):
+        lines.append('gx_api_phase_calls_total{{phase="{0}"}} {1}'
+                     .format(_label(phase), count))
+
+    lines.extend([ '# HELP gx_elapsed_seconds Seconds since the script started',
+                   '# TYPE gx_elapsed_seconds gauge',
+                   'gx_elapsed_seconds {0}'.format(time.time() - _start) ])
+    return '\n'.join(lines) + '\n'
+
+# Write to a temp file and rename it into place so that whoever is
+# reading it never sees half a file
+def _write_atomically(filename, text):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+####################################################################
+
+# Report the numbers as the script runs, and when it exits (including
+# when doit() gives up and exits).
+#
+# interval: seconds between progress lines / textfile updates (0
+#           means only at exit)
+# progress: whether to print progress lines
+# textfile: Prometheus textfile to write, or None
+# json_file: JSON summary to write at exit, or None
+def start_reporting(interval=0, progress=False, textfile=None,
+                    json_file=None):
+    def report():
+        if progress:
+            print(progress_line(), flush=True)
+        if textfile:
+            _write_atomically(textfile, prometheus_text())
+
+    def at_exit():
+        if progress or textfile:
+            report()
+        if json_file:
+            _write_atomically(json_file,
+                              json.dumps(summary(), indent=1) + '\n')
+
+    atexit.register(at_exit)
+
+    if interval > 0 and (progress or textfile):
+        def reporter():
+            while True:
+                time.sleep(interval)
+                report()
+
+        t = threading.Thread(target=reporter, daemon=True)
+        t.start()
@@ -0,0 +1,276 @@
+"""Offline planning of a Google Folder -> Team Drive migration.
+
+Given a crawl of the source tree, work out everything that migrating it
+would take -- which folders to make, which files can be moved (and with
+which credential), and which have to be copied -- without making any
+API calls.  The plan is written to a JSON file that gxcopy.py --apply
+can execute later.
+
+Plan file layout:
+
+    {
+      "version": 1,
+      "source_folder": {"id": ..., "name": ...},
+      "team_drive_name": ...,
+      "dest_team_drive": <name, or null for a new Team Drive>,
+      "owning_domain": "@...",
+      "folders": [ {"source": <ID>, "name": ..., "parent": <index or null>,
+                    "depth": <int>, "traverse": <bool>}, ... ],
+      "files":   [ {"source": <ID>, "name": ..., "parent": <index or null>,
+                    "remove_parent": <source parent ID>,
+                    "action": "move" | "copy" | "shortcut" | "skip",
+                    "credential": "admin" | <email>,
+                    "rename": <string or null>,
+                    "target": <index, for "shortcut" / "skip">}, ... ],
+      "counts":  {...}
+    }
+
+"dest_team_drive" is the --dest-team-drive that the plan was made
+with: an existing Team Drive to migrate into.  If it is null, --apply
+makes a new Team Drive named after the source folder.  Plans written
+before this field existed don't have it (see planned_team_drive()).
+
+A "parent" is an index into the folders list (null means the top of
+the Team Drive).  The folders are listed in the order that they need
+to be made (i.e., every folder comes after its parent).
+
+With a DedupIndex (see gxlib/dedup.py), a file that would be copied
+but has the same contents as another file in the plan is not copied.
+Instead, it becomes a shortcut to that file ("shortcut"), or is left
+out ("skip").  Its "target" is the index (in the files list) of the
+file whose move / copy it dedups against.
+
+"""
+
+import json
+import logging
+
+log = logging.getLogger('FToTD')
+
+plan_version = 1
+
+ADMIN = 'admin'
+MOVE  = 'move'
+COPY  = 'copy'
+# Dedup'ed copies (see gxlib/dedup.py)
+SHORTCUT = 'shortcut'
+SKIP     = 'skip'
+
+#-------------------------------------------------------------------
+
+# Decide how to migrate a single file:
+#
+# 0. If the file has multiple parents, Google will not let us move it
+#    to the team drive.  Copy it instead, but put a "MULTIFILE" prefix
+#    on the destination filenames in the Team Drive so that the owners
+#    know that there's multiple copies.
+# 1. If the file is owned by a user in the same domain as the admin,
+#    move it with the admin credentials.
+# 2. If the file is owned by any of the user credentials, move it with
+#    the corresponding user credentials.
+# 3. Otherwise, copy the file.
+#
+# gfile: GFile of the file
+# owning_domain: "@domain" that owns the target team drive
+# user_addresses: set of email addresses we have user credentials for
+#
+# Returns (action, credential, rename), where credential is ADMIN or an
+# email address.
+def choose_file_action(gfile, owning_domain, user_addresses):
+    if len(gfile.parents) > 1:
+        log.info("  This file has multiple parents.")
+        log.info('  It will be copied to the Team Drive with a "MULTIFILE" prefix')
+        return (COPY, ADMIN, 'MULTIFILE ' + gfile.name)
+
+    # I think it's an anachronism that there can be multiple owners
+    # for a file (i.e., I don't think Google supports this any more),
+    # but cover our bases.
+    for owner in gfile.owners:
+        owner_name = owner['displayName']
+        owner_email = owner['emailAddress']
+
+        # Is this file owned by someone in the target domain?
+        if owner_email.endswith(owning_domain):
+            log.info("  This file is owned by {name} <{email}> in the target domain.  WE CAN MOVE IT."
+                     .format(name=owner_name,
+                             email=owner_email))
+            return (MOVE, ADMIN, None)
+
+        # If this file owned by someone for whom we have user
+        # credentials?
+        if owner_email in user_addresses:
+            log.info("  This file is owned by {name} <{email}>, for whom we have user credentials.  WE CAN MOVE IT."
+                     .format(name=owner_name,
+                             email=owner_email))
+            return (MOVE, owner_email, None)
+
+    return (COPY, ADMIN, None)
+
+#-------------------------------------------------------------------
+
+# Make a plan for migrating the source tree (from read_source_tree()).
+# This walks the tree in the same order as
+# migrate_folder_to_team_drive() in gxcopy.py and makes the same
+# decisions, but doesn't call Google.
+#
+# dedup: if not None, the DedupIndex filled in by the crawl, and
+# dedup_mode says what to do with the duplicates (dedup.SHORTCUT or
+# dedup.ONCE).
+def make_plan(source_root, owning_domain, user_addresses,
+              team_drive_name=None, dedup=None, dedup_mode=None):
+    user_addresses = set(user_addresses)
+    folders = list()
+    files   = list()
+
+    # (source tree, index of its team folder, depth, contents iterator)
+    stack = [ (source_root, None, 0, iter(source_root.contents)) ]
+    while stack:
+        (tree, parent, depth, contents) = stack[-1]
+        entry = next(contents, None)
+        if entry is None:
+            stack.pop()
+            continue
+
+        if entry.is_folder:
+            folders.append({
+                'source'   : entry.gfile.id,
+                'name'     : entry.gfile.name,
+                'parent'   : parent,
+                'depth'    : depth + 1,
+                'traverse' : entry.traverse,
+            })
+            if entry.traverse:
+                stack.append((entry.tree, len(folders) - 1, depth + 1,
+                              iter(entry.tree.contents)))
+        else:
+            (action, credential, rename) = \
+                choose_file_action(entry.gfile, owning_domain,
+                                   user_addresses)
+            files.append({
+                'source'        : entry.gfile.id,
+                'name'          : entry.gfile.name,
+                'parent'        : parent,
+                'remove_parent' : entry.gfile.parents[0],
+                'action'        : action,
+                'credential'    : credential,
+                'rename'        : rename,
+            })
+
+    if dedup is not None:
+        dedup_copies(files, dedup, dedup_mode)
+
+    # Make sure that every folder comes after its parent (the
+    # depth-first order above already does that, but apply wants to
+    # make them a level at a time)
+    order = sorted(range(len(folders)), key=lambda i: folders[i]['depth'])
+    new_index = { old : new for new, old in enumerate(order) }
+    folders = [ folders[i] for i in order ]
+    for item in folders + files:
+        if item['parent'] is not None:
+            item['parent'] = new_index[item['parent']]
+
+    plan = {
+        'version'         : plan_version,
+        'source_folder'   : { 'id'   : source_root.root_folder.id,
+                              'name' : source_root.root_folder.name },
+        'team_drive_name' : team_drive_name or source_root.root_folder.name,
+        'dest_team_drive' : team_drive_name,
+        'owning_domain'   : owning_domain,
+        'folders'         : folders,
+        'files'           : files,
+    }
+    plan['counts'] = count_plan(plan)
+    return plan
+
+# Pick one file for each distinct contents key to carry those contents
+# into the Team Drive, and turn the copies of all the others into
+# shortcuts to it (or skip them).  A file that is moved is preferred,
+# since moving costs no storage; otherwise it's the first copy.  Files
+# that are moved are left alone, even if they are duplicates.
+def dedup_copies(files, dedup, dedup_mode):
+    targets = dict()
+    for i, file in enumerate(files):
+        key = dedup.key(file['source'])
+        if key is None:
+            continue
+        if key not in targets or (file['action'] == MOVE and
+                                  files[targets[key]]['action'] != MOVE):
+            targets[key] = i
+
+    for i, file in enumerate(files):
+        key = dedup.key(file['source'])
+        if file['action'] != COPY or key is None or targets[key] == i:
+            continue
+        file['action'] = SHORTCUT if dedup_mode == SHORTCUT else SKIP
+        file['target'] = targets[key]
+
+#-------------------------------------------------------------------
+
+# Expected API call counts for a plan (not counting retries, or moves
+# that fail and have to be copied after all)
+def count_plan(plan):
+    moves     = dict()
+    copies    = 0
+    shortcuts = 0
+    skips     = 0
+    for file in plan['files']:
+        if file['action'] == MOVE:
+            moves[file['credential']] = moves.get(file['credential'], 0) + 1
+        elif file['action'] == SHORTCUT:
+            shortcuts = shortcuts + 1
+        elif file['action'] == SKIP:
+            skips = skips + 1
+        else:
+            copies = copies + 1
+
+    depth = 0
+    if plan['folders']:
+        depth = plan['folders'][-1]['depth']
+
+    return {
+        'folders'      : len(plan['folders']),
+        'folder_depth' : depth,
+        'moves'        : moves,
+        'copies'       : copies,
+        'shortcuts'    : shortcuts,
+        'deduplicated' : shortcuts + skips,
+        'api_calls'    : (len(plan['folders']) + sum(moves.values()) +
+                          copies + shortcuts),
+    }
+
+def print_plan_summary(plan):
+    counts = plan['counts']
+    print('Plan for migrating "{0}" to Team Drive "{1}":'
+          .format(plan['source_folder']['name'], plan['team_drive_name']))
+    print("  Folders to make:  {0} ({1} levels deep)"
+          .format(counts['folders'], counts['folder_depth']))
+    for credential, count in sorted(counts['moves'].items()):
+        print("  Files to move as {0}: {1}".format(credential, count))
+    print("  Files to copy:    {0}".format(counts['copies']))
+    if counts.get('deduplicated'):
+        print("  Copies saved by dedup: {0} ({1} shortcuts)"
+              .format(counts['deduplicated'], counts['shortcuts']))
+    print("  Expected API calls: {0}".format(counts['api_calls']))
+
+#-------------------------------------------------------------------
+
+def save_plan(filename, plan):
+    with open(filename, 'w') as f:
+        json.dump(plan, f, indent=1)
+    log.info("Wrote plan to {0}".format(filename))
+
+# The existing Team Drive that a plan is for (i.e., its
+# --dest-team-drive), or None if it is for a new one
+def planned_team_drive(plan):
+    if 'dest_team_drive' in plan:
+        return plan['dest_team_drive']
+    if plan['team_drive_name'] != plan['source_folder']['name']:
+        return plan['team_drive_name']
+    return None
+
+def load_plan(filename):
+    with open(filename) as f:
+        plan = json.load(f)
+    if plan.get('version') != plan_version:
+        raise ValueError("{0}: unknown plan version".format(filename))
+    return plan
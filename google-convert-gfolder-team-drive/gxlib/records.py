@@ -0,0 +1,90 @@
+"""Recordclasses and constants shared by the Drive scripts."""
+
+from recordclass import recordclass
+
+doc_mime_type = 'application/vnd.google-apps.document';
+sheet_mime_type = 'application/vnd.google-apps.spreadsheet';
+folder_mime_type = 'application/vnd.google-apps.folder'
+# JMS this is probably a lie, but it's useful for comparisons
+team_drive_mime_type = 'application/vnd.google-apps.team_drive'
+
+#-------------------------------------------------------------------
+
+# Recordclasses are effecitvely namedtuples that are mutable (i.e.,
+# support assignment). These are the recordclasses that are used in
+# the rest of the scripts.
+
+GFile = recordclass('GFile',
+                   ['id',           # string
+                    'webViewLink',  # string (URL)
+                    'mimeType',     # string
+                    'name',         # string
+                    'owners',       # array of hashes: 'displayName', 'emailAddress', 'kind', 'me', 'permissionId'
+                    'parents',      # list of strings (each an ID)
+                    'team_file',    # GFile or None
+                    ])
+Tree = recordclass('Tree',
+                  ['root_folder',   # See comment in gxlib/crawl.py
+                   'contents'])
+ContentEntry = recordclass('ContentEntry',
+                          ['gfile',      # GFile
+                           'is_folder',  # boolean
+                           'traverse',   # boolean
+                           'contents',   # list of ContentEntry's
+                           'tree'        # Tree
+                           ])
+AllFiles = recordclass('AllFiles',
+                      ['name',           # string
+                       'webViewLink',    # string (URL)
+                       'parents',        # array of Parent records
+                       'is_folder',      # boolean
+                       'owners',         # array of hashes: 'displayName', 'emailAddress' (see intern_owners())
+                       'team_file',      # GFile
+                       ])
+
+# There is one Parent record per folder, shared by everything in that
+# folder.  The absolute name of the folder is not stored; it is
+# computed on demand by walking up the parent records (so that a tree
+# with N items doesn't need N copies of long path strings).
+class Parent:
+    __slots__ = ('id',             # string
+                 'name',           # string
+                 'webViewLink',    # string (URL)
+                 'up',             # Parent of the enclosing folder, or a string prefix
+                 )
+
+    def __init__(self, id, name, webViewLink, up=''):
+        self.id          = id
+        self.name        = name
+        self.webViewLink = webViewLink
+        self.up          = up
+
+    @property
+    def name_abs(self):
+        names = list()
+        p = self
+        while isinstance(p, Parent):
+            names.append(p.name)
+            p = p.up
+        names.append(p)
+        return '/'.join(reversed(names))
+
+    def __repr__(self):
+        return ("Parent(id={0!r}, name={1!r}, name_abs={2!r}, webViewLink={3!r})"
+                .format(self.id, self.name, self.name_abs, self.webViewLink))
+
+#-------------------------------------------------------------------
+
+# Google returns a fresh copy of the owners list (with a handful of
+# keys that we don't use) for every single file.  Share one copy per
+# distinct set of owners instead.
+_owners_table = dict()
+
+def intern_owners(owners):
+    key = tuple((o.get('displayName'), o.get('emailAddress'))
+                for o in owners)
+    if key not in _owners_table:
+        _owners_table[key] = [ { 'displayName'  : name,
+                                 'emailAddress' : email }
+                               for (name, email) in key ]
+    return _owners_table[key]
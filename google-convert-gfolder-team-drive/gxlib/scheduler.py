@@ -0,0 +1,99 @@
+"""Spread Drive API calls across all the credentials that we have.
+
+Google's Drive quotas are per user, but left to itself gxcopy.py sends
+nearly everything (the whole crawl, and every copy) through the
+admin's credentials; the user credentials are only used to move each
+user's own files.  So the admin's quota caps the speed of the whole
+migration while the users' quotas sit idle.
+
+A QuotaScheduler knows all the credentials (the admin and each user).
+For each call, the caller says which credentials are allowed to make
+it, and the scheduler hands out the service of the one with the most
+budget left: the tokens left in its bucket (see gxlib/api.py) minus
+the calls that are going out on it right now.  A credential that has
+just hit a rate limit has a negative budget (its bucket is paused),
+so calls go elsewhere until it recovers.  Ties are broken round robin.
+
+Who is allowed to do what:
+
+- Reading a file or listing a folder: the admin, or the owner of the
+  file / folder (everything in a folder is visible to its owner).
+- Moving a file: the owner (or the admin, if the owner is in the
+  owning domain); see choose_file_action() in gxlib/plan.py.
+- Copying a file: anyone who can read it.  The user credentials might
+  not be able to write to the Team Drive, though, so callers should
+  fall back to the admin if a user's copy is refused.
+
+"""
+
+import logging
+import threading
+import contextlib
+
+from gxlib.api import remaining_budget
+from gxlib.plan import ADMIN
+
+log = logging.getLogger('FToTD')
+
+#-------------------------------------------------------------------
+
+class QuotaScheduler:
+    # admin_service: service with the admin's credentials
+    # user_services: list of { 'address' : ..., 'service' : ... }
+    def __init__(self, admin_service, user_services):
+        self._services = { ADMIN : admin_service }
+        for us in user_services:
+            self._services[us['address']] = us['service']
+        self._busy  = { name : 0 for name in self._services }
+        self._turn  = 0
+        self._lock  = threading.Lock()
+
+    # The credentials (of the ones we have) that can read something
+    # with these owners
+    def readers(self, owners):
+        return [ ADMIN ] + [ owner['emailAddress'] for owner in owners
+                             if owner['emailAddress'] in self._services ]
+
+    # The credentials that can move a file, given the credential that
+    # choose_file_action() picked
+    def movers(self, gfile, credential):
+        if credential != ADMIN:
+            return [ credential ]
+        return self.readers(gfile.owners)
+
+    # Must be called with self._lock held
+    def _pick(self, names):
+        self._turn = (self._turn + 1) % len(names)
+        best       = None
+        best_score = None
+        for name in names[self._turn:] + names[:self._turn]:
+            budget = remaining_budget(self._services[name])
+            score  = (budget or 0) - self._busy[name]
+            if best is None or score > best_score:
+                best       = name
+                best_score = score
+        return best
+
+    # Pick a credential for a call that will be made later (e.g., put
+    # on a batch queue).  Returns (name, service).
+    def pick(self, names):
+        with self._lock:
+            name = self._pick(names)
+        return (name, self._services[name])
+
+    # Pick a credential for a call that is made right now, i.e.:
+    #
+    #    with scheduler.service(names) as (name, service):
+    #        doit(service.files()...)
+    #
+    # The credential counts as busy until the with block is done.
+    @contextlib.contextmanager
+    def service(self, names):
+        with self._lock:
+            name = self._pick(names)
+            self._busy[name] = self._busy[name] + 1
+        try:
+            yield (name, self._services[name])
+        finally:
+            with self._lock:
+                self._busy[name] = self._busy[name] - 1
@@ -0,0 +1,288 @@
+"""Save a crawl of a source tree to disk, and read the tree back from it.
+
+Every script crawls its source tree from scratch, even if another one
+crawled the same folder an hour ago.  With --save-snapshot, the crawl
+is also written to a snapshot file; with --from-snapshot, the tree is
+read from the snapshot instead of from Google (so, e.g., gxcopy.py can
+migrate what scan-and-report.py just scanned, and reports can be
+redone offline).
+
+A snapshot is a SQLite file (Python's own sqlite3 module; nothing to
+install) of the raw listing of every folder in the tree -- the same
+thing that gxlib/changes.py saves for incremental rescans -- plus the
+root folder of the crawl.  The tree is rebuilt by handing those
+listings to build_tree() (see SnapshotFetcher), so the Tree /
+all_files / owners / parents structures that come out are exactly the
+same as after a crawl, and all of the scripts can use them.
+
+The listings are in one table, clustered by (folder, position in the
+listing), so reading a folder's listing is a single indexed range scan
+of contiguous pages.  Distinct owner lists and mimeTypes are stored
+once each and referred to by number.  The file is memory-mapped when
+it is read, rather than read() and parsed.
+
+The snapshot is written to a temporary file that is renamed into
+place once the crawl is done, so a crawl that dies partway through
+never leaves a partial snapshot behind.
+
+A snapshot is a picture of the tree at the time of the crawl: anything
+that has changed in Drive since then isn't in it.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import urllib.request
+
+from gxlib.crawl import build_tree
+from gxlib.records import GFile
+
+log = logging.getLogger('FToTD')
+
+# Bump this if the layout of the snapshot changes
+snapshot_version = 1
+
+# How much of the snapshot to memory-map when reading it
+mmap_bytes = 1 << 30
+
+schema = [
+    """CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)""",
+    # Every folder that was listed (even if it was empty)
+    """CREATE TABLE folders (id TEXT PRIMARY KEY) WITHOUT ROWID""",
+    """CREATE TABLE mime_types (id INTEGER PRIMARY KEY,
+                                mime_type TEXT NOT NULL UNIQUE)""",
+    # JSON list of { displayName, emailAddress } (see intern_owners())
+    """CREATE TABLE owner_lists (id INTEGER PRIMARY KEY,
+                                 owners TEXT NOT NULL UNIQUE)""",
+    """CREATE TABLE items (folder      TEXT NOT NULL,
+                           position    INTEGER NOT NULL,
+                           id          TEXT NOT NULL,
+                           name        TEXT NOT NULL,
+                           mime_type   INTEGER NOT NULL,
+                           parents     TEXT NOT NULL,
+                           owners      INTEGER,
+                           webViewLink TEXT,
+                           size        TEXT,
+                           md5Checksum TEXT,
+                           PRIMARY KEY (folder, position)) WITHOUT ROWID""",
+]
+
+#-------------------------------------------------------------------
+
+# Write a snapshot as the tree is crawled.  A SnapshotWriter can be
+# given to read_source_tree() as its listings hash (see
+# RecordingFetcher in gxlib/crawl.py): each folder's listing is written
+# out as it is handed to build_tree(), instead of being kept in memory.
+# Call close() once the crawl is done to put the snapshot in place.
+#
+# root_folder: GFile of the top of the crawl
+# team_drive_id: ID of the Team Drive being crawled, or None
+# tool: name of the script that made the snapshot (for the log)
+class SnapshotWriter:
+    def __init__(self, filename, root_folder, team_drive_id=None,
+                 tool=None):
+        self.filename = filename
+        self._tmp     = filename + '.tmp'
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+        self._db = sqlite3.connect(self._tmp)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        for statement in schema:
+            self._db.execute(statement)
+
+        self._mime_types  = dict()
+        self._owner_lists = dict()
+        self._count       = 0
+
+        root = { 'id'          : root_folder.id,
+                 'name'        : root_folder.name,
+                 'mimeType'    : root_folder.mimeType,
+                 'webViewLink' : root_folder.webViewLink,
+                 'parents'     : root_folder.parents,
+                 'owners'      : root_folder.owners }
+        self._db.executemany('INSERT INTO meta VALUES (?, ?)',
+                             [ ('version', str(snapshot_version)),
+                               ('root', json.dumps(root)),
+                               ('team_drive_id', json.dumps(team_drive_id)),
+                               ('tool', tool or ''),
+                               ('created', str(int(time.time()))) ])
+
+    def _mime_type(self, mime_type):
+        id = self._mime_types.get(mime_type, None)
+        if id is None:
+            id = len(self._mime_types) + 1
+            self._mime_types[mime_type] = id
+            self._db.execute('INSERT INTO mime_types VALUES (?, ?)',
+                             (id, mime_type))
+        return id
+
+    def _owners(self, owners):
+        if owners is None:
+            return None
+        key = json.dumps([ { 'displayName'  : o.get('displayName'),
+                             'emailAddress' : o.get('emailAddress') }
+                           for o in owners ])
+        id = self._owner_lists.get(key, None)
+        if id is None:
+            id = len(self._owner_lists) + 1
+            self._owner_lists[key] = id
+            self._db.execute('INSERT INTO owner_lists VALUES (?, ?)',
+                             (id, key))
+        return id
+
+    # Save one folder's listing (raw hashes from the API)
+    def __setitem__(self, folder_id, files):
+        self._db.execute('INSERT OR REPLACE INTO folders VALUES (?)',
+                         (folder_id,))
+        self._db.execute('DELETE FROM items WHERE folder = ?',
+                         (folder_id,))
+        self._db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             [ (folder_id, i, file['id'], file['name'],
+                                self._mime_type(file['mimeType']),
+                                ' '.join(file.get('parents', [])),
+                                self._owners(file.get('owners', None)),
+                                file.get('webViewLink', None),
+                                file.get('size', None),
+                                file.get('md5Checksum', None))
+                               for i, file in enumerate(files) ])
+        self._count = self._count + len(files)
+
+    # Put the snapshot in place
+    def close(self):
+        self._db.commit()
+        self._db.close()
+        os.replace(self._tmp, self.filename)
+        log.info("Saved snapshot of {0} items to {1}"
+                 .format(self._count, self.filename))
+
+#-------------------------------------------------------------------
+
+# A snapshot, opened for reading.  Raises ValueError if the file is not
+# a snapshot that we can read.
+#
+# .root: GFile of the top of the crawl
+# .team_drive_id: ID of the Team Drive that was crawled, or None
+# .tool: name of the script that made the snapshot
+# .created: when the snapshot was made (seconds since the epoch)
+class Snapshot:
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise ValueError("no such file")
+
+        self.filename = filename
+        try:
+            url = urllib.request.pathname2url(os.path.abspath(filename))
+            self._db = sqlite3.connect('file:{0}?mode=ro'.format(url),
+                                       uri=True, check_same_thread=False)
+            self._db.execute('PRAGMA mmap_size = {0}'.format(mmap_bytes))
+            meta = dict(self._db.execute('SELECT key, value FROM meta'))
+        except sqlite3.DatabaseError as e:
+            raise ValueError("not a snapshot ({0})".format(e))
+
+        if meta.get('version') != str(snapshot_version):
+            raise ValueError("unknown snapshot version {0}"
+                             .format(meta.get('version')))
+
+        root = json.loads(meta['root'])
+        self.root = GFile(id=root['id'],
+                          mimeType=root['mimeType'],
+                          webViewLink=root['webViewLink'],
+                          name=root['name'],
+                          parents=root['parents'],
+                          owners=root['owners'],
+                          team_file=None)
+        self.team_drive_id = json.loads(meta['team_drive_id'])
+        self.tool          = meta['tool']
+        self.created       = int(meta['created'])
+
+        self._mime_types  = dict(self._db.execute('SELECT id, mime_type FROM mime_types'))
+        self._owner_lists = { id : json.loads(owners) for (id, owners) in
+                              self._db.execute('SELECT id, owners FROM owner_lists') }
+
+        log.info("Loaded snapshot of {0} (ID: {1}) from {2}, made by {3} at {4}"
+                 .format(self.root.name, self.root.id, filename,
+                         self.tool or 'unknown',
+                         time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(self.created))))
+
+    # The listing of a folder, the same as the API gave it to us.
+    # Raises ValueError if the folder wasn't listed.
+    def listing(self, folder_id):
+        rows = self._db.execute('SELECT id, name, mime_type, parents, owners, webViewLink, size, md5Checksum '
+                                'FROM items WHERE folder = ? ORDER BY position',
+                                (folder_id,)).fetchall()
+        if not rows and self._db.execute('SELECT 1 FROM folders WHERE id = ?',
+                                         (folder_id,)).fetchone() is None:
+            raise ValueError("snapshot {0} has no listing of folder ID {1}"
+                             .format(self.filename, folder_id))
+
+        files = list()
+        for (id, name, mime_type, parents, owners, wvl, size, md5) in rows:
+            file = { 'id'          : id,
+                     'name'        : name,
+                     'mimeType'    : self._mime_types[mime_type],
+                     'parents'     : parents.split(' ') if parents else [],
+                     'webViewLink' : wvl }
+            if owners is not None:
+                file['owners'] = self._owner_lists[owners]
+            if size is not None:
+                file['size'] = size
+            if md5 is not None:
+                file['md5Checksum'] = md5
+            files.append(file)
+
+        return files
+
+    # A fetcher for build_tree() / read_source_tree()
+    def fetcher(self):
+        return SnapshotFetcher(self)
+
+    def close(self):
+        self._db.close()
+
+# Same interface as the fetchers in gxlib/crawl.py, but serve folder
+# listings out of a snapshot
+class SnapshotFetcher:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def request(self, folder_id):
+        pass
+
+    def get(self, folder_id):
+        return self.snapshot.listing(folder_id)
+
+    def close(self):
+        pass
+
+#-------------------------------------------------------------------
+
+# Open a snapshot, and check that it is a crawl of the folder (or, with
+# team_drive_id, the Team Drive) that the script is working on.
+# Raises ValueError if it isn't (or isn't a snapshot).
+#
+# root_id: ID of the folder / Team Drive, or None to take whatever
+#          is in the snapshot
+# team_drive: True if the crawl has to be of a Team Drive, False if it
+#             has to be of a folder
+def open_snapshot(filename, root_id=None, team_drive=False):
+    snapshot = Snapshot(filename)
+    if team_drive and not snapshot.team_drive_id:
+        raise ValueError("it is a snapshot of a folder, not a Team Drive")
+    if not team_drive and snapshot.team_drive_id:
+        raise ValueError("it is a snapshot of a Team Drive, not a folder")
+    if root_id is not None and snapshot.root.id != root_id:
+        raise ValueError("it is a snapshot of {0} (ID: {1}), not ID {2}"
+                         .format(snapshot.root.name, snapshot.root.id,
+                                 root_id))
+    return snapshot
+
+# Rebuild the tree from a snapshot.  Returns (tree, all_files), just
+# like read_source_tree().
+def read_snapshot_tree(snapshot, prefix='', all_files=None):
+    return build_tree(snapshot.fetcher(), prefix, snapshot.root, all_files)
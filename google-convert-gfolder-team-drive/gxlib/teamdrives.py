@@ -0,0 +1,192 @@
+"""Find Team Drives by name or ID without listing every Team Drive.
+
+gxcopy.py has to make sure that there is no Team Drive with the name
+that it's about to use, and find-multifiles.py has to find a Team
+Drive given its name or ID.  Both used to page through every Team
+Drive the admin can see, which in a domain with thousands of them
+takes a while before any real work starts.  Instead:
+
+- Ask Google for just the one we want: teamdrives.get for an ID, or
+  teamdrives.list with q="name = '...'" for a name.  These are done
+  with useDomainAdminAccess, so that they find every Team Drive in the
+  domain, not just the ones the admin is a member of.  If the admin
+  isn't a domain admin, they are retried without it (and if that
+  fails too, the script aborts, rather than taking the failure to mean
+  that there is no such Team Drive).
+- Keep a local index of the names / IDs of Team Drives that we have
+  seen recently.  It is kept on disk next to the cached discovery
+  document (see cache_file() in gxlib/api.py), so that it is shared by
+  all the scripts, and entries expire after a TTL (see
+  set_index_ttl()).
+
+Nothing is trusted from the index: a Team Drive could have been made,
+deleted or renamed since it was written.  It only tells us whether
+we've been given an ID or a name, so that we don't have to ask Google
+for a Team Drive with a name as its ID first.  Entries that Google no
+longer agrees with are dropped.
+
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from googleapiclient.errors import HttpError
+
+from gxlib.api import doit, cache_file, drive_api_url_env
+
+log = logging.getLogger('FToTD')
+
+# Default number of seconds to trust an entry in the index
+default_index_ttl = 10 * 60
+
+_index_ttl  = default_index_ttl
+_index_lock = threading.Lock()
+
+# 0 means don't use the index at all
+def set_index_ttl(ttl):
+    global _index_ttl
+    _index_ttl = ttl
+
+#-------------------------------------------------------------------
+
+# One index per Drive API (i.e., bench/fake-drive.py's Team Drives
+# don't end up in the index of the real ones)
+def _index_file():
+    url = os.environ.get(drive_api_url_env, 'https://www.googleapis.com/drive/v3')
+    return cache_file('team-drives', url)
+
+# ID -> { 'name' : ..., 'seen' : time.time() when we last saw it }
+def _read_index():
+    try:
+        with open(_index_file()) as f:
+            index = json.load(f)['team_drives']
+    except (OSError, IOError, ValueError, KeyError):
+        return dict()
+
+    now = time.time()
+    return { id : entry for id, entry in index.items()
+             if now - entry['seen'] <= _index_ttl }
+
+def _write_index(index):
+    filename = _index_file()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({ 'team_drives' : index }, f)
+        os.replace(tmp, filename)
+    except (OSError, IOError) as e:
+        log.debug("Could not save the Team Drive index in {0}: {1}"
+                  .format(filename, e))
+
+# Add some Team Drives (hashes with 'id' and 'name') to the index
+def remember_team_drives(team_drives):
+    if not _index_ttl or not team_drives:
+        return
+
+    with _index_lock:
+        index = _read_index()
+        now   = time.time()
+        for team_drive in team_drives:
+            index[team_drive['id']] = { 'name' : team_drive['name'],
+                                        'seen' : now }
+        _write_index(index)
+
+# Drop some Team Drives (hashes with 'id' and 'name') from the index
+def _forget_team_drives(team_drives):
+    if not _index_ttl or not team_drives:
+        return
+
+    with _index_lock:
+        index = _read_index()
+        for team_drive in team_drives:
+            entry = index.get(team_drive['id'], None)
+            if entry is not None and entry['name'] == team_drive['name']:
+                del index[team_drive['id']]
+        _write_index(index)
+
+def _index_lookup(name_or_id, by_id, by_name):
+    if not _index_ttl:
+        return list()
+
+    with _index_lock:
+        index = _read_index()
+    return [ { 'id' : id, 'name' : entry['name'] }
+             for id, entry in index.items()
+             if ((by_id and id == name_or_id) or
+                 (by_name and entry['name'] == name_or_id)) ]
+
+#-------------------------------------------------------------------
+
+# Make the request with domain admin access, and if we're not allowed
+# to do that, make it again without.  request is a function that takes
+# the extra keyword arguments and returns the API request.  Only the
+# domain admin attempt may fail: if the second one does too, it
+# aborts.
+def _as_domain_admin(request):
+    response = doit(request(useDomainAdminAccess=True), can_fail=True)
+    if response is None:
+        log.debug("No domain admin access to Team Drives; asking as a regular user")
+        response = doit(request())
+    return response
+
+def _get_team_drive(service, id):
+    try:
+        return _as_domain_admin(lambda **kwargs:
+                                service.teamdrives().get(teamDriveId=id,
+                                                         fields='id,name',
+                                                         **kwargs))
+    except HttpError as err:
+        # I.e., it's not an ID (or not one that we can see)
+        if err.resp.status in (400, 404):
+            return None
+        raise
+
+def _list_team_drives_named(service, name):
+    quoted = name.replace('\\', '\\\\').replace("'", "\\'")
+    query  = "name = '{0}'".format(quoted)
+    log.debug("Team Drive query: {0}".format(query))
+
+    team_drives = list()
+    page_token  = None
+    while True:
+        response = _as_domain_admin(lambda **kwargs:
+                                    service.teamdrives().list(q=query,
+                                                              pageToken=page_token,
+                                                              fields='nextPageToken,teamDrives(id,name)',
+                                                              **kwargs))
+        team_drives.extend(td for td in response.get('teamDrives', [])
+                           if td['name'] == name)
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    return team_drives
+
+# Return a list of the Team Drives (hashes with 'id' and 'name') whose
+# ID or name is name_or_id.
+#
+# by_id / by_name: whether to look for an ID / name
+def find_team_drives(service, name_or_id, by_id=True, by_name=True):
+    known = _index_lookup(name_or_id, by_id, by_name)
+    is_id = any(td['id'] == name_or_id for td in known)
+    if known and not is_id:
+        log.debug("{0} is the name of a Team Drive in the index".format(name_or_id))
+
+    found = list()
+    if by_id and (is_id or not known):
+        team_drive = _get_team_drive(service, name_or_id)
+        if team_drive:
+            found.append(team_drive)
+    if by_name and not found:
+        found.extend(_list_team_drives_named(service, name_or_id))
+
+    # Anything in the index that has since been deleted or renamed
+    found_keys = set((td['id'], td['name']) for td in found)
+    _forget_team_drives([ td for td in known
+                          if (td['id'], td['name']) not in found_keys ])
+    remember_team_drives(found)
+    return found
@@ -0,0 +1,111 @@
+"""A thread-safe, connection-pooling stand-in for httplib2.Http.
+
+An httplib2.Http object is not thread safe, and holds (at most) one
+connection per host.  So every worker thread used to need its own
+authorized Http and its own Drive service object -- and each of those
+opened its own TLS connection to Google, and refreshed its own access
+token (after the first call with the old one got a 401).
+
+PooledHttp keeps a pool of httplib2.Http objects, each with its own
+kept-alive connection.  Each request borrows one from the pool (making
+a new one if they are all busy) and returns it afterwards, so a single
+PooledHttp -- and a single Drive service built on it -- can be shared
+by any number of threads.  It is authorized like any other Http (i.e.,
+credentials.authorize(http)).
+
+keep_token_fresh() refreshes a credential's access token in the
+background shortly before it expires, so that worker threads don't
+stall on 401s and token refreshes in the middle of a crawl.
+
+"""
+
+import time
+import logging
+import datetime
+import threading
+
+import httplib2
+
+log = logging.getLogger('FToTD')
+
+# Refresh access tokens this long before they expire
+refresh_margin = datetime.timedelta(minutes=5)
+# How often to check whether any access tokens need refreshing
+refresh_check_seconds = 30
+
+#-------------------------------------------------------------------
+
+class PooledHttp:
+    def __init__(self, timeout=None):
+        self.timeout  = timeout
+        self._idle    = list()      # Http objects not in use right now
+        self._created = 0
+        self._lock    = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                # Most recently used first; its connection is the
+                # least likely to have gone stale
+                return self._idle.pop()
+            self._created = self._created + 1
+            log.debug("Opening HTTP connection #{0}".format(self._created))
+        return httplib2.Http(timeout=self.timeout)
+
+    def _put(self, http):
+        with self._lock:
+            self._idle.append(http)
+
+    # Same signature as httplib2.Http.request()
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        http = self._get()
+        try:
+            return http.request(uri, method=method, body=body,
+                                headers=headers,
+                                redirections=redirections,
+                                connection_type=connection_type)
+        finally:
+            self._put(http)
+
+#-------------------------------------------------------------------
+
+_fresh_creds   = dict()     # id(credentials) -> credentials
+_fresh_lock    = threading.Lock()
+_fresh_thread  = None
+
+def _needs_refresh(credentials):
+    expiry = getattr(credentials, 'token_expiry', None)
+    if expiry is None:
+        return False
+    return datetime.datetime.utcnow() + refresh_margin >= expiry
+
+def _refresher():
+    http = httplib2.Http()
+    while True:
+        with _fresh_lock:
+            creds = list(_fresh_creds.values())
+
+        for credentials in creds:
+            if not _needs_refresh(credentials):
+                continue
+            log.debug("Refreshing access token before it expires")
+            try:
+                credentials.refresh(http)
+            except Exception as e:
+                # Not fatal: the next API call will try again (and
+                # complain properly if it still doesn't work)
+                log.info("Could not refresh access token: {0}".format(e))
+
+        time.sleep(refresh_check_seconds)
+
+# Refresh these credentials' access token in the background before it
+# expires
+def keep_token_fresh(credentials):
+    global _fresh_thread
+    with _fresh_lock:
+        _fresh_creds[id(credentials)] = credentials
+        if _fresh_thread is None:
+            _fresh_thread = threading.Thread(target=_refresher, daemon=True)
+            _fresh_thread.start()
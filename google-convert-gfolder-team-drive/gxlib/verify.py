@@ -0,0 +1,291 @@
+"""Compare a source folder tree with the Team Drive it was migrated to.
+
+Both trees are crawled at the same time, each with
+walk_source_listing() (i.e., the same parallel folder listing that
+the migration uses), and the items are matched up with a hash join on
+(path of the folder relative to the top of the tree, name).  Whenever
+an item is found on one side, it is looked up in the index of the
+other side's not-yet-matched items: a match is compared and dropped,
+and anything else waits in its own side's index.  So only the items
+that haven't been matched yet are kept in memory, and once both
+crawls are done, whatever is left in the indexes is missing from (or
+extra in) the Team Drive.
+
+What gxcopy.py does to names is taken into account: a file with
+multiple parents is expected in the Team Drive with a "MULTIFILE "
+prefix (see choose_file_action() in gxlib/plan.py), and a Drive
+shortcut (see gxlib/dedup.py) stands in for any file.
+
+The migration's journal is needed to judge the result:
+
+- Files that gxcopy.py moved are no longer in the source tree, so
+  without it they would look like extras in the Team Drive.  They
+  (and the files that --dedup once left out) are counted as such
+  instead of as differences.
+
+- A folder with multiple parents is only traversed under one of them
+  (the others get an empty folder), and which one depends on the order
+  that gxcopy.py crawled the tree in.  The journal says which Team
+  Drive folder got the contents, so the source crawl traverses the
+  folder under the same parent (see traverse_under in
+  walk_source_listing()).
+
+Matched items are compared by type (folder or not), and by size and
+md5Checksum when both sides have them (Google Docs / Sheets / etc.
+have neither).
+
+"""
+
+import sys
+import queue
+import logging
+import threading
+
+from recordclass import recordclass
+
+from gxlib.crawl import walk_source_listing
+from gxlib.dedup import shortcut_mime_type
+from gxlib.journal import read_records
+from gxlib.records import folder_mime_type
+
+log = logging.getLogger('FToTD')
+
+# Kinds of differences
+MISSING    = 'missing'      # In the source, not in the Team Drive
+EXTRA      = 'extra'        # In the Team Drive, not in the source
+MISMATCHED = 'mismatched'   # In both, but not the same
+
+SOURCE = 0
+TEAM   = 1
+
+# Maximum number of found-but-not-yet-joined items
+queue_size = 10000
+
+# What is kept in the index for each not-yet-matched item
+Item = recordclass('Item',
+                   ['id',           # string
+                    'mimeType',     # string (interned)
+                    'size',         # string or None
+                    'md5',          # string or None
+                    'webViewLink',  # string (URL)
+                    ])
+
+#-------------------------------------------------------------------
+
+# Read a gxcopy.py journal.  Returns (set of IDs of moved files, set of
+# source IDs of files that --dedup once left out, hash of source folder
+# ID -> ID of the source parent that gxcopy.py put that folder's
+# contents under).  The last one only has the folders with multiple
+# parents; it is meant for walk_source_listing()'s traverse_under.
+def read_journal(filename):
+    moved        = set()
+    deduplicated = set()
+    sources      = dict()   # Team Drive folder ID -> source folder ID
+    made         = dict()   # source folder ID -> [ (team parent ID, team folder ID) ]
+    filled       = set()    # IDs of Team Drive folders that got something
+    for record in read_records(filename):
+        if record['type'] == 'team_drive':
+            sources[record['id']] = record['source']
+            continue
+
+        # Older journals don't have the parent of a folder, but it is
+        # the same as the Team Drive folder's own parent
+        parent = record.get('parent', None)
+        if parent is None:
+            parent = record['parents'][0]
+        filled.add(parent)
+
+        if record['type'] == 'folder':
+            sources[record['id']] = record['source']
+            made.setdefault(record['source'], list()).append((parent,
+                                                              record['id']))
+        elif record['action'] == 'moved':
+            moved.add(record['source'])
+        elif record['action'] == 'deduplicated':
+            deduplicated.add(record['source'])
+
+    # A folder with multiple parents was made once per parent, but only
+    # the one that was traversed has anything in it
+    traverse_under = dict()
+    for (source_id, folders) in made.items():
+        if len(folders) < 2:
+            continue
+        for (parent, team_id) in folders:
+            if team_id in filled and parent in sources:
+                traverse_under[source_id] = sources[parent]
+                break
+
+    return (moved, deduplicated, traverse_under)
+
+#-------------------------------------------------------------------
+
+# Crawl one side, putting (side, folder path, raw file) on the results
+# queue, and then (side, None, None) -- or (side, None, exception) if
+# the crawl died.
+def _crawl(side, services, root_folder, team_drive_id, traverse_under,
+           results):
+    try:
+        root_abs  = '/' + root_folder.name
+        folder_id = None
+        for (folder, name_abs, file, _) in \
+                walk_source_listing(services, '', root_folder,
+                                    team_drive_id,
+                                    traverse_under=traverse_under):
+            # Everything in a folder shares one copy of its path
+            if folder.id != folder_id:
+                folder_id = folder.id
+                path      = name_abs[len(root_abs):]
+            results.put((side, path, file))
+        results.put((side, None, None))
+    except BaseException as e:
+        results.put((side, None, e))
+
+# The name that gxcopy.py gives a source file in the Team Drive
+def _team_name(file):
+    if file['mimeType'] != folder_mime_type and len(file['parents']) > 1:
+        return 'MULTIFILE ' + file['name']
+    return file['name']
+
+def _item(file):
+    return Item(id=file['id'],
+                mimeType=sys.intern(file['mimeType']),
+                size=file.get('size', None),
+                md5=file.get('md5Checksum', None),
+                webViewLink=file['webViewLink'])
+
+# Return a description of how two matched items differ, or None if
+# they don't
+def _compare(source, team):
+    source_is_folder = (source.mimeType == folder_mime_type)
+    team_is_folder   = (team.mimeType == folder_mime_type)
+    if team.mimeType == shortcut_mime_type and not source_is_folder:
+        return None
+
+    if source_is_folder != team_is_folder:
+        return ("folder vs. file" if source_is_folder
+                else "file vs. folder")
+    if source.size and team.size and source.size != team.size:
+        return "size {0} vs. {1}".format(source.size, team.size)
+    if source.md5 and team.md5 and source.md5 != team.md5:
+        return "md5Checksum {0} vs. {1}".format(source.md5, team.md5)
+    return None
+
+# The index of one side: key -> Item, or a list of Items if a folder
+# has more than one item with the same name
+def _add(index, key, item):
+    other = index.get(key, None)
+    if other is None:
+        index[key] = item
+    elif isinstance(other, list):
+        other.append(item)
+    else:
+        index[key] = [ other, item ]
+
+def _take(index, key):
+    item = index.get(key, None)
+    if isinstance(item, list):
+        taken = item.pop(0)
+        if len(item) == 1:
+            index[key] = item[0]
+        return taken
+    if item is not None:
+        del index[key]
+    return item
+
+def _items(index):
+    for key, item in index.items():
+        if isinstance(item, list):
+            for i in item:
+                yield (key, i)
+        else:
+            yield (key, item)
+
+#-------------------------------------------------------------------
+
+# Crawl the source folder and the Team Drive at the same time and
+# compare them (see the top of this file).
+#
+# source_services / team_services: lists of services to crawl each
+# side with (one per crawl worker; see FolderFetcher in gxlib/crawl.py)
+# source_folder / team_drive: GFiles of the tops of the trees
+# moved / deduplicated / traverse_under: what read_journal() returned
+# report: function called as report(kind, path, name, source item,
+# Team Drive item, details) for each difference (MISMATCHED ones as
+# they are found, the others once the crawls are done); items that
+# aren't on one side are None
+#
+# Returns a hash of counts.
+def verify_team_drive(source_services, source_folder,
+                      team_services, team_drive,
+                      moved, deduplicated, traverse_under, report=None):
+    counts = { 'matched'      : 0,
+               MISSING        : 0,
+               EXTRA          : 0,
+               MISMATCHED     : 0,
+               'moved'        : 0,
+               'deduplicated' : 0 }
+
+    results = queue.Queue(maxsize=queue_size)
+    crawls  = [ threading.Thread(target=_crawl,
+                                 args=(SOURCE, source_services,
+                                       source_folder, None, traverse_under,
+                                       results),
+                                 name='verify-source', daemon=True),
+                threading.Thread(target=_crawl,
+                                 args=(TEAM, team_services,
+                                       team_drive, team_drive.id, None,
+                                       results),
+                                 name='verify-team-drive', daemon=True) ]
+    for t in crawls:
+        t.start()
+
+    indexes = [ dict(), dict() ]
+    running = len(crawls)
+    while running:
+        (side, path, file) = results.get()
+        if path is None:
+            if file is not None:
+                raise file
+            running = running - 1
+            continue
+
+        if side == SOURCE:
+            name = _team_name(file)
+        else:
+            name = file['name']
+        key  = (path, name)
+        item = _item(file)
+
+        other = _take(indexes[1 - side], key)
+        if other is None:
+            _add(indexes[side], key, item)
+            continue
+
+        counts['matched'] = counts['matched'] + 1
+        (source, team) = (item, other) if side == SOURCE else (other, item)
+        details = _compare(source, team)
+        if details:
+            counts[MISMATCHED] = counts[MISMATCHED] + 1
+            if report:
+                report(MISMATCHED, path, name, source, team, details)
+
+    log.info("Done crawling; {0} items matched".format(counts['matched']))
+
+    # Everything left over didn't match
+    for ((path, name), item) in _items(indexes[SOURCE]):
+        if item.id in deduplicated:
+            counts['deduplicated'] = counts['deduplicated'] + 1
+            continue
+        counts[MISSING] = counts[MISSING] + 1
+        if report:
+            report(MISSING, path, name, item, None, None)
+
+    for ((path, name), item) in _items(indexes[TEAM]):
+        if item.id in moved:
+            counts['moved'] = counts['moved'] + 1
+            continue
+        counts[EXTRA] = counts[EXTRA] + 1
+        if report:
+            report(EXTRA, path, name, None, item, None)
+
+    return counts
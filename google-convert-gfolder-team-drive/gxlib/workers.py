@@ -0,0 +1,53 @@
+"""Run a bunch of API work items in parallel.
+
+Each thread is given a service, and the number of services is the
+number of threads.  The services are built on gxlib/transport.py's
+thread-safe PooledHttp, so the same service can be given to more than
+one thread.
+
+"""
+
+import queue
+import threading
+
+#-------------------------------------------------------------------
+
+# Call func(service, item) for each item in items, with one thread per
+# service pulling items off a shared queue.  Returns the list of
+# results, in the same order as items.  If any call raises an
+# exception (including the SystemExit from doit()), the remaining
+# items are abandoned and the exception is re-raised here.
+def run_with_services(services, items, func):
+    if len(services) <= 1 or len(items) <= 1:
+        return [ func(services[0], item) for item in items ]
+
+    results = [ None ] * len(items)
+    errors  = list()
+    work    = queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker(service):
+        while not errors:
+            try:
+                (i, item) = work.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results[i] = func(service, item)
+            except BaseException as e:
+                errors.append(e)
+                return
+
+    threads = list()
+    for service in services[:len(items)]:
+        t = threading.Thread(target=worker, args=(service,), daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results
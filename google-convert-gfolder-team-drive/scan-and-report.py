@@ -20,7 +20,8 @@ Pre-requisites:
 - pip install --upgrade recordclass
 
 Input:
-- Source folder ID
+- Source folder ID, or a snapshot of a previous crawl of it (see
+  gxlib/snapshot.py)
 
 """
 
@@ -29,7 +30,6 @@ import sys
 import os
 import re
 import time
-import httplib2
 import calendar
 import uuid
 import logging
@@ -40,72 +40,34 @@ import csv
 from pprint import pprint
 from pprint import pformat
 
-from recordclass import recordclass
-
-from apiclient.discovery import build
-from apiclient.http import MediaFileUpload
-from apiclient.errors import HttpError
 from oauth2client import tools
 from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 
+from gxlib.api import doit, BatchQueue, MAY_BE_MISSING
+from gxlib.api import register_http, set_rate_limit, default_rate
+from gxlib.api import build_drive_service
+from gxlib import metrics
+from gxlib.transport import PooledHttp, keep_token_fresh
+from gxlib.changes import scan_source_tree
+from gxlib.crawl import read_source_tree, walk_source_listing
+from gxlib.records import folder_mime_type, team_drive_mime_type
+from gxlib.records import GFile
+from gxlib.snapshot import SnapshotWriter, open_snapshot, read_snapshot_tree
+
 # Globals
 app_cred_file = 'client_id.json'
 admin_cred_file = 'admin-credentials.json'
 user_agent = 'gxcopy'
-doc_mime_type = 'application/vnd.google-apps.document';
-sheet_mime_type = 'application/vnd.google-apps.spreadsheet';
-folder_mime_type = 'application/vnd.google-apps.folder'
 args = None
 log = None
-# JMS this is probably a lie, but it's useful for comparisons
-team_drive_mime_type = 'application/vnd.google-apps.team_drive'
 # Scopes documented here:
 # https://developers.google.com/drive/v3/web/about-auth
 scope = 'https://www.googleapis.com/auth/drive'
 
 #-------------------------------------------------------------------
 
-# Recordclasses are effecitvely namedtuples that are mutable (i.e.,
-# support assignment). These are the recordclasses that are used in
-# the rest of the script.
-
-GFile = recordclass('GFile',
-                   ['id',           # string
-                    'webViewLink',  # string (URL)
-                    'mimeType',     # string
-                    'name',         # string
-                    'owners',       # array of hashes: 'displayName', 'emailAddress', 'kind', 'me', 'permissionId'
-                    'parents',      # list of strings (each an ID)
-                    'team_file',    # GFile or None
-                    ])
-Tree = recordclass('Tree',
-                  ['root_folder',   # See comment in read_source_tree()
-                   'contents'])
-ContentEntry = recordclass('ContentEntry',
-                          ['gfile',      # GFile
-                           'is_folder',  # boolean
-                           'traverse',   # boolean
-                           'contents',   # list of ContentEntry's
-                           'tree'        # Tree
-                           ])
-AllFiles = recordclass('AllFiles',
-                      ['name',           # string
-                       'webViewLink',    # string (URL)
-                       'parents',        # array of Parent records
-                       'is_folder',      # boolean
-                       'owners',         # array of hashes: 'displayName', 'emailAddress', 'kind', 'me', 'permissionId'
-                       ])
-Parent = recordclass('Parent',
-                     ['id',              # string
-                      'name',            # string
-                      'name_abs',        # string
-                      'webViewLink'      # string (URL)
-                      ])
-
-#-------------------------------------------------------------------
-
 def diediedie(msg):
     global log
 
@@ -186,53 +148,27 @@ def load_user_credentials(filename, scope, app_cred):
               .format(file))
     return user_cred
 
-def authorize(user_cred):
-    http    = httplib2.Http()
+def authorize(user_cred, name=None):
+    # One pooled, thread-safe Http per credential (see
+    # gxlib/transport.py), so the service can be shared by threads
+    http    = PooledHttp()
     http    = user_cred.authorize(http)
-    service = build('drive', 'v3', http=http)
+    service = build_drive_service(http)
+    register_http(http, user_cred, name)
+    keep_token_fresh(user_cred)
 
     log.debug('Authorized to Google')
     return service
 
 ####################################################################
 
-# If the Google API call fails, try again...
-def doit(httpref, can_fail=False):
-    count = 0
-    while count < 3:
-        try:
-            ret = httpref.execute()
-            return ret
-
-        except HttpError as err:
-            log.debug("*** Got HttpError:")
-            pprint(err)
-            if err.resp.status in [500, 503]:
-                log.debug("*** Seems recoverable; let's sleep and try again...")
-                time.sleep(5)
-                count = count + 1
-                continue
-            elif err.resp.status == 403 and can_fail:
-                log.debug("*** Got a 403, but we're allowed to fail this call")
-                # Need to return None to indicate failure
-                return None
-            else:
-                log.debug("*** Doesn't seem recoverable (status {0}) -- aborting".format(err.resp.status))
-                log.debug(err)
-                raise
-
-        except:
-            log.error("*** Some unknown error occurred")
-            log.error(sys.exc_info()[0])
-            raise
-
-    # If we get here, it's failed multiple times -- time to bail...
-    log.error("Error: we failed this 3 times; there's no reason to believe it'll work if we do it again...")
-    exit(1)
-
-####################################################################
+owner_fieldnames       = [ 'Owner name', 'Owner email',
+                           'Filename', 'File link' ]
+multiparent_fieldnames = [ 'File name', 'File link',
+                           'Folder name', 'Folder path', 'Folder link' ]
 
-def print_owners(all_files, csvfile):
+# listing: whether to print every file (as well as each owner)
+def print_owners(all_files, csvfile, listing=True):
     print('')
     print("Gathering owners of files from source folder...")
     print('')
@@ -258,9 +194,7 @@ def print_owners(all_files, csvfile):
     # Setup for CSV output, if desired
     writer = None
     if csvfile:
-        fieldnames = [ 'Owner name', 'Owner email',
-                       'Filename', 'File link' ]
-        writer     = csv.DictWriter(csvfile, fieldnames=fieldnames,
+        writer     = csv.DictWriter(csvfile, fieldnames=owner_fieldnames,
                                     quoting=csv.QUOTE_ALL)
         writer.writeheader()
 
@@ -277,15 +211,17 @@ def print_owners(all_files, csvfile):
             row['Filename']  = gfile.name
             row['File link'] = gfile.webViewLink
 
-            print("   File: {filename}\n   URL:  {wvl}"
-                  .format(filename=gfile.name, wvl=gfile.webViewLink))
+            if listing:
+                print("   File: {filename}\n   URL:  {wvl}"
+                      .format(filename=gfile.name, wvl=gfile.webViewLink))
 
             if writer:
                 writer.writerow(row)
 
 #-------------------------------------------------------------------
 
-def print_multiparents(service, root, all_files, csvfile):
+# listing: whether to print every file (or just how many there are)
+def print_multiparents(service, root, all_files, csvfile, listing=True):
     print('')
     print('Files/folders with multiple parents:')
     print('')
@@ -302,9 +238,7 @@ def print_multiparents(service, root, all_files, csvfile):
     # Setup for CSV output, if desired
     writer = None
     if csvfile:
-        fieldnames = [ 'File name', 'File link',
-                       'Folder name', 'Folder path', 'Folder link' ]
-        writer     = csv.DictWriter(csvfile, fieldnames=fieldnames,
+        writer     = csv.DictWriter(csvfile, fieldnames=multiparent_fieldnames,
                                     quoting=csv.QUOTE_ALL)
         writer.writeheader()
 
@@ -314,164 +248,189 @@ def print_multiparents(service, root, all_files, csvfile):
         row['File name'] = allfile.name
         row['File link'] = allfile.webViewLink
 
-        print("File: {filename}\nURL:  {wvl}"
-              .format(filename=allfile.name,
-                      wvl=allfile.webViewLink))
-        print("      Appears in:")
+        if listing:
+            print("File: {filename}\nURL:  {wvl}"
+                  .format(filename=allfile.name,
+                          wvl=allfile.webViewLink))
+            print("      Appears in:")
         for parent in allfile.parents:
             row['Folder name'] = parent.name
             row['Folder path'] = parent.name_abs
             row['Folder link'] = parent.webViewLink
 
-            print('        Folder: "{foldername}"'
-                  .format(foldername=parent.name_abs))
-            print('           URL: {wvl}'
-                  .format(wvl=parent.webViewLink))
+            if listing:
+                print('        Folder: "{foldername}"'
+                      .format(foldername=parent.name_abs))
+                print('           URL: {wvl}'
+                      .format(wvl=parent.webViewLink))
 
             if writer:
                 writer.writerow(row)
 
+    if not listing:
+        print("{num} files".format(num=len(multiparents)))
+
 #-------------------------------------------------------------------
 
-# Find a list of contents of a particular root folder (GFile), and
-# recursively call down into each folder.  Make a somewhat complicated
-# data structure to represent the tree (remember that both files and
-# folders can have multiple parents).
+# Same reports as print_multiparents() and print_owners(), but the
+# CSV rows are written as the crawl finds each file, instead of after
+# the whole tree has been read into memory.  All that is kept is a
+# count of files and bytes per owner (printed at the end), plus the
+# IDs of the files with multiple parents (so that their owners aren't
+# counted once per parent).  Files with multiple parents are reported
+# as soon as they are found, using the parents that the folder
+# listing says they have.
 #
-# tree:
-#   .root_folder, a GFile instance:
-#      .id
-#      .mimeType: folder mime type
-#      .name
-#      .parents: list
-#      .owners: JMS ???list
-#      .team_id: None (will be populated later)
-#   .contents: list, each entry is an instance of ContentEntry, representing an item in this folder
-#      .gfile, a GFile instance:
-#         .id
-#         .mimeType
-#         .name
-#         .parents
-#         .owners: JMS ???list
-#         .team_id: None (will never be populated)
-#      .is_folder: boolean, True if folder
-#      .traverse: boolean, True if this is 1st time we've seen this folder
-#      .tree: if traverse==True, a tree, otherwise None
+# Each folder's multiparent rows come out as soon as it is listed, so
+# a file's rows are not all together.  A file counts as having
+# multiple parents if Drive says so, even if only one of them is in
+# the source tree (it can't be moved either way).
 #
-# all_files: hash indexed by ID, each entry is:
-#    .name
-#    .webViewLink
-#    .parents: list, each entry dictionary with these keys:
-#       .parent_folder_name
-#       .parent_folder_name_abs (contains entire name since root)
-#       .parent_folder_id
-#       .parent_folder_url: None (*may* be populated later)
-#    .team_file: None (will be populated later)
+# owners_csv / multiparents_csv: files to write the CSV rows to, or
+# None
+# listing: whether to print every file as it is found
+# resolve_parents: whether to look up (and report) the parents of
+# multiple parent files that turn out to be outside the source tree
+def stream_reports(services, source_folder, owners_csv, multiparents_csv,
+                   listing=True, resolve_parents=False):
+    owner_writer = None
+    if owners_csv:
+        owner_writer = csv.DictWriter(owners_csv,
+                                      fieldnames=owner_fieldnames,
+                                      quoting=csv.QUOTE_ALL)
+        owner_writer.writeheader()
+    multiparent_writer = None
+    if multiparents_csv:
+        multiparent_writer = csv.DictWriter(multiparents_csv,
+                                            fieldnames=multiparent_fieldnames,
+                                            quoting=csv.QUOTE_ALL)
+        multiparent_writer.writeheader()
+
+    owners        = dict()    # email -> { name, files, bytes }
+    multiparents  = set()     # IDs
+    folders       = set([ source_folder.id ])
+    outside       = dict()    # parent ID -> [ file hash, ... ]
+    for (parent, parent_name_abs, file, _) in \
+            walk_source_listing(services, '', source_folder):
+        # Skip folders
+        if file['mimeType'] == folder_mime_type:
+            if resolve_parents:
+                folders.add(file['id'])
+            continue
+
+        seen_before = file['id'] in multiparents
+        if len(file['parents']) > 1:
+            multiparents.add(file['id'])
+            log.info('Found a file with multiple parents: "{0}"'
+                     .format(file['name']))
+
+            # Parents that we haven't (yet) found in the source tree
+            if resolve_parents:
+                for parent_id in file['parents']:
+                    if parent_id not in folders:
+                        outside.setdefault(parent_id, list()).append({
+                            'name'        : file['name'],
+                            'webViewLink' : file['webViewLink'],
+                        })
+            if listing:
+                print('Multiple parents: {filename} ({wvl})\n   Appears in: "{foldername}"'
+                      .format(filename=file['name'],
+                              wvl=file['webViewLink'],
+                              foldername=parent_name_abs))
+            if multiparent_writer:
+                multiparent_writer.writerow({
+                    'File name'   : file['name'],
+                    'File link'   : file['webViewLink'],
+                    'Folder name' : parent.name,
+                    'Folder path' : parent_name_abs,
+                    'Folder link' : parent.webViewLink,
+                })
+        if seen_before:
+            continue
+
+        for owner in file.get('owners', list()):
+            owner_name  = owner['displayName']
+            owner_email = owner['emailAddress']
+
+            if owner_email not in owners:
+                owners[owner_email] = { 'name'  : owner_name,
+                                        'files' : 0,
+                                        'bytes' : 0 }
+            totals = owners[owner_email]
+            totals['files'] = totals['files'] + 1
+            totals['bytes'] = totals['bytes'] + int(file.get('size', 0))
+
+            if listing:
+                print('File: {filename} ({wvl})\n   Owner: {name} <{email}>'
+                      .format(filename=file['name'],
+                              wvl=file['webViewLink'],
+                              name=owner_name, email=owner_email))
+            if owner_writer:
+                owner_writer.writerow({
+                    'Owner name'  : owner_name,
+                    'Owner email' : owner_email,
+                    'Filename'    : file['name'],
+                    'File link'   : file['webViewLink'],
+                })
+
+    if resolve_parents:
+        # The ones that we never did find in the source tree
+        for parent_id in folders:
+            outside.pop(parent_id, None)
+        resolve_outside_parents(services[0], outside,
+                                multiparent_writer, listing)
+
+    print('')
+    print("{num} files with multiple parents".format(num=len(multiparents)))
+    print('')
+    print("File owners:")
+    for email, totals in sorted(owners.items(),
+                                key=lambda item: -item[1]['files']):
+        print("{name} <{email}> owns {num} files ({bytes} bytes)"
+              .format(name=totals['name'], email=email,
+                      num=totals['files'], bytes=totals['bytes']))
+
+# Look up the parents outside the source tree of files with multiple
+# parents (with batched files().get calls), and report them the same
+# way as the parents inside the tree.
 #
-def read_source_tree(service, prefix, root_folder, all_files = dict()):
-    log.info('Discovering contents of folder: "{0}" (ID: {1})'
-             .format(root_folder.name, root_folder.id))
-
-    parent_folder_name_abs = '{0}/{1}'.format(prefix, root_folder.name)
-    log.debug('parent folder name abs: {0}=={1}'
-              .format(prefix, root_folder.name))
-    tree = Tree(root_folder=root_folder, contents=[])
-
-    # Iterate through everything in this root folder
-    page_token = None
-    query = "'{0}' in parents and trashed=false".format(root_folder.id)
-    log.debug("Query: {0}".format(query))
-    while True:
-        response = doit(service.files()
-                        .list(q=query,
-                              spaces='drive',
-                              corpora='user',
-                              fields='nextPageToken,files(name,id,mimeType,parents,owners,webViewLink)',
-                              pageToken=page_token,
-                              supportsTeamDrives=True))
-        for file in response.get('files', []):
-            log.info('Found: "{0}"'.format(file['name']))
-            id = file['id']
-            traverse = False
-            is_folder = False
-            if file['mimeType'] == folder_mime_type:
-                is_folder = True
-
-            # We have already seen this file before
-            if id in all_files:
-                log.debug('--- We already know this file; cross-referencing...')
-
-                # If this is a folder that we already know, then do
-                # not traverse down into it (again).
-                if is_folder:
-                    log.debug('--- Is a folder, but we already know it; NOT adding to pending traversal list')
-                    traverse = False
-
-            # We have *NOT* already seen this file before
-            else:
-                log.debug('--- We do not already know this file; saving...')
-                log.debug("Parents: {p}".format(p=file['parents']))
-                all_files[id] = AllFiles(name=file['name'],
-                                         webViewLink=file['webViewLink'],
-                                         parents=[], # Filled in below
-                                         is_folder=is_folder,
-                                         owners=file['owners'])
-
-                # If it's a folder, add it to the pending traversal list
-                if is_folder:
-                    traverse = True
-                    log.debug("--- Is a folder; adding to pending traversal list")
-
-            # Save this content entry in the list of contents for this
-            # folder
-            gfile = GFile(id=id,
-                          mimeType=file['mimeType'],
-                          webViewLink=file['webViewLink'],
-                          name=file['name'],
-                          parents=file['parents'],
-                          owners=file['owners'],
-                          team_file=None)
-            content_entry = ContentEntry(gfile=gfile,
-                                         is_folder=is_folder,
-                                         traverse=traverse,
-                                         contents=[],
-                                         tree=None)
-            tree.contents.append(content_entry)
-
-            # JMS delete me
-            log.debug("Created gfile for content entry: {0}"
-                      .format(gfile))
-
-            # Save this file in the master list of *all* files found.
-            # Basically, add a parent listing to this ID in the
-            # all_files index.
-            parent_wvl = '<Unknown>'
-            if root_folder.id in all_files:
-                parent_wvl = all_files[root_folder.id].webViewLink
-
-            parent = Parent(id=root_folder.id, name=root_folder.name,
-                            name_abs=parent_folder_name_abs,
-                            webViewLink=parent_wvl)
-            all_files[id].parents.append(parent)
-
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
-
-    # Traverse all the sub folders
-    for entry in tree.contents:
-        if entry.traverse:
-            new_prefix = '{0}/{1}'.format(parent_folder_name_abs,
-                                          entry.gfile.name)
-            log.debug("== Traversing down into {0}"
-                          .format(new_prefix))
-            (t, all_files) = read_source_tree(service,
-                                              parent_folder_name_abs,
-                                              entry.gfile, all_files)
-            entry.tree = t
-
-    # Done!
-    return (tree, all_files)
+# outside: hash of parent ID -> list of the files (hashes with 'name'
+# and 'webViewLink') in that parent
+def resolve_outside_parents(service, outside, writer, listing=True):
+    log.info("Looking up {0} parent folders outside the source tree"
+             .format(len(outside)))
+
+    def resolved(parent_id, folder):
+        if folder is None:
+            # We can't see it (or it's gone)
+            folder = { 'name' : '<Unknown>', 'webViewLink' : '<Unknown>' }
+
+        for file in outside[parent_id]:
+            if listing:
+                print('Multiple parents: {filename} ({wvl})\n   Appears in: "{foldername}" (outside the source tree)'
+                      .format(filename=file['name'],
+                              wvl=file['webViewLink'],
+                              foldername=folder['name']))
+            if writer:
+                writer.writerow({
+                    'File name'   : file['name'],
+                    'File link'   : file['webViewLink'],
+                    'Folder name' : folder['name'],
+                    'Folder path' : '<Outside the source tree>',
+                    'Folder link' : folder['webViewLink'],
+                })
+
+    batch = BatchQueue()
+    for parent_id in outside:
+        request = (service
+                   .files()
+                   .get(fileId=parent_id,
+                        fields='id,name,webViewLink',
+                        supportsTeamDrives=True))
+        batch.add(service, request,
+                  lambda folder, parent_id=parent_id: resolved(parent_id, folder),
+                  can_fail=MAY_BE_MISSING)
+    batch.flush()
 
 #-------------------------------------------------------------------
 
@@ -506,8 +465,7 @@ def verify_folder_id(service, id):
 
 def add_cli_args():
     tools.argparser.add_argument('--source-folder-id',
-                                 required=True,
-                                 help='Source folder ID')
+                                 help='Source folder ID (required, unless --from-snapshot)')
 
     tools.argparser.add_argument('--app-id',
                                  default=app_cred_file,
@@ -519,6 +477,59 @@ def add_cli_args():
 
     tools.argparser.add_argument('--csv',
                                  help='Output CSV file (optional)')
+    tools.argparser.add_argument('--owners-csv',
+                                 help='Output CSV file for the file owners report, instead of --csv (optional)')
+    tools.argparser.add_argument('--multiparents-csv',
+                                 help='Output CSV file for the multiple parents report, instead of --csv (optional)')
+    tools.argparser.add_argument('--stream',
+                                 action='store_true',
+                                 help='Write the report rows as the source tree is read, instead of reading the whole tree into memory first (needs --owners-csv / --multiparents-csv instead of --csv)')
+    tools.argparser.add_argument('--resolve-parents',
+                                 action='store_true',
+                                 help='With --stream, also look up and report the parents of files with multiple parents that are outside the source tree')
+    tools.argparser.add_argument('--no-file-listing',
+                                 action='store_true',
+                                 help='Do not print every file on the terminal; just print the totals (the CSV files still get everything)')
+
+    tools.argparser.add_argument('--crawl-workers',
+                                 type=int,
+                                 default=1,
+                                 help='Number of folders to list in parallel when reading the source tree (default: 1)')
+
+    tools.argparser.add_argument('--crawl-mode',
+                                 choices=['folders', 'corpus'],
+                                 default='folders',
+                                 help='How to read the source tree: list it folder-by-folder, or list every file we can see in one pass and rebuild the tree locally (default: folders)')
+
+    tools.argparser.add_argument('--scan-state',
+                                 help='File to save the scan results in.  If it already exists (from a previous scan of the same folder), only apply what changed since then instead of re-crawling the whole tree (optional)')
+    tools.argparser.add_argument('--full-rescan',
+                                 action='store_true',
+                                 help='Ignore any existing --scan-state file and re-crawl the whole tree')
+
+    tools.argparser.add_argument('--save-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Also save the source tree to this snapshot file (see gxlib/snapshot.py), so that this script, gxcopy.py, or find-multifiles.py can use it with --from-snapshot instead of reading the tree again (optional)')
+    tools.argparser.add_argument('--from-snapshot',
+                                 metavar='SNAPSHOT_FILE',
+                                 help='Read the source tree from this snapshot file (made with --save-snapshot) instead of from Google; no credentials are needed (optional)')
+
+    tools.argparser.add_argument('--api-rate-limit',
+                                 type=float,
+                                 default=default_rate,
+                                 help='Maximum Google API calls per second per credential; 0 means no limit (default: {0})'.format(default_rate))
+
+    tools.argparser.add_argument('--progress',
+                                 action='store_true',
+                                 help='Print a line of Google API call statistics every --metrics-interval seconds')
+    tools.argparser.add_argument('--metrics-interval',
+                                 type=float,
+                                 default=30,
+                                 help='Seconds between --progress lines and --metrics-textfile updates (default: 30)')
+    tools.argparser.add_argument('--metrics-textfile',
+                                 help='Keep Prometheus-format Google API call statistics in this file (e.g., for the node_exporter textfile collector)')
+    tools.argparser.add_argument('--metrics-json',
+                                 help='Write a JSON summary of Google API call statistics to this file at exit')
 
     tools.argparser.add_argument('--verbose',
                                  action='store_true',
@@ -533,6 +544,71 @@ def add_cli_args():
     global args
     args = tools.argparser.parse_args()
 
+    if args.stream and args.csv:
+        print("ERROR: --stream writes both reports at once, so it needs --owners-csv and/or --multiparents-csv instead of --csv")
+        exit(1)
+    if args.resolve_parents and not args.stream:
+        print("ERROR: --resolve-parents needs --stream")
+        exit(1)
+    if args.stream and (args.scan_state or args.crawl_mode == 'corpus'):
+        print("ERROR: --stream cannot be used with --scan-state or --crawl-mode corpus")
+        exit(1)
+
+    if args.from_snapshot and (args.save_snapshot or args.scan_state or
+                               args.stream):
+        print("ERROR: --from-snapshot cannot be used with --save-snapshot, --scan-state, or --stream")
+        exit(1)
+    if args.save_snapshot and (args.scan_state or args.stream):
+        print("ERROR: --save-snapshot cannot be used with --scan-state or --stream")
+        exit(1)
+    if not args.source_folder_id and not args.from_snapshot:
+        print("ERROR: --source-folder-id or --from-snapshot is required")
+        exit(1)
+
+#-------------------------------------------------------------------
+
+# Read the source tree from --from-snapshot, and report on it
+def report_from_snapshot():
+    try:
+        snapshot = open_snapshot(args.from_snapshot,
+                                 root_id=args.source_folder_id)
+    except ValueError as e:
+        diediedie("Cannot use snapshot {0}: {1}"
+                  .format(args.from_snapshot, e))
+
+    (source_root, all_files) = read_snapshot_tree(snapshot)
+    snapshot.close()
+
+    write_reports(None, source_root, all_files,
+                  not args.no_file_listing)
+    log.debug("END OF MAIN")
+    return 0
+
+# Print (and write to --csv / --owners-csv / --multiparents-csv) the
+# multiple parents and file owners reports
+def write_reports(admin_service, source_root, all_files, listing):
+    csvfile = None
+    if args.csv:
+        csvfile = open(args.csv, 'w', newline='')
+    owners_csv = csvfile
+    if args.owners_csv:
+        owners_csv = open(args.owners_csv, 'w', newline='')
+    multiparents_csv = csvfile
+    if args.multiparents_csv:
+        multiparents_csv = open(args.multiparents_csv, 'w', newline='')
+
+    # Print the list of files with multiple parents
+    metrics.set_phase('report')
+    print_multiparents(admin_service, source_root, all_files,
+                       multiparents_csv, listing)
+
+    # Print a list of all file owners
+    print_owners(all_files, owners_csv, listing)
+
+    for f in set([ csvfile, owners_csv, multiparents_csv ]):
+        if f:
+            f.close()
+
 #-------------------------------------------------------------------
 
 def main():
@@ -541,13 +617,24 @@ def main():
     # Setup logging
     setup_logging(args)
 
+    # Keep track of where the Google API calls go
+    metrics.start_reporting(interval=args.metrics_interval,
+                            progress=args.progress,
+                            textfile=args.metrics_textfile,
+                            json_file=args.metrics_json)
+
+    # The report can be redone from a snapshot without Google
+    if args.from_snapshot:
+        return report_from_snapshot()
+
     # Authorize the app and provide user consent to Google
+    set_rate_limit(args.api_rate_limit)
     app_cred = load_app_credentials(args.app_id)
 
     log.info("Authtenticating as administrator...")
     admin_cred = load_user_credentials(args.admin_credentials,
                                        scope, app_cred)
-    admin_service = authorize(admin_cred)
+    admin_service = authorize(admin_cred, 'admin')
 
     # Verify source folder ID.  Do this up front, before doing
     # expensive / slow things.
@@ -556,24 +643,54 @@ def main():
 
     log.debug("Source folder is: {0}".format(source_folder))
 
-    # Read the source tree
-    (source_root, all_files) = read_source_tree(admin_service, '',
-                                                source_folder)
+    # The admin service is thread safe, so all the crawl workers can
+    # share it
+    crawl_services = [admin_service] * args.crawl_workers
 
-    csvfile = None
-    if args.csv:
-        csvfile = open(args.csv, 'w', newline='')
+    listing = not args.no_file_listing
 
-    # Print the list of files with multiple parents
-    print_multiparents(admin_service, source_root, all_files, csvfile)
+    # Read the source tree and report on it at the same time
+    if args.stream:
+        owners_csv = None
+        if args.owners_csv:
+            owners_csv = open(args.owners_csv, 'w', newline='')
+        multiparents_csv = None
+        if args.multiparents_csv:
+            multiparents_csv = open(args.multiparents_csv, 'w', newline='')
 
-    # Print a list of all file owners
-    print_owners(all_files, csvfile)
+        metrics.set_phase('crawl')
+        stream_reports(crawl_services, source_folder,
+                       owners_csv, multiparents_csv, listing,
+                       resolve_parents=args.resolve_parents)
 
-    log.debug("END OF MAIN")
+        for csvfile in (owners_csv, multiparents_csv):
+            if csvfile:
+                csvfile.close()
+        log.debug("END OF MAIN")
+        return 0
 
-    if csvfile:
-        csvfile.close()
+    # Read the source tree
+    metrics.set_phase('crawl')
+    snapshot = None
+    if args.save_snapshot:
+        snapshot = SnapshotWriter(args.save_snapshot, source_folder,
+                                  tool='scan-and-report.py')
+    if args.scan_state:
+        (source_root, all_files) = scan_source_tree(crawl_services, '',
+                                                    source_folder,
+                                                    args.scan_state,
+                                                    corpus=(args.crawl_mode == 'corpus'),
+                                                    full=args.full_rescan)
+    else:
+        (source_root, all_files) = read_source_tree(crawl_services, '',
+                                                    source_folder,
+                                                    corpus=(args.crawl_mode == 'corpus'),
+                                                    listings=snapshot)
+    if snapshot:
+        snapshot.close()
+
+    write_reports(admin_service, source_root, all_files, listing)
+    log.debug("END OF MAIN")
 
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""Script to check a migration made by gxcopy.py: compare a source
+google folder with the Team Drive it was migrated to, and report:
+
+- items that are missing from the Team Drive
+- extra items in the Team Drive (that aren't in the source folder)
+- items that are in both but don't match (a folder vs. a file, or
+  different sizes / MD5 checksums)
+
+Both trees are read at the same time; see gxlib/verify.py for how they
+are compared.  The migration's --journal is needed: files that
+gxcopy.py moved are no longer in the source folder, and it says which
+parent gxcopy.py put the contents of a folder with multiple parents
+under.
+
+Exits with status 1 if there are any differences.
+
+Pre-requisites:
+- A client_id.json file downloaded from the Google Dashboard
+  (presumably of the owning organization of the destination Team
+  Drive: https://console.developers.google.com/apis/credentials)
+- A Google Account who is authorized to read everything in the source
+  folder tree and in the destination Team Drive.
+- pip install --upgrade google-api-python-client
+- pip install --upgrade recordclass
+
+Input:
+- Source folder ID
+- Destination Team Drive (name or ID)
+- The --journal of the gxcopy.py migration
+
+"""
+
+import json
+import sys
+import os
+import logging
+import logging.handlers
+import csv
+
+from oauth2client import tools
+from oauth2client.file import Storage
+from oauth2client.client import AccessTokenRefreshError
+from oauth2client.client import OAuth2WebServerFlow
+
+from gxlib.api import doit
+from gxlib.api import register_http, set_rate_limit, default_rate
+from gxlib.api import build_drive_service
+from gxlib import metrics
+from gxlib.transport import PooledHttp, keep_token_fresh
+from gxlib.records import folder_mime_type, team_drive_mime_type
+from gxlib.records import GFile
+from gxlib.teamdrives import find_team_drives
+from gxlib.teamdrives import set_index_ttl, default_index_ttl
+from gxlib.verify import verify_team_drive, read_journal
+from gxlib.verify import MISSING, EXTRA, MISMATCHED
+
+# Globals
+app_cred_file = 'client_id.json'
+admin_cred_file = 'admin-credentials.json'
+user_agent = 'gxcopy'
+args = None
+log = None
+# Scopes documented here:
+# https://developers.google.com/drive/v3/web/about-auth
+scope = 'https://www.googleapis.com/auth/drive'
+
+#-------------------------------------------------------------------
+
+def diediedie(msg):
+    global log
+
+    log.error(msg)
+    log.error("Aborting")
+
+    exit(1)
+
+#-------------------------------------------------------------------
+
+def setup_logging(args):
+    level=logging.ERROR
+
+    if args.debug:
+        level="DEBUG"
+    elif args.verbose:
+        level="INFO"
+
+    global log
+    log = logging.getLogger('FToTD')
+    log.setLevel(level)
+
+    # Make sure to include the timestamp in each message
+    f = logging.Formatter('%(asctime)s %(levelname)-8s: %(message)s')
+
+    # Default log output to stdout
+    s = logging.StreamHandler()
+    s.setFormatter(f)
+    log.addHandler(s)
+
+    # Optionally save to a rotating logfile
+    if args.logfile:
+        s = logging.FileHandler(filename=args.logfile)
+        s.setFormatter(f)
+        log.addHandler(s)
+
+    log.info('Starting')
+
+#-------------------------------------------------------------------
+
+def load_app_credentials(app_cred_file):
+    # Read in the JSON file to get the client ID and client secret
+    cwd  = os.getcwd()
+    file = os.path.join(cwd, app_cred_file)
+    if not os.path.isfile(file):
+        diediedie("Error: JSON file {0} does not exist".format(file))
+    if not os.access(file, os.R_OK):
+        diediedie("Error: JSON file {0} is not readable".format(file))
+
+    with open(file) as data_file:
+        app_cred = json.load(data_file)
+
+    log.debug('Loaded application credentials from {0}'
+                  .format(file))
+    return app_cred
+
+def load_user_credentials(filename, scope, app_cred):
+    # Get user consent
+    client_id       = app_cred['installed']['client_id']
+    client_secret   = app_cred['installed']['client_secret']
+    flow            = OAuth2WebServerFlow(client_id, client_secret, scope)
+    flow.user_agent = user_agent
+
+    cwd       = os.getcwd()
+    file      = os.path.join(cwd, filename)
+    storage   = Storage(file)
+    user_cred = storage.get()
+
+    # If no credentials are able to be loaded, fire up a web
+    # browser to get a user login, etc.  Then save those
+    # credentials in the file listed above so that next time we
+    # run, those credentials are available.
+    if user_cred is None or user_cred.invalid:
+        user_cred = tools.run_flow(flow, storage,
+                                        tools.argparser.parse_args())
+
+    log.debug('Loaded user credentials from {0}'
+              .format(file))
+    return user_cred
+
+def authorize(user_cred, name=None):
+    # One pooled, thread-safe Http per credential (see
+    # gxlib/transport.py), so the service can be shared by threads
+    http    = PooledHttp()
+    http    = user_cred.authorize(http)
+    service = build_drive_service(http)
+    register_http(http, user_cred, name)
+    keep_token_fresh(user_cred)
+
+    log.debug('Authorized to Google')
+    return service
+
+####################################################################
+
+fieldnames = [ 'Difference', 'Path', 'Details',
+               'Source link', 'Team Drive link' ]
+
+# Returns a function to give verify_team_drive() as its report
+# function, that prints each difference (and writes it to the CSV
+# file, if there is one)
+def difference_printer(csvfile):
+    writer = None
+    if csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
+                                quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+
+    def report(kind, path, name, source, team, details):
+        row = { 'Difference'      : kind,
+                'Path'            : '{0}/{1}'.format(path, name),
+                'Details'         : details or '',
+                'Source link'     : source.webViewLink if source else '',
+                'Team Drive link' : team.webViewLink if team else '' }
+
+        print("{kind:>10}: {path}"
+              .format(kind=kind.capitalize(), path=row['Path']))
+        if details:
+            print("            {0}".format(details))
+        for link in (row['Source link'], row['Team Drive link']):
+            if link:
+                print("            {0}".format(link))
+
+        if writer:
+            writer.writerow(row)
+
+    return report
+
+def print_summary(counts):
+    print("Matched:    {0}".format(counts['matched']))
+    if counts['moved']:
+        print("Moved:      {0} (according to the journal)"
+              .format(counts['moved']))
+    if counts['deduplicated']:
+        print("Left out by --dedup once: {0} (according to the journal)"
+              .format(counts['deduplicated']))
+    print("Missing:    {0}".format(counts[MISSING]))
+    print("Extra:      {0}".format(counts[EXTRA]))
+    print("Mismatched: {0}".format(counts[MISMATCHED]))
+
+#-------------------------------------------------------------------
+
+def verify_folder_id(service, id):
+    folder = doit(service.files().get(fileId=id,
+                                      fields='id,mimeType,name,webViewLink,owners,parents',
+                                      supportsTeamDrives=True))
+
+    if folder is None or folder['mimeType'] != folder_mime_type:
+        log.error("Error: Could not find any contents of folder ID: {0}"
+                  .format(id))
+        exit(1)
+
+    log.info("Valid folder ID: {0} ({1})"
+             .format(id, folder['name']))
+
+    gfile = GFile(id=folder['id'], mimeType=folder['mimeType'],
+                  webViewLink=folder['webViewLink'],
+                  name=folder['name'],
+                  parents=folder.get('parents', None),
+                  owners=folder['owners'],
+                  team_file=None)
+
+    return gfile
+
+# Find the Team Drive with this name or ID (see gxlib/teamdrives.py)
+def find_team_drive(service, name_or_id):
+    log.info("Looking for a Team Drive named '{name}'"
+             .format(name=name_or_id))
+
+    team_drives = find_team_drives(service, name_or_id)
+    if len(team_drives) > 1:
+        diediedie("There is more than one Team Drive named '{name}'; give its ID instead"
+                  .format(name=name_or_id))
+
+    for team_drive in team_drives:
+        log.info("Found matching Team Drive: {name} / {id}"
+                 .format(name=team_drive['name'],
+                         id=team_drive['id']))
+        file = GFile(id=team_drive['id'],
+                     mimeType=team_drive_mime_type,
+                     webViewLink=None,
+                     name=team_drive['name'],
+                     owners=list(),
+                     parents=['root'],
+                     team_file=None)
+        return file
+
+    diediedie("Could not find Team Drive name or ID {name}"
+              .format(name=name_or_id))
+
+#-------------------------------------------------------------------
+
+def add_cli_args():
+    tools.argparser.add_argument('--source-folder-id',
+                                 required=True,
+                                 help='Source folder ID')
+    tools.argparser.add_argument('--dest-team-drive',
+                                 required=True,
+                                 help='Destination Team Drive (name or ID)')
+
+    tools.argparser.add_argument('--app-id',
+                                 default=app_cred_file,
+                                 help='Filename containing Google application credentials')
+
+    tools.argparser.add_argument('--admin-credentials',
+                                 default=admin_cred_file,
+                                 help='Filename containing Google credentials for a domain superadmin.  This user must be able to read the entire source folder and the destination Team Drive.')
+
+    tools.argparser.add_argument('--journal',
+                                 required=True,
+                                 help='The --journal file of the gxcopy.py migration.  It says which files were moved (and so are no longer in the source folder), and where the contents of folders with multiple parents went.')
+
+    tools.argparser.add_argument('--csv',
+                                 help='Output CSV file of the differences (optional)')
+
+    tools.argparser.add_argument('--crawl-workers',
+                                 type=int,
+                                 default=1,
+                                 help='Number of folders to list in parallel when reading each of the source folder and the Team Drive (default: 1)')
+
+    tools.argparser.add_argument('--api-rate-limit',
+                                 type=float,
+                                 default=default_rate,
+                                 help='Maximum Google API calls per second per credential; 0 means no limit (default: {0})'.format(default_rate))
+    tools.argparser.add_argument('--team-drive-cache-ttl',
+                                 type=float,
+                                 default=default_index_ttl,
+                                 help='Seconds to keep entries in the local index of Team Drive names and IDs for (it saves a Google API call when looking a Team Drive up by name; anything found is still checked with Google); 0 means no index (default: {0})'.format(default_index_ttl))
+
+    tools.argparser.add_argument('--progress',
+                                 action='store_true',
+                                 help='Print a line of Google API call statistics every --metrics-interval seconds')
+    tools.argparser.add_argument('--metrics-interval',
+                                 type=float,
+                                 default=30,
+                                 help='Seconds between --progress lines and --metrics-textfile updates (default: 30)')
+    tools.argparser.add_argument('--metrics-textfile',
+                                 help='Keep Prometheus-format Google API call statistics in this file (e.g., for the node_exporter textfile collector)')
+    tools.argparser.add_argument('--metrics-json',
+                                 help='Write a JSON summary of Google API call statistics to this file at exit')
+
+    tools.argparser.add_argument('--verbose',
+                                 action='store_true',
+                                 help='Be a bit verbose in what the script is doing')
+    tools.argparser.add_argument('--debug',
+                                 action='store_true',
+                                 help='Be incredibly verbose in what the script is doing')
+    tools.argparser.add_argument('--logfile',
+                                 required=False,
+                                 help='Store verbose/debug logging to the specified file')
+
+    global args
+    args = tools.argparser.parse_args()
+
+    if not os.path.exists(args.journal):
+        print("ERROR: --journal {0} does not exist".format(args.journal))
+        exit(1)
+
+#-------------------------------------------------------------------
+
+def main():
+    add_cli_args()
+
+    # Setup logging
+    setup_logging(args)
+
+    # Keep track of where the Google API calls go
+    metrics.start_reporting(interval=args.metrics_interval,
+                            progress=args.progress,
+                            textfile=args.metrics_textfile,
+                            json_file=args.metrics_json)
+
+    # Authorize the app and provide user consent to Google
+    set_rate_limit(args.api_rate_limit)
+    set_index_ttl(args.team_drive_cache_ttl)
+    app_cred = load_app_credentials(args.app_id)
+
+    log.info("Authtenticating as administrator...")
+    admin_cred = load_user_credentials(args.admin_credentials,
+                                       scope, app_cred)
+    admin_service = authorize(admin_cred, 'admin')
+
+    source_folder = verify_folder_id(admin_service,
+                                     id=args.source_folder_id)
+    team_drive    = find_team_drive(admin_service, args.dest_team_drive)
+
+    (moved, deduplicated, traverse_under) = read_journal(args.journal)
+    log.info("Journal {0}: {1} files were moved, {2} were left out by --dedup once"
+             .format(args.journal, len(moved), len(deduplicated)))
+
+    csvfile = None
+    if args.csv:
+        csvfile = open(args.csv, 'w', newline='')
+
+    # The admin service is thread safe, so all the crawl workers (of
+    # both crawls) can share it
+    crawl_services = [admin_service] * args.crawl_workers
+
+    metrics.set_phase('verify')
+    counts = verify_team_drive(crawl_services, source_folder,
+                               crawl_services, team_drive,
+                               moved, deduplicated, traverse_under,
+                               report=difference_printer(csvfile))
+    print_summary(counts)
+
+    if csvfile:
+        csvfile.close()
+
+    log.debug("END OF MAIN")
+    if counts[MISSING] or counts[EXTRA] or counts[MISMATCHED]:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main())